@@ -0,0 +1,276 @@
+""" Cross-packet forward error correction for telemetry frames.
+
+    After every group of n data frames the can sends k parity frames. The
+    base station rebuilds any k lost frames of the group from the frames
+    and parity frames it did receive.
+
+    Parity is a systematic Reed-Solomon (Cauchy) code over GF(256). Each
+    column of the Cauchy matrix is scaled so the first parity row is all
+    ones; with k = 1 the parity is a plain XOR of the frames. Every square
+    submatrix stays invertible, so any k losses can be repaired.
+
+    Parity frame layout (big endian):
+        version    B   FRAME_VERSION
+        type       B   FRAME_PARITY
+        can        B   ID of the sending can
+        first      H   pid of the first data frame of the group
+        n          B   data frames in the group
+        k          B   parity frames of the group
+        index      B   row of this parity frame (0 .. k-1)
+        offsets    n*B pid - first of every data frame
+        parity         parity over [length byte + frame + zero padding]
+        crc        H   CRC-16/CCITT
+"""
+import struct
+try:
+    from communications.dataintegrity import crc16_ccitt
+    from communications.telemetry import FRAME_VERSION, CRC_SIZE, FEC_OVERHEAD
+except ImportError:
+    # Base station copies keep the modules next to each other
+    from dataintegrity import crc16_ccitt
+    from telemetry import FRAME_VERSION, CRC_SIZE, FEC_OVERHEAD
+
+FRAME_PARITY = 0x03
+
+PARITY_HEADER_FORMAT = '>BBBHBBB'
+PARITY_HEADER_SIZE = struct.calcsize(PARITY_HEADER_FORMAT)
+
+FEC_GROUP = 4           # Data frames per group (n)
+FEC_PARITY = 1          # Parity frames per group (k), overhead is k/n
+FEC_KEEP_FRAMES = 64    # Data frames the decoder keeps for repairs
+FEC_KEEP_GROUPS = 8     # Incomplete groups the decoder waits on
+
+# GF(256) with the polynomial x^8 + x^4 + x^3 + x^2 + 1. The exp table is
+# doubled so a product never needs a modulo.
+GF_EXP = bytearray(512)
+GF_LOG = bytearray(256)
+
+def _init_tables():
+    x = 1
+    for i in range(255):
+        GF_EXP[i] = x
+        GF_LOG[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11D
+    for i in range(255, 512):
+        GF_EXP[i] = GF_EXP[i - 255]
+
+_init_tables()
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def gf_inv(a):
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+def coefficient(row, column, k):
+    """ Entry of the normalised Cauchy matrix, x = row, y = k + column. """
+    y = k + column
+    return gf_mul(gf_inv(row ^ y), y)
+
+
+def _mul_acc(dst, src, coef):
+    """ dst ^= coef * src, element-wise over GF(256). """
+    if coef == 1:
+        for i in range(len(src)):
+            dst[i] ^= src[i]
+        return
+    log_coef = GF_LOG[coef]
+    for i in range(len(src)):
+        s = src[i]
+        if s:
+            dst[i] ^= GF_EXP[log_coef + GF_LOG[s]]
+
+
+def _symbol(frame, size):
+    """ Length-prefixed, zero padded copy of a frame. """
+    symbol = bytearray(size)
+    symbol[0] = len(frame)
+    symbol[1:1 + len(frame)] = frame
+    return symbol
+
+
+def encode_parity(frames, k, can=0):
+    """ Return the k parity frames for [(pid, frame), ...]. """
+    n = len(frames)
+    first = frames[0][0]
+    size = max(len(frame) for _, frame in frames) + 1
+    symbols = [_symbol(frame, size) for _, frame in frames]
+    header_size = PARITY_HEADER_SIZE + n
+    packets = []
+    for row in range(k):
+        packet = bytearray(header_size + size + CRC_SIZE)
+        struct.pack_into(PARITY_HEADER_FORMAT, packet, 0, FRAME_VERSION, FRAME_PARITY, can, first & 0xFFFF, n, k, row)
+        for i, (pid, _) in enumerate(frames):
+            packet[PARITY_HEADER_SIZE + i] = (pid - first) & 0xFF
+        parity = bytearray(size)
+        for column, symbol in enumerate(symbols):
+            _mul_acc(parity, symbol, coefficient(row, column, k))
+        packet[header_size:header_size + size] = parity
+        end = header_size + size
+        struct.pack_into('>H', packet, end, crc16_ccitt(memoryview(packet)[:end]))
+        packets.append(packet)
+    return packets
+
+
+def _invert(matrix):
+    """ Invert a square matrix over GF(256) (Gauss-Jordan). """
+    size = len(matrix)
+    a = [list(row) + [1 if i == j else 0 for j in range(size)] for i, row in enumerate(matrix)]
+    for col in range(size):
+        pivot = col
+        while a[pivot][col] == 0:
+            pivot += 1
+            if pivot == size:
+                raise ValueError("Singular FEC matrix")
+        a[col], a[pivot] = a[pivot], a[col]
+        inv = gf_inv(a[col][col])
+        a[col] = [gf_mul(v, inv) for v in a[col]]
+        for r in range(size):
+            factor = a[r][col]
+            if r != col and factor:
+                a[r] = [v ^ gf_mul(factor, p) for v, p in zip(a[r], a[col])]
+    return [row[size:] for row in a]
+
+
+class FecEncoder:
+    """ Collects sent data frames and emits parity frames per group. """
+
+    def __init__(self, n=FEC_GROUP, k=FEC_PARITY, can=0):
+        if n < 1 or k < 0 or n + k > 255:
+            raise ValueError("Unsupported FEC group {}+{}".format(n, k))
+        if PARITY_HEADER_SIZE + n + 1 + CRC_SIZE > FEC_OVERHEAD:
+            # The parity of a MAX_DATA_FRAME frame would not fit a packet
+            raise ValueError("FEC group of {} exceeds telemetry.FEC_OVERHEAD".format(n))
+        self.n = n
+        self.k = k
+        self.can = can
+        self._frames = []
+
+    def add(self, pid, frame):
+        """ Register a frame that was sent. Returns the parity frames to send (often none). """
+        if not self.k:
+            return []
+        parity = []
+        if self._frames and (pid - self._frames[0][0]) & 0xFFFF > 0xFF:
+            # pid offsets no longer fit a byte, close the group early
+            parity = encode_parity(self._frames, self.k, self.can)
+            self._frames = []
+        self._frames.append((pid, bytes(frame)))
+        if len(self._frames) >= self.n:
+            parity += encode_parity(self._frames, self.k, self.can)
+            self._frames = []
+        return parity
+
+
+class FecDecoder:
+    """ Rebuilds lost data frames from the parity frames of their group. """
+
+    def __init__(self, keep_frames=FEC_KEEP_FRAMES, keep_groups=FEC_KEEP_GROUPS):
+        self.keep_frames = keep_frames
+        self.keep_groups = keep_groups
+        self._frames = {}
+        self._frame_order = []
+        self._groups = {}
+        self._group_order = []
+        self.recovered = 0
+        self.unrecoverable = 0
+
+    def add_data(self, pid, frame):
+        """ Remember a received data frame. Returns False if its CRC is wrong,
+            a corrupt frame would spoil the repair of its whole group.
+        """
+        end = len(frame) - CRC_SIZE
+        if end <= 0 or crc16_ccitt(memoryview(frame)[:end]) != struct.unpack_from('>H', frame, end)[0]:
+            return False
+        self._remember(pid, frame)
+        return True
+
+    def _remember(self, pid, frame):
+        if pid not in self._frames:
+            self._frame_order.append(pid)
+            if len(self._frame_order) > self.keep_frames:
+                self._frames.pop(self._frame_order.pop(0), None)
+        self._frames[pid] = bytes(frame)
+
+    def add_parity(self, packet):
+        """ Take a parity frame, returns the data frames it allowed to rebuild.
+            Raises ValueError on a corrupt parity frame.
+        """
+        if len(packet) < PARITY_HEADER_SIZE + CRC_SIZE:
+            raise ValueError("Parity frame too short ({} bytes)".format(len(packet)))
+        end = len(packet) - CRC_SIZE
+        if crc16_ccitt(memoryview(packet)[:end]) != struct.unpack_from('>H', packet, end)[0]:
+            raise ValueError("Parity frame CRC mismatch")
+        _, _, _, first, n, k, row = struct.unpack_from(PARITY_HEADER_FORMAT, packet, 0)
+        header_size = PARITY_HEADER_SIZE + n
+        if row >= k or end <= header_size:
+            raise ValueError("Malformed parity frame")
+        pids = [(first + packet[PARITY_HEADER_SIZE + i]) & 0xFFFF for i in range(n)]
+
+        key = (first, n, k)
+        group = self._groups.get(key)
+        if group is None:
+            group = {}
+            self._groups[key] = group
+            self._group_order.append(key)
+            if len(self._group_order) > self.keep_groups:
+                dropped = self._group_order.pop(0)
+                self._groups.pop(dropped, None)
+                self.unrecoverable += 1
+        group[row] = bytes(packet[header_size:end])
+
+        missing = [i for i, pid in enumerate(pids) if pid not in self._frames]
+        if not missing:
+            self._forget(key)
+            return []
+        if len(missing) > len(group):
+            # Wait for more parity frames of this group
+            return []
+
+        frames = self._solve(pids, missing, group, k)
+        self._forget(key)
+        for i, frame in zip(missing, frames):
+            self._remember(pids[i], frame)
+        self.recovered += len(frames)
+        return frames
+
+    def _forget(self, key):
+        if key in self._groups:
+            del self._groups[key]
+            self._group_order.remove(key)
+
+    def _solve(self, pids, missing, group, k):
+        rows = sorted(group)[:len(missing)]
+        size = len(group[rows[0]])
+        # Syndromes: parity minus the contribution of the frames we have
+        syndromes = []
+        for row in rows:
+            syndrome = bytearray(group[row])
+            for column, pid in enumerate(pids):
+                if column in missing:
+                    continue
+                frame = self._frames[pid]
+                if len(frame) + 1 > size:
+                    raise ValueError("Frame {} does not belong to this parity group".format(pid))
+                _mul_acc(syndrome, _symbol(frame, size), coefficient(row, column, k))
+            syndromes.append(syndrome)
+
+        inverse = _invert([[coefficient(row, column, k) for column in missing] for row in rows])
+        frames = []
+        for i in range(len(missing)):
+            symbol = bytearray(size)
+            for r, syndrome in enumerate(syndromes):
+                if inverse[i][r]:
+                    _mul_acc(symbol, syndrome, inverse[i][r])
+            length = symbol[0]
+            if length + 1 > size:
+                raise ValueError("Rebuilt frame has an invalid length")
+            frames.append(bytes(symbol[1:1 + length]))
+        return frames
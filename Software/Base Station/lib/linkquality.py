@@ -0,0 +1,94 @@
+""" Link quality of the can downlink and the spreading factor policy.
+
+    LinkMonitor keeps the RSSI/SNR of the last packets and the pids of the
+    last samples; the packet error rate is the share of pids missing
+    between the oldest and the newest one of the window.
+
+    choose_sf() is the adaptive data rate policy: the lowest SF, i.e. the
+    highest throughput, whose demodulation floor the measured SNR still
+    clears by ADR_MARGIN_DB. Pid gaps alone do not raise the SF, the can
+    also skips samples when its duty-cycle budget runs short; they only
+    count together with a thin SNR margin.
+
+    ADR stops at SF_MAX. Above it a keyframe takes over 1.3 s on air and
+    the 1 % duty cycle leaves a couple of dozen frames per hour, too few
+    to track the can; SF11/SF12 stay available by telecommand.
+"""
+
+SF_MIN = 7
+SF_MAX = 10             # Highest SF the can still sends usable telemetry at
+SF_STEP_DB = 2.5        # Sensitivity gained per SF step
+ADR_MARGIN_DB = 6       # Kept above the demodulation floor, the can tumbles and moves away
+PER_OK = 0.1            # Loss accepted before trading throughput for range
+PER_HIGH = 0.3          # Loss that raises the SF when the SNR margin is thin as well
+LINK_WINDOW = 20        # Packets and samples the rates are computed over
+
+
+def required_snr(sf):
+    """ SNR the SX127x needs to demodulate at 'sf' (Semtech datasheet), in dB. """
+    return -7.5 - SF_STEP_DB * (sf - 7)
+
+
+def choose_sf(sf, per, snr, margin_db=ADR_MARGIN_DB):
+    """ SF for the next packets, one step at a time, from the current 'sf',
+        packet error rate 'per' (0 .. 1) and mean 'snr' in dB.
+    """
+    if sf > SF_MAX:
+        # Set by hand, ADR brings it back into its own range
+        return SF_MAX
+    margin = snr - required_snr(sf) - margin_db
+    if sf < SF_MAX and (margin < 0 or (per > PER_HIGH and margin < SF_STEP_DB)):
+        return sf + 1
+    if sf > SF_MIN and per <= PER_OK and margin >= SF_STEP_DB:
+        return sf - 1
+    return sf
+
+
+class LinkMonitor:
+    """ Rolling RSSI, SNR and packet error rate of the downlink. """
+
+    def __init__(self, window=LINK_WINDOW):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        """ Start over, e.g. after an SF change the old figures no longer apply. """
+        self._rssi = []
+        self._snr = []
+        self._pids = []
+
+    def add_packet(self, rssi, snr):
+        self._rssi.append(rssi)
+        self._snr.append(snr)
+        if len(self._snr) > self.window:
+            self._rssi.pop(0)
+            self._snr.pop(0)
+
+    def add_pid(self, pid):
+        """ Count a received sample; late ones (retransmissions, repairs) do not change the rate. """
+        pid &= 0xFFFF
+        if self._pids and not 0 < (pid - self._pids[-1]) & 0xFFFF < 0x8000:
+            return
+        self._pids.append(pid)
+        if len(self._pids) > self.window:
+            self._pids.pop(0)
+
+    @property
+    def full(self):
+        """ Enough packets and samples for a decision. """
+        return len(self._snr) >= self.window and len(self._pids) >= self.window
+
+    def per(self):
+        if len(self._pids) < 2:
+            return 0.0
+        span = ((self._pids[-1] - self._pids[0]) & 0xFFFF) + 1
+        return 1 - len(self._pids) / span
+
+    def rssi(self):
+        return sum(self._rssi) / len(self._rssi) if self._rssi else None
+
+    def snr(self):
+        return sum(self._snr) / len(self._snr) if self._snr else None
+
+    def stats(self):
+        return {'rssi': self.rssi(), 'snr': self.snr(), 'per': self.per()}
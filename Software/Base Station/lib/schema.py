@@ -0,0 +1,159 @@
+""" Telemetry schema shared by the can, the base station and the host.
+
+    This file is the one definition of the telemetry names and fields:
+    KEY_MAP renames keys for the JSON packets and logs, TLM_FIELDS drives
+    the binary frame encoder and decoder in telemetry.py, LOG_FIELDS the
+    flight log records in logformat.py. Base Station/lib
+    and Data Analysis keep identical copies, written by sync_shared.py
+    (Software folder); SCHEMA_HASH is sent in every keyframe, so a copy
+    that drifted is rejected instead of misparsed.
+"""
+try:
+    from communications.dataintegrity import crc16_ccitt
+except ImportError:
+    # Base station and host copies keep dataintegrity.py next to this module
+    from dataintegrity import crc16_ccitt
+
+# Long name -> short name used on the radio and in the logs
+KEY_MAP = {
+    "pid": "pid",
+    "type": "type",
+    "epoch": "etm",
+    "valid": "vld",
+    "esp32": "e32",
+    "wss": "wss",
+    "fmem": "fm",
+    "altitude": "alt",
+    "temperature": "tmp",
+    "bmp280": "b28",
+    "bme688": "b68",
+    "lps25h": "l25",
+    "lis3mdl": "l3m",
+    "pressure": "prs",
+    "acceleration": "acc",
+    "gyroscope": "gyr",
+    "gps_coordinates": "gps",
+    "air_quality": "aq",
+    "ccs811": "c81",
+    "eCO2": "eco",
+    "tVOC": "tvoc",
+    "telemetry": "tlm",
+    "mpu9250": "mpu",
+    "mcp9808": "mcp",
+    "accel_x": "a_x",
+    "accel_y": "a_y",
+    "accel_z": "a_z",
+    "gyro_x": "g_x",
+    "gyro_y": "g_y",
+    "gyro_z": "g_z",
+    "mag_x": "m_x",
+    "mag_y": "m_y",
+    "mag_z": "m_z",
+    "longitude": "lon",
+    "latitude": "lat",
+    "speed": "spd",
+    "timestamp": "tmsp",
+    "magnetic_variation": "mv",
+    "course": "crs",
+    "null": "na",
+    "pres": "pre",
+    "temp": "tme",
+    "volt": "V",
+    "soc": "soc",
+    "icm20948": "icm"
+}
+
+# Binary telemetry fields: (group, sensor, keys, struct codes, scales). A
+# field maps to data[group][sensor] (a scalar when keys is None, a dict
+# otherwise) or, when sensor is None, to the keys of data[group] directly.
+# Appending a field is compatible with the presence bitmap (16 bits at most);
+# any change alters SCHEMA_HASH.
+TLM_FIELDS = (
+    ('temp', 'bme688', None, 'h', (100,)),          # 0.01 °C
+    ('temp', 'lps25h', None, 'h', (100,)),
+    ('temp', 'mcp9808', None, 'h', (100,)),
+    ('temp', 'bmp280', None, 'h', (100,)),
+    ('pres', 'bme688', None, 'H', (50,)),           # 0.02 hPa
+    ('pres', 'lps25h', None, 'H', (50,)),
+    ('pres', 'bmp280', None, 'H', (50,)),
+    ('alt', 'bme688', None, 'h', (10,)),            # 0.1 m
+    ('alt', 'lps25h', None, 'h', (10,)),
+    ('alt', 'bmp280', None, 'h', (10,)),
+    ('hum', 'bme688', None, 'H', (100,)),           # 0.01 %
+    ('hum', 'bmp280', None, 'H', (100,)),
+    ('acc', 'icm20948', ('accel_x', 'accel_y', 'accel_z'), 'hhh', (1000, 1000, 1000)),  # mg
+    ('gyro', 'icm20948', ('gyro_x', 'gyro_y', 'gyro_z'), 'hhh', (10, 10, 10)),          # 0.1 dps
+    ('gps', None, ('lat', 'lon', 'gtm'), 'iiI', (10000000, 10000000, 100)),             # 1e-7 °, 0.01 s of day
+    ('bat', None, ('volt', 'soc'), 'HH', (1000, 100)),                                  # mV, 0.01 %
+)
+
+# Fields needed to follow and recover the can, always sent first
+CRITICAL_GROUPS = ('alt', 'gps', 'bat')
+
+# Flight log sample fields: (group, sensor, keys, struct codes), looked up
+# like TLM_FIELDS in the full-resolution data plus 'esp32'. Every sample
+# has every field, a missing value is stored as NaN. Any change alters
+# LOG_SCHEMA_HASH, which each log file starts with.
+LOG_FIELDS = (
+    ('temp', 'bme688', None, 'f'),                  # °C
+    ('temp', 'lps25h', None, 'f'),
+    ('temp', 'mcp9808', None, 'f'),
+    ('temp', 'bmp280', None, 'f'),
+    ('pres', 'bme688', None, 'f'),                  # hPa
+    ('pres', 'lps25h', None, 'f'),
+    ('pres', 'bmp280', None, 'f'),
+    ('alt', 'bme688', None, 'f'),                   # m
+    ('alt', 'lps25h', None, 'f'),
+    ('alt', 'bmp280', None, 'f'),
+    ('hum', 'bme688', None, 'f'),                   # %
+    ('hum', 'bmp280', None, 'f'),
+    ('acc', 'icm20948', ('accel_x', 'accel_y', 'accel_z'), 'fff'),     # g
+    ('gyro', 'icm20948', ('gyro_x', 'gyro_y', 'gyro_z'), 'fff'),       # dps
+    ('mag', 'icm20948', ('mag_x', 'mag_y', 'mag_z'), 'fff'),           # raw counts
+    ('mag', 'lis3mdl', ('mag_x', 'mag_y', 'mag_z'), 'fff'),            # gauss, hard/soft-iron corrected
+    ('air', 'ccs811', ('eCO2', 'tVOC'), 'ff'),                         # ppm, ppb
+    ('uv', None, ('uva', 'uvb', 'uvidx'), 'fff'),
+    ('gps', None, ('lat', 'lon', 'gtm'), 'ddf'),                       # °, s of day
+    ('bat', None, ('volt', 'soc'), 'ff'),                              # V, %
+    ('esp32', None, ('fmem', 'wss'), 'ff'),                            # bytes, dBm
+)
+
+# Precomputed tables, lookups only at run time
+KEY_MAP_REVERSE = {short: name for name, short in KEY_MAP.items()}
+if len(KEY_MAP_REVERSE) != len(KEY_MAP):
+    raise ValueError("KEY_MAP short names must be unique")
+if len(TLM_FIELDS) > 16:
+    raise ValueError("TLM_FIELDS does not fit the 16-bit presence bitmap")
+
+
+def _canonical():
+    """ Text form of the schema, identical on MicroPython and CPython. """
+    parts = []
+    for name in sorted(KEY_MAP):
+        parts.append('{}={}'.format(name, KEY_MAP[name]))
+    for group, sensor, keys, codes, scales in TLM_FIELDS:
+        parts.append('{}|{}|{}|{}|{}'.format(group, sensor or '', ','.join(keys or ()), codes,
+                                             ','.join(str(scale) for scale in scales)))
+    parts.append(','.join(CRITICAL_GROUPS))
+    return ';'.join(parts).encode()
+
+SCHEMA_HASH = crc16_ccitt(_canonical())
+
+
+def _log_canonical():
+    parts = []
+    for group, sensor, keys, codes in LOG_FIELDS:
+        parts.append('{}|{}|{}|{}'.format(group, sensor or '', ','.join(keys or ()), codes))
+    return ';'.join(parts).encode()
+
+LOG_SCHEMA_HASH = crc16_ccitt(_log_canonical())
+
+
+def rename_keys(data, table):
+    """ Rename the keys of a nested dict with KEY_MAP or KEY_MAP_REVERSE. """
+    renamed = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            value = rename_keys(value, table)
+        renamed[table.get(key, key)] = value
+    return renamed
@@ -0,0 +1,271 @@
+""" Authenticated telecommands on the LoRa uplink.
+
+    The can opens a short receive window after every RX_EVERY-th
+    transmission and announces it with a FRAME_LISTEN frame sent right
+    before it. The base station sends its pending command only after that
+    frame, once per window, until the command is acknowledged; the
+    acknowledgement goes out in the can's next downlink.
+
+    Command layout (big endian):
+        version    B   FRAME_VERSION
+        type       B   FRAME_COMMAND
+        can        B   ID of the can it is for, CAN_BROADCAST for all of them
+        seq        H   increases with every new command
+        opcode     B   CMD_*
+        args           COMMAND_ARGS[opcode]
+        tag        8s  HMAC-SHA256 over everything before it, truncated
+
+    Acknowledgement layout:
+        version    B   FRAME_VERSION
+        type       B   FRAME_ACK
+        can        B   ID of the acknowledging can
+        seq        H   seq of the command
+        opcode     B   opcode of the command
+        status     B   STATUS_*
+        crc        H   CRC-16/CCITT
+
+    Listen layout:
+        version    B   FRAME_VERSION
+        type       B   FRAME_LISTEN
+        can        B   ID of the listening can
+        pid        H   sample counter of the cycle
+        window     H   length of the receive window in ms
+        crc        H   CRC-16/CCITT
+
+    A command whose seq is not newer than the last accepted one is a
+    replay; the last command itself is acknowledged again without running
+    it twice, in case the first acknowledgement was lost; its status is
+    kept in flash with the seq, so this also holds across a reboot. Commands for
+    another can are ignored, the base station numbers all commands in one
+    sequence so skipped ones never make a later one look like a replay.
+"""
+import struct
+try:
+    from communications.dataintegrity import crc16_ccitt, hmac_sha256
+    from communications.telemetry import FRAME_VERSION, CRC_SIZE
+except ImportError:
+    # Base station copies keep the modules next to each other
+    from dataintegrity import crc16_ccitt, hmac_sha256
+    from telemetry import FRAME_VERSION, CRC_SIZE
+
+FRAME_COMMAND = 0x04
+FRAME_ACK = 0x05
+FRAME_LISTEN = 0x08
+
+COMMAND_HEADER_FORMAT = '>BBBHB'
+COMMAND_HEADER_SIZE = struct.calcsize(COMMAND_HEADER_FORMAT)
+ACK_FORMAT = '>BBBHBB'
+ACK_SIZE = struct.calcsize(ACK_FORMAT) + CRC_SIZE
+LISTEN_FORMAT = '>BBBHH'
+LISTEN_SIZE = struct.calcsize(LISTEN_FORMAT) + CRC_SIZE
+TAG_SIZE = 8
+CAN_BROADCAST = 0xFF
+
+CMD_SET_PERIOD = 0x01       # H   sample period in ms, 0 = as fast as possible
+CMD_SET_SF = 0x02           # B   spreading factor 7 .. 12
+CMD_SET_POWER = 0x03        # b   output power in dBm, -3 .. 15
+CMD_RETRANSMIT = 0x04       # HH  first and last pid to send again
+CMD_SET_MODE = 0x05         # B   MODE_*
+CMD_SET_BATCH = 0x06        # BH  samples per batch frame (0 = off), latency in ms
+
+COMMAND_ARGS = {
+    CMD_SET_PERIOD: '>H',
+    CMD_SET_SF: '>B',
+    CMD_SET_POWER: '>b',
+    CMD_RETRANSMIT: '>HH',
+    CMD_SET_MODE: '>B',
+    CMD_SET_BATCH: '>BH',
+}
+COMMAND_NAMES = {
+    CMD_SET_PERIOD: 'period',
+    CMD_SET_SF: 'sf',
+    CMD_SET_POWER: 'power',
+    CMD_RETRANSMIT: 'retransmit',
+    CMD_SET_MODE: 'mode',
+    CMD_SET_BATCH: 'batch',
+}
+
+STATUS_OK = 0
+STATUS_BAD_ARGS = 1
+STATUS_UNSUPPORTED = 2
+STATUS_FAILED = 3
+STATUS_NAMES = ('ok', 'bad_args', 'unsupported', 'failed')
+
+# Flight modes
+MODE_PAD = 0                # Slow telemetry while waiting for launch
+MODE_FLIGHT = 1             # Every sample, keyframes plus deltas
+MODE_RECOVERY = 2           # Slow keyframes only, each one locates the can on its own
+MODE_NAMES = ('pad', 'flight', 'recovery')
+MODE_PERIOD_MS = (5000, 0, 10000)   # Sample period each mode starts with
+
+RX_EVERY = 10               # Transmissions between two receive windows
+RX_WINDOW_MS = 1000
+RX_DELAY_MS = 150           # Base station: wait after a frame before sending
+
+SEQ_FILE = 'telecommand_seq.txt'
+
+
+def rx_window_symbols(window_ms, sf, bw):
+    """ 'radio rx' takes the LoRa window in symbols, 'bw' is in kHz. """
+    return max(1, min(window_ms * bw // (1 << sf), 65535))
+
+
+def encode_command(key, seq, opcode, *args, can=CAN_BROADCAST):
+    """ Build an authenticated command frame (base station side). """
+    fmt = COMMAND_ARGS.get(opcode)
+    if fmt is None:
+        raise ValueError("Unknown telecommand opcode {}".format(opcode))
+    body = struct.pack(COMMAND_HEADER_FORMAT, FRAME_VERSION, FRAME_COMMAND, can, seq & 0xFFFF, opcode) + struct.pack(fmt, *args)
+    return body + hmac_sha256(key, body)[:TAG_SIZE]
+
+
+def decode_command(key, packet):
+    """ Return (can, seq, opcode, args) of a command frame.
+        Raises ValueError on a forged, corrupt or unknown command.
+    """
+    if len(packet) < COMMAND_HEADER_SIZE + TAG_SIZE:
+        raise ValueError("Command too short ({} bytes)".format(len(packet)))
+    end = len(packet) - TAG_SIZE
+    body = bytes(packet[:end])
+    expected = hmac_sha256(key, body)[:TAG_SIZE]
+    # Compare every byte, so the time taken does not reveal the tag
+    diff = 0
+    for a, b in zip(expected, packet[end:]):
+        diff |= a ^ b
+    if diff:
+        raise ValueError("Command authentication failed")
+    version, frame_type, can, seq, opcode = struct.unpack_from(COMMAND_HEADER_FORMAT, body, 0)
+    if version != FRAME_VERSION or frame_type != FRAME_COMMAND:
+        raise ValueError("Not a telecommand")
+    fmt = COMMAND_ARGS.get(opcode)
+    if fmt is None or struct.calcsize(fmt) != end - COMMAND_HEADER_SIZE:
+        raise ValueError("Unknown telecommand {}".format(opcode))
+    return can, seq, opcode, struct.unpack_from(fmt, body, COMMAND_HEADER_SIZE)
+
+
+def encode_ack(seq, opcode, status, can=0):
+    ack = bytearray(ACK_SIZE)
+    struct.pack_into(ACK_FORMAT, ack, 0, FRAME_VERSION, FRAME_ACK, can, seq & 0xFFFF, opcode, status)
+    struct.pack_into('>H', ack, ACK_SIZE - CRC_SIZE, crc16_ccitt(memoryview(ack)[:ACK_SIZE - CRC_SIZE]))
+    return ack
+
+
+def decode_ack(frame):
+    """ Return {'can', 'seq', 'opcode', 'status'}, raises ValueError on a corrupt frame. """
+    if len(frame) != ACK_SIZE:
+        raise ValueError("Acknowledgement has the wrong size ({} bytes)".format(len(frame)))
+    if crc16_ccitt(memoryview(frame)[:ACK_SIZE - CRC_SIZE]) != struct.unpack_from('>H', frame, ACK_SIZE - CRC_SIZE)[0]:
+        raise ValueError("Acknowledgement CRC mismatch")
+    _, _, can, seq, opcode, status = struct.unpack_from(ACK_FORMAT, frame, 0)
+    return {'can': can, 'seq': seq, 'opcode': opcode, 'status': status}
+
+
+def encode_listen(pid, window_ms, can=0):
+    """ The frame sent right before a receive window. """
+    frame = bytearray(LISTEN_SIZE)
+    struct.pack_into(LISTEN_FORMAT, frame, 0, FRAME_VERSION, FRAME_LISTEN, can, pid & 0xFFFF, window_ms)
+    struct.pack_into('>H', frame, LISTEN_SIZE - CRC_SIZE, crc16_ccitt(memoryview(frame)[:LISTEN_SIZE - CRC_SIZE]))
+    return frame
+
+
+def decode_listen(frame):
+    """ Return {'can', 'pid', 'window_ms'}, raises ValueError on a corrupt frame. """
+    if len(frame) != LISTEN_SIZE:
+        raise ValueError("Listen frame has the wrong size ({} bytes)".format(len(frame)))
+    if crc16_ccitt(memoryview(frame)[:LISTEN_SIZE - CRC_SIZE]) != struct.unpack_from('>H', frame, LISTEN_SIZE - CRC_SIZE)[0]:
+        raise ValueError("Listen frame CRC mismatch")
+    _, _, can, pid, window_ms = struct.unpack_from(LISTEN_FORMAT, frame, 0)
+    return {'can': can, 'pid': pid, 'window_ms': window_ms}
+
+
+def _newer(seq, last):
+    """ Serial number arithmetic, seq wraps at 65536. """
+    return last is None or 0 < (seq - last) & 0xFFFF < 0x8000
+
+
+class TelecommandReceiver:
+    """ Can side: decides when to listen, authenticates and runs commands.
+
+        Handlers are registered per opcode, take the command arguments and
+        return a STATUS_* code. Acknowledgements wait in 'acks' until the
+        next downlink picks them up with take_acks().
+    """
+
+    def __init__(self, key, rx_every=RX_EVERY, seq_file=SEQ_FILE, can=0):
+        self.key = key
+        self.can = can
+        self.rx_every = rx_every
+        self.seq_file = seq_file
+        self.handlers = {}
+        self.acks = []
+        self.last_seq, self.last_status = self._load_seq()
+        self.rejected = 0
+        self._since_rx = 0
+
+    def _load_seq(self):
+        """ (seq, status) of the last command run, (None, None) before the first. """
+        try:
+            with open(self.seq_file, 'r') as file:
+                parts = file.read().split()
+            # Files written before the status was kept hold the seq alone
+            return int(parts[0]), int(parts[1]) if len(parts) > 1 else None
+        except (OSError, ValueError, IndexError):
+            return None, None
+
+    def _save_seq(self):
+        # Kept in flash, so a reboot does not make old commands valid again,
+        # and a retry of the last one is still acknowledged after it
+        try:
+            with open(self.seq_file, 'w') as file:
+                file.write("{} {}".format(self.last_seq, self.last_status))
+        except OSError:
+            pass
+
+    def register(self, opcode, handler):
+        self.handlers[opcode] = handler
+
+    def sent(self):
+        """ Count one transmission, returns True when a receive window is due. """
+        self._since_rx += 1
+        if self._since_rx >= self.rx_every:
+            self._since_rx = 0
+            return True
+        return False
+
+    def receive(self, packet):
+        """ Handle one uplink packet. Returns (seq, opcode, status), or None
+            if it was rejected or is meant for another can.
+        """
+        try:
+            can, seq, opcode, args = decode_command(self.key, packet)
+        except ValueError:
+            self.rejected += 1
+            return None
+        if can != self.can and can != CAN_BROADCAST:
+            return None
+        if seq == self.last_seq and self.last_status is not None:
+            # Retry of the last command, its acknowledgement was lost
+            self.acks.append(encode_ack(seq, opcode, self.last_status, self.can))
+            return seq, opcode, self.last_status
+        if not _newer(seq, self.last_seq):
+            self.rejected += 1
+            return None
+
+        handler = self.handlers.get(opcode)
+        if handler is None:
+            status = STATUS_UNSUPPORTED
+        else:
+            try:
+                status = handler(*args)
+            except ValueError:
+                status = STATUS_BAD_ARGS
+        self.last_seq = seq
+        self.last_status = status
+        self._save_seq()
+        self.acks.append(encode_ack(seq, opcode, status, self.can))
+        return seq, opcode, status
+
+    def take_acks(self):
+        acks = self.acks
+        self.acks = []
+        return acks
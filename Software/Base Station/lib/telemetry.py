@@ -0,0 +1,496 @@
+""" Binary telemetry frames for the LoRa downlink.
+
+    Keyframe layout (big endian):
+        version    B   FRAME_VERSION, bumped when the frame layout changes
+        type       B   FRAME_TLM
+        can        B   ID of the sending can (tdma.can_id_from_hweui)
+        pid        H   packet id, also the sequence number (wraps at 65536)
+        schema     H   SCHEMA_HASH of the sender (schema.py)
+        epoch      I   can time in seconds
+        presence   H   bit n set when TLM_FIELDS[n] is in the frame
+        fields         only the present ones, in TLM_FIELDS order
+        crc        H   CRC-16/CCITT over everything before it
+
+    Delta frame layout:
+        version    B   FRAME_VERSION
+        type       B   FRAME_DELTA
+        can        B   as above
+        pid        H   packet id
+        ref        B   pid - pid of the keyframe the deltas refer to
+        presence   H   as above
+        deltas         zigzag varints: epoch, then every value of every
+                       present field minus its keyframe value (0 if the
+                       keyframe lacks the field)
+        crc        H   CRC-16/CCITT
+
+    Bulk frames have the keyframe layout with type FRAME_BULK. They carry
+    the fields outside CRITICAL_GROUPS for a pid whose critical fields
+    went in a keyframe or delta frame, are never a delta reference and
+    may be dropped when airtime is short.
+
+    Batch frame layout, several reduced samples in one packet:
+        version    B   FRAME_VERSION
+        type       B   FRAME_BATCH
+        can        B   as above
+        pid        H   pid of the first sample
+        schema     H   SCHEMA_HASH
+        epoch      I   can time of the first sample in seconds
+        count      B   samples that follow, BATCH_SAMPLE_FORMAT each:
+                       pid offset, time since the first sample (10 ms),
+                       altitude (0.1 m), vertical speed (0.1 m/s),
+                       latitude and longitude (1e-7 °); missing values
+                       are sent as the lowest integer of their code
+        crc        H   CRC-16/CCITT
+
+    Values are sent as scaled integers, so a missing sensor costs nothing
+    and a full sample fits one radio packet. Deltas always refer to a
+    keyframe, never to the previous delta, so a lost delta frame costs
+    only itself and the base station resynchronises at the next keyframe.
+    This module runs unchanged on the can, the base station and the host.
+"""
+import struct
+import time
+try:
+    from communications.dataintegrity import crc16_ccitt
+    from communications.schema import TLM_FIELDS, CRITICAL_GROUPS, SCHEMA_HASH
+except ImportError:
+    # Base station and host copies keep dataintegrity.py next to this module
+    from dataintegrity import crc16_ccitt
+    from schema import TLM_FIELDS, CRITICAL_GROUPS, SCHEMA_HASH
+
+FRAME_VERSION = 3
+
+FRAME_TLM = 0x01       # Keyframe, absolute values
+FRAME_DELTA = 0x02     # Differences against a keyframe
+FRAME_BULK = 0x06      # Low-priority fields, absolute values
+FRAME_BATCH = 0x07     # Reduced samples, many per frame
+FRAME_TYPE_NAMES = {FRAME_TLM: 'TLM', FRAME_DELTA: 'DLT', FRAME_BULK: 'BLK', FRAME_BATCH: 'BAT'}
+
+# Every frame on the link starts with version, type and can, most with the pid next
+CAN_OFFSET = 2
+PID_OFFSET = 3
+
+HEADER_FORMAT = '>BBBHHIH'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+DELTA_HEADER_FORMAT = '>BBBHBH'
+DELTA_HEADER_SIZE = struct.calcsize(DELTA_HEADER_FORMAT)
+CRC_SIZE = 2
+BATCH_HEADER_FORMAT = '>BBBHHIB'
+BATCH_HEADER_SIZE = struct.calcsize(BATCH_HEADER_FORMAT)
+BATCH_SAMPLE_FORMAT = '>BHhhii'
+BATCH_SAMPLE_SIZE = struct.calcsize(BATCH_SAMPLE_FORMAT)
+MAX_FRAME = 255         # RN2483 payload limit
+# A FEC parity frame (fec.py) adds its header, the pid offsets of a group,
+# a length byte and its CRC to the largest data frame of the group
+FEC_OVERHEAD = 15
+MAX_DATA_FRAME = MAX_FRAME - FEC_OVERHEAD
+BATCH_MAX_SAMPLES = (MAX_DATA_FRAME - BATCH_HEADER_SIZE - CRC_SIZE) // BATCH_SAMPLE_SIZE
+
+# Delta frames sent between two keyframes
+KEYFRAME_INTERVAL = 10
+# Keyframes kept by the decoder for late delta frames
+KEYFRAMES_KEPT = 4
+
+# Presence masks of all, critical and bulk fields
+ALL_FIELDS = (1 << len(TLM_FIELDS)) - 1
+CRITICAL_FIELDS = sum(1 << bit for bit, field in enumerate(TLM_FIELDS) if field[0] in CRITICAL_GROUPS)
+BULK_FIELDS = ALL_FIELDS & ~CRITICAL_FIELDS
+
+# Integer range of each struct code, values outside are clamped
+_LIMITS = {
+    'b': (-0x80, 0x7F), 'B': (0, 0xFF),
+    'h': (-0x8000, 0x7FFF), 'H': (0, 0xFFFF),
+    'i': (-0x80000000, 0x7FFFFFFF), 'I': (0, 0xFFFFFFFF),
+}
+
+# Precomputed per-field formats and sizes for decoding
+_FIELD_FORMATS = tuple('>' + field[3] for field in TLM_FIELDS)
+_FIELD_SIZES = tuple(struct.calcsize(fmt) for fmt in _FIELD_FORMATS)
+
+
+def frame_can(frame):
+    """ ID of the can that sent a frame. """
+    return frame[CAN_OFFSET]
+
+
+def frame_pid(frame):
+    """ pid of a telemetry frame, of the first sample for a batch frame. """
+    return (frame[PID_OFFSET] << 8) | frame[PID_OFFSET + 1]
+
+
+def _lookup(data, group, sensor, keys):
+    """ Return the field values as a tuple, or None if any is missing. """
+    value = data.get(group)
+    if sensor is not None:
+        value = value.get(sensor) if isinstance(value, dict) else None
+    if keys is None:
+        return None if value is None else (value,)
+    if not isinstance(value, dict):
+        return None
+    values = tuple(value.get(key) for key in keys)
+    return None if None in values else values
+
+
+def _to_fixed(value, code, scale):
+    low, high = _LIMITS[code]
+    value = int(round(value * scale))
+    return low if value < low else high if value > high else value
+
+
+def _fixed_fields(data, mask=ALL_FIELDS):
+    """ Return (presence bitmap, [(bit, fixed values), ...]) for the fields of one sample in 'mask'. """
+    presence = 0
+    fields = []
+    for bit, (group, sensor, keys, codes, scales) in enumerate(TLM_FIELDS):
+        if not mask & (1 << bit):
+            continue
+        raw = _lookup(data, group, sensor, keys)
+        if raw is None:
+            continue
+        try:
+            fixed = tuple(_to_fixed(value, code, scale) for value, code, scale in zip(raw, codes, scales))
+        except (TypeError, ValueError):
+            # Non-numeric reading, send the field as missing
+            continue
+        presence |= 1 << bit
+        fields.append((bit, fixed))
+    return presence, fields
+
+
+def _to_data(fields):
+    """ Scale fixed-point fields back into the nested radio data dict. """
+    data = {}
+    for bit, raw in fields:
+        group, sensor, keys, codes, scales = TLM_FIELDS[bit]
+        values = [value / scale for value, scale in zip(raw, scales)]
+        target = data.setdefault(group, {})
+        if keys is None:
+            target[sensor] = values[0]
+        elif sensor is None:
+            target.update(zip(keys, values))
+        else:
+            target[sensor] = dict(zip(keys, values))
+    return data
+
+
+def _zigzag(value):
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def _put_varint(buf, value):
+    while value > 0x7F:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _get_varint(frame, offset, end):
+    value = 0
+    shift = 0
+    while True:
+        if offset >= end:
+            raise ValueError("Truncated varint in delta frame")
+        b = frame[offset]
+        offset += 1
+        value |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return value, offset
+        shift += 7
+
+
+def _append_crc(frame, size):
+    struct.pack_into('>H', frame, size, crc16_ccitt(memoryview(frame)[:size]))
+
+
+def _check_crc(frame):
+    """ Verify the CRC trailer, returns the end of the frame body. """
+    if len(frame) < DELTA_HEADER_SIZE + CRC_SIZE:
+        raise ValueError("Frame too short ({} bytes)".format(len(frame)))
+    end = len(frame) - CRC_SIZE
+    if crc16_ccitt(memoryview(frame)[:end]) != struct.unpack_from('>H', frame, end)[0]:
+        raise ValueError("Frame CRC mismatch")
+    if frame[0] != FRAME_VERSION:
+        raise ValueError("Unsupported frame version {}".format(frame[0]))
+    return end
+
+
+def _pack_keyframe(pid, epoch, presence, fields, frame_type=FRAME_TLM, can=0):
+    fmt = HEADER_FORMAT
+    values = []
+    for bit, fixed in fields:
+        fmt += TLM_FIELDS[bit][3]
+        values.extend(fixed)
+    size = struct.calcsize(fmt)
+    frame = bytearray(size + CRC_SIZE)
+    struct.pack_into(fmt, frame, 0, FRAME_VERSION, frame_type, can, pid & 0xFFFF, SCHEMA_HASH, int(epoch) & 0xFFFFFFFF, presence, *values)
+    _append_crc(frame, size)
+    return frame
+
+
+def _pack_delta(pid, epoch, presence, fields, key, can=0):
+    key_pid, key_epoch, key_fields = key
+    frame = bytearray(DELTA_HEADER_SIZE)
+    struct.pack_into(DELTA_HEADER_FORMAT, frame, 0, FRAME_VERSION, FRAME_DELTA, can, pid & 0xFFFF, (pid - key_pid) & 0xFF, presence)
+    _put_varint(frame, _zigzag(int(epoch) - key_epoch))
+    for bit, fixed in fields:
+        base = key_fields.get(bit)
+        for i, value in enumerate(fixed):
+            _put_varint(frame, _zigzag(value - base[i] if base else value))
+    size = len(frame)
+    frame.extend(bytes(CRC_SIZE))
+    _append_crc(frame, size)
+    return frame
+
+
+def _unpack_keyframe(frame, end):
+    if end < HEADER_SIZE:
+        raise ValueError("Frame too short ({} bytes)".format(len(frame)))
+    version, frame_type, can, pid, schema, epoch, presence = struct.unpack_from(HEADER_FORMAT, frame, 0)
+    if schema != SCHEMA_HASH:
+        raise ValueError("Frame {} uses schema {:04x}, expected {:04x}".format(pid, schema, SCHEMA_HASH))
+    fields = []
+    offset = HEADER_SIZE
+    for bit in range(len(TLM_FIELDS)):
+        if not presence & (1 << bit):
+            continue
+        if offset + _FIELD_SIZES[bit] > end:
+            raise ValueError("Frame shorter than its presence bitmap")
+        fields.append((bit, struct.unpack_from(_FIELD_FORMATS[bit], frame, offset)))
+        offset += _FIELD_SIZES[bit]
+    if offset != end:
+        raise ValueError("Frame longer than its presence bitmap")
+    return frame_type, can, pid, epoch, fields
+
+
+def _result(frame_type, can, pid, epoch, fields):
+    return {
+        'version': FRAME_VERSION,
+        'type': FRAME_TYPE_NAMES.get(frame_type, frame_type),
+        'can': can,
+        'pid': pid,
+        'epoch': epoch,
+        'data': _to_data(fields)
+    }
+
+
+def encode_frame(pid, epoch, data, frame_type=FRAME_TLM, mask=ALL_FIELDS, can=0):
+    """ Pack the fields in 'mask' of one sample ('data' as collected for the radio) into a keyframe. """
+    presence, fields = _fixed_fields(data, mask)
+    return _pack_keyframe(pid, epoch, presence, fields, frame_type, can)
+
+
+def decode_frame(frame):
+    """ Unpack a keyframe into {'version', 'type', 'can', 'pid', 'epoch', 'data'}.
+        Raises ValueError on a corrupt, truncated or unknown frame; delta
+        frames need a TelemetryDecoder.
+    """
+    end = _check_crc(frame)
+    if frame[1] == FRAME_DELTA:
+        raise ValueError("Delta frames need a TelemetryDecoder")
+    return _result(*_unpack_keyframe(frame, end))
+
+
+class TelemetryEncoder:
+    """ Sends a keyframe every 'keyframe_interval' frames and delta frames
+        in between, with the fields in 'mask'. Call sent() once a frame
+        returned by encode() was handed to the radio; a keyframe only
+        becomes the reference for deltas once it was actually sent.
+    """
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL, mask=ALL_FIELDS, can=0):
+        self.keyframe_interval = keyframe_interval
+        self.mask = mask
+        self.can = can
+        self._key = None
+        self._pending = None
+        self._since_key = 0
+
+    def encode(self, pid, epoch, data):
+        presence, fields = _fixed_fields(data, self.mask)
+        key = self._key
+        if key is None or self._since_key >= self.keyframe_interval or not 0 < pid - key[0] < 256:
+            self._pending = (pid, int(epoch), dict(fields))
+            return _pack_keyframe(pid, epoch, presence, fields, FRAME_TLM, self.can)
+        self._pending = None
+        return _pack_delta(pid, epoch, presence, fields, key, self.can)
+
+    def sent(self):
+        if self._pending is not None:
+            self._key = self._pending
+            self._pending = None
+            self._since_key = 0
+        else:
+            self._since_key += 1
+
+    def force_keyframe(self):
+        """ Make the next frame a keyframe, e.g. after the link was lost. """
+        self._key = None
+
+
+class TelemetryDecoder:
+    """ Decodes keyframes and delta frames of one can, keeping its last few keyframes. """
+
+    def __init__(self, keep=KEYFRAMES_KEPT):
+        self.keep = keep
+        self._keys = {}
+        self._order = []
+        self.missing_keyframe = 0
+
+    def decode(self, frame):
+        """ Return {'version', 'type', 'can', 'pid', 'epoch', 'data'} for any frame.
+            Raises ValueError on corrupt frames and on deltas whose
+            keyframe was not received.
+        """
+        end = _check_crc(frame)
+        if frame[1] != FRAME_DELTA:
+            frame_type, can, pid, epoch, fields = _unpack_keyframe(frame, end)
+            if frame_type != FRAME_BULK:
+                self._remember(pid, epoch, fields)
+            return _result(frame_type, can, pid, epoch, fields)
+
+        _, _, can, pid, ref, presence = struct.unpack_from(DELTA_HEADER_FORMAT, frame, 0)
+        key_pid = (pid - ref) & 0xFFFF
+        key = self._keys.get(key_pid)
+        if key is None:
+            self.missing_keyframe += 1
+            raise ValueError("Delta frame {} refers to keyframe {} which was not received".format(pid, key_pid))
+        key_epoch, key_fields = key
+
+        offset = DELTA_HEADER_SIZE
+        delta, offset = _get_varint(frame, offset, end)
+        epoch = key_epoch + _unzigzag(delta)
+        fields = []
+        for bit in range(len(TLM_FIELDS)):
+            if not presence & (1 << bit):
+                continue
+            base = key_fields.get(bit)
+            values = []
+            for i in range(len(TLM_FIELDS[bit][3])):
+                delta, offset = _get_varint(frame, offset, end)
+                values.append(_unzigzag(delta) + (base[i] if base else 0))
+            fields.append((bit, values))
+        if offset != end:
+            raise ValueError("Delta frame longer than its presence bitmap")
+        return _result(FRAME_DELTA, can, pid, epoch, fields)
+
+    def _remember(self, pid, epoch, fields):
+        if pid not in self._keys:
+            self._order.append(pid)
+            if len(self._order) > self.keep:
+                del self._keys[self._order.pop(0)]
+        self._keys[pid] = (epoch, dict(fields))
+
+
+def _fused_altitude(data):
+    """ First available altitude, in TLM_FIELDS order. """
+    for group, sensor, keys, codes, scales in TLM_FIELDS:
+        if group == 'alt':
+            value = _lookup(data, group, sensor, keys)
+            if value is not None:
+                return value[0]
+    return None
+
+
+class BatchEncoder:
+    """ Packs reduced samples (time, altitude, vertical speed, position)
+        into one frame of up to MAX_FRAME bytes. Each packet pays the LoRa
+        preamble and header once, so fewer, fuller packets carry more
+        samples for the same airtime.
+    """
+
+    def __init__(self, max_samples=BATCH_MAX_SAMPLES, can=0):
+        self.max_samples = min(max_samples, BATCH_MAX_SAMPLES)
+        self.can = can
+        self._frame = bytearray(BATCH_HEADER_SIZE + BATCH_SAMPLE_SIZE * BATCH_MAX_SAMPLES + CRC_SIZE)
+        self.count = 0
+        self._first = None      # (pid, epoch, ticks) of the first sample
+        self._last_alt = None   # (ticks, altitude) for the vertical speed
+
+    def add(self, pid, epoch, ticks, data):
+        """ Add one sample ('ticks' from time.ticks_ms). Returns True once the batch is full. """
+        if not self.fits(pid):
+            raise ValueError("Batch is full, flush() it first")
+        if not self.count:
+            self._first = (pid, int(epoch), ticks)
+        first_pid, _, first_ticks = self._first
+
+        alt = _fused_altitude(data)
+        vz = None
+        if alt is not None:
+            if self._last_alt is not None:
+                dt = time.ticks_diff(ticks, self._last_alt[0])
+                if dt > 0:
+                    vz = (alt - self._last_alt[1]) * 1000 / dt
+            self._last_alt = (ticks, alt)
+        gps = _lookup(data, 'gps', None, ('lat', 'lon'))
+
+        struct.pack_into(BATCH_SAMPLE_FORMAT, self._frame, BATCH_HEADER_SIZE + self.count * BATCH_SAMPLE_SIZE,
+                         (pid - first_pid) & 0xFFFF,
+                         _to_fixed(time.ticks_diff(ticks, first_ticks) / 1000, 'H', 100),
+                         -0x8000 if alt is None else _to_fixed(alt, 'h', 10),
+                         -0x8000 if vz is None else _to_fixed(vz, 'h', 10),
+                         -0x80000000 if gps is None else _to_fixed(gps[0], 'i', 10000000),
+                         -0x80000000 if gps is None else _to_fixed(gps[1], 'i', 10000000))
+        self.count += 1
+        return self.full
+
+    @property
+    def full(self):
+        return self.count >= self.max_samples
+
+    def age_ms(self, now):
+        """ Time since the first sample of the batch, 0 when empty. """
+        return time.ticks_diff(now, self._first[2]) if self.count else 0
+
+    def fits(self, pid):
+        """ Whether a sample with this pid can still go in the batch. """
+        return not self.count or (self.count < self.max_samples and (pid - self._first[0]) & 0xFFFF < 256)
+
+    def flush(self):
+        """ Return the batch frame (None when empty) and start a new batch. """
+        if not self.count:
+            return None
+        pid, epoch, _ = self._first
+        struct.pack_into(BATCH_HEADER_FORMAT, self._frame, 0, FRAME_VERSION, FRAME_BATCH, self.can, pid & 0xFFFF, SCHEMA_HASH,
+                         epoch & 0xFFFFFFFF, self.count)
+        size = BATCH_HEADER_SIZE + self.count * BATCH_SAMPLE_SIZE
+        _append_crc(self._frame, size)
+        self.count = 0
+        return bytes(self._frame[:size + CRC_SIZE])
+
+
+def decode_batch(frame):
+    """ Return one {'version', 'type', 'can', 'pid', 'epoch', 'data'} per sample of
+        a batch frame. Raises ValueError on a corrupt or foreign frame.
+    """
+    end = _check_crc(frame)
+    if frame[1] != FRAME_BATCH or end < BATCH_HEADER_SIZE:
+        raise ValueError("Not a batch frame")
+    _, _, can, pid, schema, epoch, count = struct.unpack_from(BATCH_HEADER_FORMAT, frame, 0)
+    if schema != SCHEMA_HASH:
+        raise ValueError("Batch {} uses schema {:04x}, expected {:04x}".format(pid, schema, SCHEMA_HASH))
+    if BATCH_HEADER_SIZE + count * BATCH_SAMPLE_SIZE != end:
+        raise ValueError("Batch length does not match its sample count")
+    samples = []
+    for i in range(count):
+        offset, dt, alt, vz, lat, lon = struct.unpack_from(BATCH_SAMPLE_FORMAT, frame, BATCH_HEADER_SIZE + i * BATCH_SAMPLE_SIZE)
+        data = {}
+        if alt != -0x8000:
+            data['alt'] = {'fused': alt / 10}
+        if vz != -0x8000:
+            data['vz'] = vz / 10
+        if lat != -0x80000000:
+            data['gps'] = {'lat': lat / 10000000, 'lon': lon / 10000000}
+        samples.append({
+            'version': FRAME_VERSION,
+            'type': FRAME_TYPE_NAMES[FRAME_BATCH],
+            'can': can,
+            'pid': (pid + offset) & 0xFFFF,
+            'epoch': epoch + dt / 100,
+            'data': data
+        })
+    return samples
@@ -12,60 +12,45 @@ from network import WLAN
 from logger import Logger
 from converters import timeConverter, localtime_to_epoch
 from utils import generate_random_filename
+from telemetry import TelemetryDecoder, decode_batch, frame_can, frame_pid, FRAME_VERSION, FRAME_BULK, FRAME_BATCH, PID_OFFSET
+from schema import KEY_MAP_REVERSE as REVERSED_KEY_MAP
+from fec import FecDecoder, FRAME_PARITY
+from telecommand import (encode_command, decode_ack, decode_listen, FRAME_ACK, FRAME_LISTEN, COMMAND_NAMES, STATUS_NAMES, STATUS_OK,
+                         CMD_SET_SF, RX_DELAY_MS, CAN_BROADCAST)
+from linkquality import LinkMonitor, choose_sf
 
 
 # Constants
 LoRa_freq = 868000000  # frequency in Hz
 SDDir = 'BaseSD'
 switch = True
-
-# The provided KEY_MAP
-KEY_MAP = {
-    "pid": "pid",
-    "type": "type",
-    "epochtime": "etm",
-    "valid": "vld",
-    "esp32": "e32",
-    "wifi_signal_strength": "wss",
-    "free_memory": "fm",
-    "altitude": "alt",
-    "temperature": "tmp",
-    "bmp280": "b28",
-    "lps25h": "l25",
-    "lis3mdl": "l3m",
-    "pressure": "prs",
-    "acceleration": "acc",
-    "gyroscope": "gyr",
-    "gps_coordinates": "gps",
-    "air_quality": "aq",
-    "ccs811": "c81",
-    "eCO2": "eco",
-    "tVOC": "tvoc",
-    "telemetry": "tlm",
-    "mpu9250": "mpu",
-    "accel_x": "a_x",
-    "accel_y": "a_y",
-    "accel_z": "a_z",
-    "gyro_x": "g_x",
-    "gyro_y": "g_y",
-    "gyro_z": "g_z",
-    "mag_x": "m_x",
-    "mag_y": "m_y",
-    "mag_z": "m_z",
-    "longitude": "lon",
-    "latitude": "lat",
-    "speed": "spd",
-    "timestamp": "tmsp",
-    "magnetic_variation": "mv",
-    "course": "crs",
-    "null": "na",
-    "pres": "pre",
-    "temp": "tme"
-}
+# Shared secret of the telecommand uplink, must match TELECOMMAND_KEY on the can
+TELECOMMAND_KEY = b"CDOSR-CanSat2024-uplink"
+# Drop lines like "sf 9", "period 2000", "power 10", "mode 2" or
+# "retransmit 120 140" in this file to command the cans; "@3 mode 2" commands
+# can 3 only
+TELECOMMAND_FILE = 'telecommands.txt'
+TELECOMMAND_SEQ_FILE = 'telecommand_seq.txt'
+# Silence after an SF change means the acknowledgement was lost, follow the can
+LINK_LOST_S = 30
+# A command the can never acknowledges is dropped after this many sends or
+# this long in the queue, so it cannot hold back the ones behind it. One send
+# per receive window, which the cans open every 10 frames, up to 100 s apart
+TELECOMMAND_MAX_SENDS = 8
+TELECOMMAND_EXPIRE_S = 900
+# Lost pids are asked for again once they are this far behind the newest one,
+# parity frames may still rebuild them before that
+RETRANSMIT_AFTER = 8
+RETRANSMIT_RANGE = 32   # Longest range per request, the can accepts up to RETRANSMIT_MAX
+MISSING_KEPT = 256      # Lost pids remembered at most
 
 packets = {}
 packet_count = {}
 last_pid = None 
+# Commands waiting for their acknowledgement, oldest first: [seq, opcode, args, times sent, can, queued at]
+telecommands = []
+# State of every can heard on the frequency, by can ID (see can_state())
+cans = {}
 
 pycom.heartbeat(False)  # Disable the heartbeat LED
 pycom.rgbled(0xFFFF00)
@@ -78,9 +63,6 @@ try:
     # set LED to red
     pycom.rgbled(0x110000)
 
-    # Reverse the KEY_MAP dictionary
-    REVERSED_KEY_MAP = {v: k for k, v in KEY_MAP.items()}
-
     # Mount SD Card
     try:
         sd = SD()
@@ -183,8 +165,15 @@ def append_to_json(filelog, packet):
         # If the file does not exist, initialize an empty dictionary
         file_data = {}
 
-    # Update the file data with new packet data
-    file_data.update({str(packet['pid']): packet})
+    # Update the file data with new packet data; the bulk frame of a pid
+    # adds its fields to the critical ones. Binary frames name their can,
+    # cans sharing the frequency count pids independently
+    key = str(packet['pid']) if 'can' not in packet else "{}:{}".format(packet['can'], packet['pid'])
+    existing = file_data.get(key)
+    if existing is not None and 'data' in packet:
+        merge_dicts(packet['data'], existing.setdefault('data', {}))
+    else:
+        file_data.update({key: packet})
 
     # Write the updated data back to the file
     try:
@@ -198,6 +187,232 @@ def append_to_json(filelog, packet):
         time.sleep(0.05)
         pycom.rgbled(0x000000) 
 
+def can_state(can):
+    """Decoders and link figures of one can; cans sharing the frequency (TDMA)
+    number their frames independently."""
+    state = cans.get(can)
+    if state is None:
+        state = {
+            # Keeps the recent keyframes that delta frames refer to
+            'decoder': TelemetryDecoder(),
+            # Keeps recent frames so parity frames can rebuild the lost ones
+            'fec': FecDecoder(),
+            # RSSI, SNR and packet error rate of the last frames, drives the SF of the can
+            'link': LinkMonitor(),
+            # Gaps in the received pids, oldest first, and the newest pid received
+            'missing': [],
+            'newest': None
+        }
+        cans[can] = state
+        print("New can on the frequency: {}".format(can))
+    return state
+
+def reset_links():
+    """After an SF change the old link figures no longer apply, to any can."""
+    for state in cans.values():
+        state['link'].reset()
+
+def next_telecommand_seq():
+    """Command sequence numbers must keep increasing across restarts, the can rejects replays."""
+    try:
+        with open(TELECOMMAND_SEQ_FILE, 'r') as f:
+            seq = int(f.read()) + 1
+    except (OSError, ValueError):
+        seq = 1
+    with open(TELECOMMAND_SEQ_FILE, 'w') as f:
+        f.write(str(seq))
+    return seq & 0xFFFF
+
+def queue_telecommand(name, *args, can=CAN_BROADCAST):
+    """Queue a command for one can or all of them, e.g. queue_telecommand('sf', 9)."""
+    opcodes = {v: k for k, v in COMMAND_NAMES.items()}
+    if name not in opcodes:
+        print("Unknown telecommand:", name)
+        return
+    telecommands.append([next_telecommand_seq(), opcodes[name], args, 0, can, utime.time()])
+    print("Telecommand {} {} queued for {}".format(name, args, "all cans" if can == CAN_BROADCAST else "can {}".format(can)))
+
+def pending_telecommand(can):
+    """Oldest command the can is meant to receive, None when there is none."""
+    for command in telecommands:
+        if command[4] in (can, CAN_BROADCAST):
+            return command
+    return None
+
+def expire_telecommands():
+    """Drop the commands sent TELECOMMAND_MAX_SENDS times or queued for
+    TELECOMMAND_EXPIRE_S without an acknowledgement."""
+    now = utime.time()
+    for command in telecommands[:]:
+        seq, opcode, args, sent, can, queued = command
+        if sent >= TELECOMMAND_MAX_SENDS or now - queued >= TELECOMMAND_EXPIRE_S:
+            telecommands.remove(command)
+            print("Telecommand {} {} {} for {} expired after {} sends, not acknowledged".format(
+                seq, COMMAND_NAMES.get(opcode, opcode), args, "all cans" if can == CAN_BROADCAST else "can {}".format(can), sent))
+
+def read_telecommand_file():
+    """Queue the commands an operator left in TELECOMMAND_FILE."""
+    try:
+        with open(TELECOMMAND_FILE, 'r') as f:
+            lines = f.read().split('\n')
+        os.remove(TELECOMMAND_FILE)
+    except OSError:
+        return
+    for line in lines:
+        parts = line.split()
+        can = CAN_BROADCAST
+        try:
+            if parts and parts[0].startswith('@'):
+                can = int(parts.pop(0)[1:])
+            if parts:
+                queue_telecommand(parts[0], *[int(v) for v in parts[1:]], can=can)
+        except ValueError:
+            print("Invalid telecommand line:", line)
+
+def listen_window(packet_data):
+    """True for an intact frame announcing that the can's receive window opens now."""
+    try:
+        decode_listen(packet_data)
+    except ValueError as e:
+        print("Dropped listen frame:", str(e))
+        return False
+    return True
+
+def send_telecommand(can):
+    """Send the oldest command for the can into the receive window it just announced."""
+    command = pending_telecommand(can)
+    if command is None:
+        return
+    seq, opcode, args, _, target, _ = command
+    command[3] += 1
+    utime.sleep_ms(RX_DELAY_MS)
+    s.setblocking(True)
+    s.send(encode_command(TELECOMMAND_KEY, seq, opcode, *args, can=target))
+
+def process_ack(packet_data):
+    """Match an acknowledgement from the can with the pending command."""
+    try:
+        ack = decode_ack(packet_data)
+    except ValueError as e:
+        print("Dropped acknowledgement:", str(e))
+        return
+    print("Telecommand {} {} on can {}: {}".format(ack['seq'], COMMAND_NAMES.get(ack['opcode'], ack['opcode']), ack['can'],
+                                                   STATUS_NAMES[ack['status']] if ack['status'] < len(STATUS_NAMES) else ack['status']))
+    command = pending_telecommand(ack['can'])
+    if command is not None and command[0] == ack['seq']:
+        # A broadcast is done with the first acknowledgement, address cans one by one to be sure
+        telecommands.remove(command)
+        seq, opcode, args, _, _, _ = command
+        if opcode == CMD_SET_SF and ack['status'] == STATUS_OK:
+            # The can switches right after this acknowledgement
+            lora.sf(args[0])
+            reset_links()
+
+def sent_sf_command():
+    """The SF change already sent to a can and not acknowledged yet, or None."""
+    for command in telecommands:
+        if command[1] == CMD_SET_SF and command[3]:
+            return command
+    return None
+
+def telecommand_link_lost():
+    """No frames since an SF change was sent: the can switched, but its acknowledgement was lost."""
+    command = sent_sf_command()
+    if command is not None:
+        telecommands.remove(command)
+        seq, opcode, args, _, _, _ = command
+        lora.sf(args[0])
+        reset_links()
+        print("Link lost after telecommand {}, following the can to SF{}".format(seq, args[0]))
+
+def adapt_sf(can):
+    """Step the SF of the can towards the fastest one the link carries, once a
+    full window was measured at the current SF and no command is pending.
+    Cans sharing the frequency also share the receiver's SF, so the SF only
+    adapts while a single can is heard."""
+    link_monitor = cans[can]['link']
+    if telecommands or len(cans) > 1 or not link_monitor.full:
+        return
+    sf = lora.sf()
+    stats = link_monitor.stats()
+    new_sf = choose_sf(sf, stats['per'], stats['snr'])
+    if new_sf != sf:
+        print("Link RSSI {:.0f} dBm, SNR {:.1f} dB, PER {:.0f} %: SF{} -> SF{}".format(stats['rssi'], stats['snr'], stats['per'] * 100, sf, new_sf))
+        queue_telecommand('sf', new_sf, can=can)
+
+def track_pids(samples):
+    """Note the pids skipped over by the received samples, forget the ones that arrived late."""
+    for sample in samples:
+        state = can_state(sample['can'])
+        missing_pids = state['missing']
+        pid = sample['pid'] & 0xFFFF
+        state['link'].add_pid(pid)
+        if state['newest'] is None:
+            state['newest'] = pid
+            continue
+        gap = (pid - state['newest']) & 0xFFFF
+        if 0 < gap < 0x8000:
+            for i in range(1, min(gap, MISSING_KEPT)):
+                missing_pids.append((state['newest'] + i) & 0xFFFF)
+            del missing_pids[:-MISSING_KEPT]
+            state['newest'] = pid
+        elif pid in missing_pids:
+            missing_pids.remove(pid)
+
+def request_missing(can):
+    """Ask the can for the oldest run of its lost pids, once nothing else is pending for it."""
+    state = cans[can]
+    missing_pids = state['missing']
+    if pending_telecommand(can) is not None or not missing_pids:
+        return
+    first = missing_pids[0]
+    if (state['newest'] - first) & 0xFFFF < RETRANSMIT_AFTER:
+        return
+    last = first
+    while ((last + 1) & 0xFFFF) in missing_pids and (last - first) & 0xFFFF < RETRANSMIT_RANGE - 1:
+        last = (last + 1) & 0xFFFF
+    # Asked once, frames still lost after the retransmission stay lost
+    for i in range(((last - first) & 0xFFFF) + 1):
+        missing_pids.remove((first + i) & 0xFFFF)
+    queue_telecommand('retransmit', first, last, can=can)
+
+def process_frame(packet_data):
+    """Decode a binary frame. Telemetry frames (keyframe or delta) carry a whole
+    sample, batch frames several reduced ones, parity frames may rebuild lost
+    ones; returns the list of samples. Every frame names the can that sent it,
+    each can has its own decoders."""
+    if packet_data[1] == FRAME_ACK:
+        process_ack(packet_data)
+        return []
+    if packet_data[1] == FRAME_LISTEN:
+        # No samples, the receive loop answers it
+        return []
+    state = can_state(frame_can(packet_data))
+    if packet_data[1] == FRAME_PARITY:
+        try:
+            frames = state['fec'].add_parity(packet_data)
+        except ValueError as e:
+            print("Dropped parity frame:", str(e))
+            return []
+        if frames:
+            print("Rebuilt {} lost frame(s), {} so far".format(len(frames), state['fec'].recovered))
+    else:
+        if packet_data[1] != FRAME_BULK:
+            # Parity covers keyframes, deltas and batches, all carry the (first) pid
+            state['fec'].add_data(frame_pid(packet_data), packet_data)
+        frames = [packet_data]
+
+    samples = []
+    for frame in frames:
+        try:
+            if frame[1] == FRAME_BATCH:
+                samples.extend(decode_batch(frame))
+            else:
+                samples.append(state['decoder'].decode(frame))
+        except ValueError as e:
+            print("Dropped telemetry frame:", str(e))
+    return samples
+
 def process_packet(packet_data):
     global packets, packet_count, last_pid  # Ensure that packets is accessible and can maintain state across function calls
     try:
@@ -277,13 +492,36 @@ def is_complete(data):
 def receive_packets(filename):
     while True:
         try:
-            s.setblocking(True)
+            if sent_sf_command() is not None:
+                s.settimeout(LINK_LOST_S)
+            else:
+                s.setblocking(True)
             packet = s.recv(1024)  # Adjust based on expected maximum packet size
             if packet:
                 pycom.rgbled(0xFFFF00) 
                 #print(process_packet(packet_data=packet))
-                complete_packet=process_packet(packet)
-                if complete_packet is not None:
+                # Binary frames start with their version byte, JSON packets with a quote or brace
+                # Every binary frame has at least version, type, can and a pid
+                if packet[0] == FRAME_VERSION and len(packet) > PID_OFFSET + 1:
+                    complete_packets = process_frame(packet)
+                    can = frame_can(packet)
+                    # Signal of this packet, kept with its samples
+                    stats = lora.stats()
+                    can_state(can)['link'].add_packet(stats.rssi, stats.snr)
+                    for sample in complete_packets:
+                        sample['link'] = {'rssi': stats.rssi, 'snr': stats.snr}
+                    track_pids(complete_packets)
+                    read_telecommand_file()
+                    expire_telecommands()
+                    adapt_sf(can)
+                    request_missing(can)
+                    # Only the can's announced window hears us, anything else is wasted airtime
+                    if packet[1] == FRAME_LISTEN and listen_window(packet):
+                        send_telecommand(can)
+                else:
+                    complete_packet = process_packet(packet)
+                    complete_packets = [complete_packet] if complete_packet is not None else []
+                for complete_packet in complete_packets:
                     renamed_packet = {REVERSED_KEY_MAP.get(key, key): value for key, value in complete_packet.items()}
                     # print(ujson.dumps(renamed_packet))
                     append_to_json(filename, renamed_packet)
@@ -294,6 +532,7 @@ def receive_packets(filename):
                 print("No packet received")
         except socket.timeout:
             print("Socket timeout, no packet received")
+            telecommand_link_lost()
             pycom.rgbled(0xFF0000)
         except Exception as e:
             print("Error receiving packet:", str(e))
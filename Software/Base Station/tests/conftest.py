@@ -0,0 +1,9 @@
+"""
+Host tests of the base station modules, run with 'python -m pytest' from
+this folder. They import the copies in lib/, which run unchanged on the
+host; pymakr.conf keeps this folder off the board.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
@@ -0,0 +1,133 @@
+"""
+Cross-frame parity (fec.py) on real telemetry frames: exact repair of any
+k lost frames of a group, and delivery under random loss.
+"""
+import itertools
+import random
+import time
+
+import pytest
+
+from fec import FecEncoder, FecDecoder
+from telemetry import (TelemetryEncoder, BatchEncoder, frame_pid, MAX_FRAME, MAX_DATA_FRAME, BATCH_MAX_SAMPLES)
+
+
+def sample(i):
+    return {
+        'temp': {'bme688': 20 + i * 0.01},
+        'pres': {'bme688': 1013 - i * 0.1},
+        'acc': {'icm20948': {'accel_x': 0.01 * i, 'accel_y': 0.0, 'accel_z': 1.0}},
+        'gps': {'lat': 45.1 + i * 1e-5, 'lon': 26.0, 'gtm': 1000 + i},
+        'bat': {'volt': 3.9, 'soc': 88},
+    }
+
+
+def telemetry_frames(count):
+    """ Keyframes and deltas of different lengths, as the can sends them. """
+    encoder = TelemetryEncoder()
+    frames = []
+    for pid in range(count):
+        frames.append(encoder.encode(pid, 1700000000 + pid, sample(pid)))
+        encoder.sent()
+    return frames
+
+
+def simulate(n, k, loss, count=2000, seed=1):
+    """ Fraction of the frames that arrive or are rebuilt, each packet lost with probability 'loss'. """
+    rng = random.Random(seed)
+    encoder = FecEncoder(n, k)
+    decoder = FecDecoder()
+    delivered = set()
+    for pid, frame in enumerate(telemetry_frames(count)):
+        parity = encoder.add(pid, frame)
+        if rng.random() >= loss:
+            assert decoder.add_data(pid, frame)
+            delivered.add(pid)
+        for packet in parity:
+            if rng.random() >= loss:
+                delivered.update(frame_pid(rebuilt) for rebuilt in decoder.add_parity(packet))
+    return len(delivered) / count
+
+
+@pytest.mark.parametrize('n, k', [(2, 1), (3, 2), (4, 1), (4, 2), (4, 3)])
+def test_any_k_losses_are_rebuilt(n, k):
+    frames = telemetry_frames(n)
+    encoder = FecEncoder(n, k)
+    parity = [packet for pid, frame in enumerate(frames) for packet in encoder.add(pid, frame)]
+    assert len(parity) == k
+    for lost in itertools.combinations(range(n), k):
+        decoder = FecDecoder()
+        for pid, frame in enumerate(frames):
+            if pid not in lost:
+                decoder.add_data(pid, frame)
+        rebuilt = []
+        for packet in parity:
+            rebuilt += decoder.add_parity(packet)
+        assert sorted(rebuilt, key=frame_pid) == [frames[pid] for pid in lost]
+
+
+def test_more_losses_than_parity():
+    frames = telemetry_frames(4)
+    encoder = FecEncoder(4, 1)
+    parity = [packet for pid, frame in enumerate(frames) for packet in encoder.add(pid, frame)]
+    decoder = FecDecoder()
+    decoder.add_data(0, frames[0])
+    decoder.add_data(1, frames[1])
+    assert decoder.add_parity(parity[0]) == []
+    assert decoder.recovered == 0
+
+
+def test_corrupt_parity_is_rejected():
+    frames = telemetry_frames(4)
+    encoder = FecEncoder(4, 1)
+    packet = bytearray([packet for pid, frame in enumerate(frames) for packet in encoder.add(pid, frame)][0])
+    packet[10] ^= 0x01
+    with pytest.raises(ValueError):
+        FecDecoder().add_parity(packet)
+
+
+def test_skipped_pids_stay_in_one_group():
+    """ Only sent frames join a group, the pid offsets cover the gaps. """
+    frames = telemetry_frames(12)
+    sent = [0, 3, 4, 9]
+    encoder = FecEncoder(4, 1)
+    parity = [packet for pid in sent for packet in encoder.add(pid, frames[pid])]
+    decoder = FecDecoder()
+    for pid in (0, 4, 9):
+        decoder.add_data(pid, frames[pid])
+    assert decoder.add_parity(parity[0]) == [frames[3]]
+
+
+@pytest.mark.parametrize('n, k, loss, minimum', [
+    (3, 1, 0.05, 0.985), (3, 1, 0.10, 0.955), (3, 1, 0.20, 0.88),
+    (4, 1, 0.05, 0.98), (4, 1, 0.10, 0.95), (4, 1, 0.20, 0.87),
+    (4, 2, 0.05, 0.995), (4, 2, 0.10, 0.98), (4, 2, 0.20, 0.93),
+])
+def test_delivery_under_random_loss(n, k, loss, minimum):
+    delivered = simulate(n, k, loss)
+    assert delivered >= minimum
+    assert delivered > 1 - loss
+
+
+def test_no_loss_needs_no_repair():
+    assert simulate(4, 1, 0.0, count=200) == 1.0
+
+
+def test_group_too_large_for_the_overhead():
+    # The offsets of a larger group would push the parity of a full frame past MAX_FRAME
+    with pytest.raises(ValueError):
+        FecEncoder(5, 1)
+
+
+def test_parity_of_a_full_batch_fits_a_packet(monkeypatch):
+    monkeypatch.setattr(time, 'ticks_diff', lambda new, old: new - old, raising=False)
+    batch = BatchEncoder()
+    for pid in range(BATCH_MAX_SAMPLES):
+        batch.add(pid, 1700000000, pid * 1000, sample(pid))
+    frame = batch.flush()
+    assert len(frame) <= MAX_DATA_FRAME
+    encoder = FecEncoder()
+    parity = []
+    for pid in range(encoder.n):
+        parity += encoder.add(pid * BATCH_MAX_SAMPLES, frame)
+    assert parity and all(len(packet) <= MAX_FRAME for packet in parity)
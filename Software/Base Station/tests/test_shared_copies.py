@@ -0,0 +1,31 @@
+"""
+The modules shared with the can must stay identical to their source in
+Main Can/communications; run 'python sync_shared.py' in Software after
+editing one.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import sync_shared  # noqa: E402
+
+
+@pytest.mark.parametrize('source, copy', [(source, copy) for source, copy, _ in sync_shared.copies()],
+                         ids=lambda path: os.path.relpath(path, sync_shared.ROOT))
+def test_copy_matches_the_can(source, copy):
+    assert sync_shared.read_text(copy) is not None, f"{copy} is missing"
+    assert sync_shared.read_text(copy) == sync_shared.read_text(source), \
+        f"{os.path.relpath(copy, sync_shared.ROOT)} differs, run 'python sync_shared.py'"
+
+
+def test_every_copy_is_listed():
+    """ A module copied by hand, outside sync_shared, would drift unchecked. """
+    source_dir = os.path.join(sync_shared.ROOT, sync_shared.SOURCE)
+    for name in os.listdir(source_dir):
+        if not name.endswith('.py'):
+            continue
+        for target in sync_shared.TARGETS:
+            if os.path.exists(os.path.join(sync_shared.ROOT, target, name)):
+                assert target in sync_shared.SHARED.get(name, ()), f"{target}/{name} is not in sync_shared.SHARED"
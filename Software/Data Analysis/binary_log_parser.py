@@ -0,0 +1,211 @@
+"""
+This module reads the binary DataLogger files of the CanSat (logformat.py)
+into NumPy arrays, one per field, and saves them as .npz or CSV.
+
+Sample records all have the same size, so the records of a file are
+located, checked and decoded with array operations instead of a Python
+loop per record; only a damaged or foreign record costs a loop step.
+A file cut short by a reset reads up to its last whole record.
+"""
+import configparser
+import os
+
+import numpy as np
+
+from logformat import (read_file_header, read_record, read_seal, FILE_HEADER_SIZE, SAMPLE_RECORD_SIZE,
+                       SEAL_RECORD_SIZE, LENGTH_SIZE, CRC_SIZE, REC_SAMPLE, SEAL_CLOSED)
+from schema import LOG_FIELDS
+
+# Columns every sample has besides the LOG_FIELDS values
+SAMPLE_COLUMNS = ('ticks', 'pid', 'epoch')
+
+
+def _crc16_table() -> np.ndarray:
+    table = np.zeros(256, dtype=np.uint16)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) & 0xffff if crc & 0x8000 else (crc << 1) & 0xffff
+        table[i] = crc
+    return table
+
+_CRC16_TABLE = _crc16_table()
+
+
+def column_names() -> list:
+    """
+    Names of the LOG_FIELDS values, e.g. 'temp.bme688' or 'acc.icm20948.accel_x'.
+    """
+    names = []
+    for group, sensor, keys, _ in LOG_FIELDS:
+        prefix = group if sensor is None else f"{group}.{sensor}"
+        names.extend([prefix] if keys is None else [f"{prefix}.{key}" for key in keys])
+    return names
+
+
+def sample_dtype() -> np.dtype:
+    """
+    NumPy layout of a sample record, big endian like the can writes it.
+    """
+    codes = {'f': '>f4', 'd': '>f8'}
+    fields = [('length', '>u2'), ('type', 'u1'), ('ticks', '>u4'), ('pid', '>u4'), ('epoch', '>u4')]
+    names = iter(column_names())
+    for _, _, _, field_codes in LOG_FIELDS:
+        fields.extend((next(names), codes[code]) for code in field_codes)
+    fields.append(('crc', '>u2'))
+    dtype = np.dtype(fields)
+    if dtype.itemsize != SAMPLE_RECORD_SIZE:
+        raise ValueError("Sample layout does not match logformat.py")
+    return dtype
+
+
+def crc16_rows(rows: np.ndarray) -> np.ndarray:
+    """
+    CRC-16/CCITT of every row of a 2-D uint8 array, all rows at once.
+    """
+    crc = np.full(rows.shape[0], 0xFFFF, dtype=np.uint16)
+    columns = np.ascontiguousarray(rows.T)
+    for column in columns:
+        crc = (crc << 8) ^ _CRC16_TABLE[(crc >> 8) ^ column]
+    return crc
+
+
+def _next_sample(buf: np.ndarray, start: int) -> int:
+    """
+    Offset of the next byte sequence that looks like a sample record header, -1 if none.
+    """
+    length = SAMPLE_RECORD_SIZE - LENGTH_SIZE
+    window = buf[start:]
+    if len(window) < SAMPLE_RECORD_SIZE:
+        return -1
+    hits = np.flatnonzero((window[:-2] == length >> 8) & (window[1:-1] == length & 0xFF) & (window[2:] == REC_SAMPLE))
+    return start + int(hits[0]) if hits.size else -1
+
+
+def _sample_offsets(data: bytes, buf: np.ndarray, start: int, stats: dict) -> np.ndarray:
+    """
+    Offsets of the sample records. Runs of back-to-back samples are found in
+    one step each; other records are stepped over, damage is skipped up to
+    the next sample header.
+    """
+    size = SAMPLE_RECORD_SIZE
+    length = size - LENGTH_SIZE
+    runs = []
+    pos = start
+    while pos + size <= len(buf):
+        starts = pos + size * np.arange((len(buf) - pos) // size)
+        ok = (buf[starts] == length >> 8) & (buf[starts + 1] == length & 0xFF) & (buf[starts + 2] == REC_SAMPLE)
+        bad = np.flatnonzero(~ok)
+        run = len(starts) if not bad.size else int(bad[0])
+        runs.append(starts[:run])
+        pos += run * size
+        if run == len(starts):
+            break
+        try:
+            # A record of another type, its length tells where the next one starts
+            pos = read_record(data, pos)[3]
+            stats['other'] += 1
+        except ValueError:
+            resume = _next_sample(buf, pos + 1)
+            stats['skipped_bytes'] += (resume if resume >= 0 else len(buf)) - pos
+            if resume < 0:
+                pos = len(buf)
+                break
+            pos = resume
+    stats['torn_bytes'] += len(buf) - pos if pos < len(buf) else 0
+    return np.concatenate(runs) if runs else np.zeros(0, dtype=np.int64)
+
+
+def read_log(path: str) -> tuple:
+    """
+    Reads a binary log file.
+
+    Parameters:
+        path (str): The log file written by the DataLogger.
+
+    Returns:
+        tuple: (header, columns, stats): the file header, {column: array}
+        for SAMPLE_COLUMNS and column_names(), and counts of the damaged
+        parts that were skipped. stats['sealed'] is 'closed' or
+        'recovered' after the seal record, None for a segment that is
+        still open or was never recovered.
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    header = read_file_header(data)
+    stats = {'samples': 0, 'corrupt': 0, 'other': 0, 'skipped_bytes': 0, 'torn_bytes': 0, 'sealed': None}
+
+    # The seal is the last record, the records before it are read as usual
+    seal = read_seal(data, len(data) - SEAL_RECORD_SIZE) if len(data) >= FILE_HEADER_SIZE + SEAL_RECORD_SIZE else None
+    if seal is not None:
+        stats['sealed'] = 'closed' if seal[2] == SEAL_CLOSED else 'recovered'
+        torn = len(data) - SEAL_RECORD_SIZE - seal[0]
+        if seal[2] != SEAL_CLOSED and torn >= 0:
+            # After a reset, what follows the last good record may be stale flash
+            # that still holds valid records of a deleted file; the seal cuts it off
+            stats['torn_bytes'] = torn
+            data = data[:seal[0]]
+        else:
+            data = data[:-SEAL_RECORD_SIZE]
+    buf = np.frombuffer(data, dtype=np.uint8)
+
+    offsets = _sample_offsets(data, buf, FILE_HEADER_SIZE, stats)
+    rows = buf[offsets[:, None] + np.arange(SAMPLE_RECORD_SIZE)]
+    stored = (rows[:, -2].astype(np.uint16) << 8) | rows[:, -1]
+    valid = crc16_rows(rows[:, :-CRC_SIZE]) == stored
+    stats['corrupt'] = int(np.count_nonzero(~valid))
+    records = np.ascontiguousarray(rows[valid]).view(sample_dtype()).ravel()
+    stats['samples'] = len(records)
+
+    # Native byte order, the arrays go straight into pandas or matplotlib
+    columns = {name: records[name].astype(records.dtype[name].newbyteorder('='))
+               for name in SAMPLE_COLUMNS + tuple(column_names())}
+    return header, columns, stats
+
+
+def read_configuration(file_path: str = 'config.ini') -> dict:
+    """
+    Reads the binary log settings from a configuration file.
+
+    Parameters:
+        file_path (str): The path to the configuration file. Defaults to 'config.ini'.
+
+    Returns:
+        dict: Configuration parameters.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"{file_path} not found.")
+
+    config = configparser.ConfigParser()
+    with open(file_path, 'r', encoding='utf-8') as config_file:
+        config.read_file(config_file)
+
+    try:
+        return {
+            "input_file": config.get('BINARY_LOG', 'InputFile'),
+            "output_file": config.get('BINARY_LOG', 'OutputFile')
+        }
+
+    except (configparser.NoSectionError, configparser.NoOptionError) as noe:
+        raise ValueError(f"Configuration reading error: {str(noe)}")
+
+
+def save_columns(columns: dict, output_file: str):
+    """
+    Saves the columns as CSV when the name ends in .csv, as .npz otherwise.
+    """
+    if output_file.endswith('.csv'):
+        names = list(columns)
+        table = np.column_stack([columns[name].astype(float) for name in names])
+        np.savetxt(output_file, table, delimiter=',', header=','.join(names), comments='', fmt='%.10g')
+    else:
+        np.savez_compressed(output_file, **columns)
+
+
+if __name__ == "__main__":
+    config = read_configuration('config.ini')
+    header, columns, stats = read_log(config["input_file"])
+    print(f"Session {header['session']} segment {header['segment']}, sealed: {stats['sealed']}")
+    print(f"{stats['samples']} samples, {stats['corrupt']} corrupt records, {stats['other']} other records, "
+          f"{stats['skipped_bytes']} damaged bytes skipped, {stats['torn_bytes']} bytes of a torn last record")
+    save_columns(columns, config["output_file"])
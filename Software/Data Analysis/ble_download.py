@@ -0,0 +1,126 @@
+"""
+This module downloads the DataLogger files from the CanSat over BLE and
+saves them in the output directory, resuming partial downloads
+"""
+import asyncio
+import configparser
+import os
+import sys
+import time
+
+from logtransfer import LogTransferClient, CONTROL_UUID, DATA_UUID, DEVICE_NAME, WINDOW
+
+# No data for this long means notifications went missing, acknowledge what arrived
+ACK_TIMEOUT_S = 2.0
+SCAN_TIMEOUT_S = 10.0
+
+def read_configuration(file_path: str = 'config.ini') -> dict:
+    """
+    Reads the BLE download settings from a configuration file.
+
+    Parameters:
+        file_path (str): The path to the configuration file. Defaults to 'config.ini'.
+
+    Returns:
+        dict: Configuration parameters.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"{file_path} not found.")
+
+    config = configparser.ConfigParser()
+    with open(file_path, 'r', encoding='utf-8') as config_file:
+        config.read_file(config_file)
+
+    try:
+        return {
+            "address": config.get('BLE', 'Address', fallback='') or None,
+            "output_dir": config.get('BLE', 'OutputDir'),
+            "window": config.getint('BLE', 'Window', fallback=WINDOW)
+        }
+
+    except configparser.NoOptionError as noe:
+        raise ValueError(f"Configuration reading error: {str(noe)}")
+
+async def find_can(name: str = DEVICE_NAME) -> str:
+    """
+    Scans for the can and returns its address.
+    """
+    from bleak import BleakScanner
+
+    device = await BleakScanner.find_device_by_name(name, timeout=SCAN_TIMEOUT_S)
+    if device is None:
+        raise RuntimeError(f"{name} not found, is the can powered and in range?")
+    return device.address
+
+async def download(address: str, output_dir: str, names: list = None, window: int = WINDOW) -> list:
+    """
+    Downloads log files from the can.
+
+    Parameters:
+        address (str): BLE address of the can.
+        output_dir (str): Directory the files are saved in.
+        names (list): Files to download, all of them when empty.
+        window (int): Chunks the can sends per acknowledgement.
+
+    Returns:
+        list: The files that are complete in the output directory.
+    """
+    from bleak import BleakClient
+
+    os.makedirs(output_dir, exist_ok=True)
+    transfer = LogTransferClient(output_dir, window)
+    queue = asyncio.Queue()
+
+    async with BleakClient(address) as client:
+        print(f"Connected to {address}, MTU {client.mtu_size}")
+        await client.start_notify(CONTROL_UUID, lambda _, data: queue.put_nowait((CONTROL_UUID, bytes(data))))
+        await client.start_notify(DATA_UUID, lambda _, data: queue.put_nowait((DATA_UUID, bytes(data))))
+
+        async def exchange(request, finished):
+            """Send 'request' and answer the notifications until 'finished()'."""
+            if request is not None:
+                await client.write_gatt_char(CONTROL_UUID, request, response=True)
+            while not finished():
+                try:
+                    uuid, data = await asyncio.wait_for(queue.get(), ACK_TIMEOUT_S)
+                except asyncio.TimeoutError:
+                    reply = transfer.timeout() if not transfer.done else None
+                else:
+                    reply = transfer.on_data(data) if uuid == DATA_UUID else transfer.on_control(data)
+                if reply is not None:
+                    await client.write_gatt_char(CONTROL_UUID, reply, response=False)
+
+        await exchange(transfer.list_request(), lambda: transfer.listed)
+        complete = []
+        for name in names or sorted(transfer.files):
+            if name not in transfer.files:
+                print(f"{name} is not on the can")
+                continue
+            request = transfer.start(name)
+            if request is None:
+                print(f"{name} already downloaded")
+                complete.append(name)
+                continue
+            start, first = time.monotonic(), transfer.offset
+            await exchange(request, lambda: transfer.done)
+            if transfer.error is not None:
+                print(f"{name}: refused by the can (status {transfer.error})")
+                continue
+            elapsed = time.monotonic() - start
+            size = transfer.offset - first
+            print(f"{name}: {size} bytes in {elapsed:.1f} s ({size / elapsed / 1024:.1f} kB/s), "
+                  f"{transfer.bad_chunks} chunks resent")
+            complete.append(name)
+    return complete
+
+if __name__ == "__main__":
+    try:
+        import bleak  # noqa: F401
+    except ImportError:
+        sys.exit("The BLE download needs bleak: pip install bleak")
+
+    config = read_configuration('config.ini')
+    address = config["address"] or asyncio.run(find_can())
+
+    # File names on the command line, all log files otherwise
+    asyncio.run(download(address, config["output_dir"], sys.argv[1:], config["window"]))
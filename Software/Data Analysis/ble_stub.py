@@ -0,0 +1,110 @@
+"""
+Stand-in for the MicroPython 'bluetooth' and 'micropython' modules, so the
+can's BluetoothComm (Main Can/communications/bluetooth.py) runs in the host
+tests. The test plays the central: connect(), write() to a characteristic
+and take() the notifications the can sent.
+"""
+import uuid
+
+_IRQ_CENTRAL_CONNECT = 1
+_IRQ_CENTRAL_DISCONNECT = 2
+_IRQ_GATTS_WRITE = 3
+_IRQ_MTU_EXCHANGED = 21
+
+
+def const(value):
+    return value
+
+
+class UUID:
+    def __init__(self, value):
+        self.value = uuid.UUID(value)
+
+    def __bytes__(self):
+        # Little endian, as the BLE stack stores it
+        return self.value.bytes[::-1]
+
+    def __str__(self):
+        return str(self.value)
+
+
+class BLE:
+    """ One peripheral with one central. 'queue_size' notifications fit the
+        stack until the central takes them, further ones raise OSError.
+    """
+
+    def __init__(self, queue_size=8):
+        self.queue_size = queue_size
+        self.handles = {}           # Characteristic UUID string -> value handle
+        self.settings = {}
+        self.advertising = False
+        self.conn = None
+        self._handler = None
+        self._values = {}
+        self._notifications = []
+
+    # Peripheral API used by the can
+
+    def active(self, *state):
+        return True
+
+    def config(self, **settings):
+        self.settings.update(settings)
+
+    def irq(self, handler):
+        self._handler = handler
+
+    def gatts_register_services(self, services):
+        handles = []
+        for _, characteristics in services:
+            service_handles = []
+            for characteristic, _ in characteristics:
+                handle = len(self.handles) + 1
+                self.handles[str(characteristic)] = handle
+                self._values[handle] = b''
+                service_handles.append(handle)
+            handles.append(tuple(service_handles))
+        return tuple(handles)
+
+    def gatts_set_buffer(self, handle, size, append=False):
+        pass
+
+    def gap_advertise(self, interval_us, adv_data=None, resp_data=None):
+        self.advertising = interval_us is not None
+
+    def gattc_exchange_mtu(self, conn):
+        pass
+
+    def gatts_read(self, handle):
+        return self._values[handle]
+
+    def gatts_notify(self, conn, handle, data):
+        if conn != self.conn:
+            raise OSError(128)      # ENOTCONN
+        if len(self._notifications) >= self.queue_size:
+            raise OSError(12)       # ENOMEM, the stack is full
+        self._notifications.append((handle, bytes(data)))
+
+    # Central side, driven by the test
+
+    def connect(self, mtu=247, conn=0):
+        self.conn = conn
+        self.advertising = False
+        self._handler(_IRQ_CENTRAL_CONNECT, (conn, 0, b''))
+        self._handler(_IRQ_MTU_EXCHANGED, (conn, mtu))
+
+    def disconnect(self):
+        conn, self.conn = self.conn, None
+        self._notifications = []
+        self._handler(_IRQ_CENTRAL_DISCONNECT, (conn, 0, b''))
+
+    def write(self, uuid_string, data):
+        handle = self.handles[uuid_string]
+        self._values[handle] = bytes(data)
+        self._handler(_IRQ_GATTS_WRITE, (self.conn, handle))
+
+    def take(self):
+        """ The notifications sent since the last call, as (uuid, data). """
+        names = {handle: name for name, handle in self.handles.items()}
+        notifications, self._notifications = self._notifications, []
+        return [(names[handle], data) for handle, data in notifications]
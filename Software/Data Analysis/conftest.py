@@ -0,0 +1,34 @@
+"""
+Shared set-up of the host tests, run with 'python -m pytest' from this folder.
+
+The tests also run the can's own modules (Main Can/communications and
+utils): Main Can goes on the import path after this folder, and the
+can_clock fixture supplies the MicroPython tick functions of the time
+module.
+"""
+import os
+import sys
+import time
+
+import pytest
+
+MAIN_CAN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Main Can')
+sys.path.append(MAIN_CAN)
+
+
+class CanClock:
+    """ time.ticks_ms() of the can, moved on by the test. """
+    def __init__(self):
+        self.ms = 0
+
+    def advance(self, ms):
+        self.ms += ms
+
+
+@pytest.fixture
+def can_clock(monkeypatch):
+    clock = CanClock()
+    monkeypatch.setattr(time, 'ticks_ms', lambda: clock.ms, raising=False)
+    monkeypatch.setattr(time, 'ticks_diff', lambda new, old: new - old, raising=False)
+    monkeypatch.setattr(time, 'ticks_add', lambda ticks, delta: ticks + delta, raising=False)
+    return clock
@@ -0,0 +1,152 @@
+import json
+import hashlib
+from array import array
+from collections import OrderedDict
+try:
+    # C CRC-32 where the port has it (CPython, ubinascii on the ESP32)
+    from binascii import crc32 as _crc32_c
+except ImportError:
+    _crc32_c = None
+try:
+    # CRC-16/CCITT in C, CPython only
+    from binascii import crc_hqx as _crc16_c
+except ImportError:
+    _crc16_c = None
+
+# Byte-at-a-time lookup tables, built once at import
+_CRC16_TABLE = array('H', [0] * 256)
+_CRC32_TABLE = array('I', [0] * 256)
+
+def _init_tables():
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) & 0xffff if crc & 0x8000 else (crc << 1) & 0xffff
+        _CRC16_TABLE[i] = crc
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xEDB88320 if crc & 1 else crc >> 1
+        _CRC32_TABLE[i] = crc
+
+_init_tables()
+
+def serialize_data(data):
+    """ Convert data to a JSON formatted string. """
+    return json.dumps(data, separators=(',', ':'))
+
+def deserialize_data(data_string):
+    """ Convert JSON formatted string back to data. """
+    return json.loads(data_string)
+
+def get_data_checksum(data):
+    """ Generate an MD5 checksum for the data (slow: sorts, serialises and hashes,
+        use crc32/crc16_ccitt on the bytes instead). """
+    # Convert data to JSON ensuring consistent order
+    sorted_dict = OrderedDict(sorted(data.items()))
+    sorted_json = json.dumps(sorted_dict)
+    encoded_data = sorted_json.encode()
+
+    # Calculate MD5 hash
+    md5_hash = hashlib.md5(encoded_data)
+    # Convert the binary digest to a hexadecimal string
+    hex_digest = ''.join('{:02x}'.format(x) for x in md5_hash.digest())
+    
+    return hex_digest
+
+def compute_crc32(data):
+    """ Compute CRC32 checksum for given data. """
+    serialized_data = serialize_data(data)
+    return crc32(serialized_data.encode())
+
+def decode_hex(hex_str):
+    """ Convert a hexadecimal string to bytes. """
+    byte_data = bytes.fromhex(hex_str)
+    return byte_data
+
+def crc32(data, crc=0):
+    """ CRC-32 (IEEE 802.3, same as zlib.crc32) over bytes, bytearray or memoryview.
+        Pass the previous result as 'crc' to continue over several chunks.
+    """
+    if _crc32_c is not None:
+        return _crc32_c(data, crc) & 0xffffffff
+    table = _CRC32_TABLE
+    crc ^= 0xffffffff
+    for b in data:
+        crc = table[(crc ^ b) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+def crc16_ccitt(data, crc=0xffff):
+    """ CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF) used by the radio frames.
+        Pass the previous result as 'crc' to continue over several chunks.
+    """
+    if _crc16_c is not None:
+        return _crc16_c(data, crc)
+    table = _CRC16_TABLE
+    for b in data:
+        crc = ((crc << 8) & 0xff00) ^ table[(crc >> 8) ^ b]
+    return crc
+
+# Stored text records end with a tab and the CRC-32 of the text as 8 hex
+# digits. repr() and JSON never emit a raw tab, so the split is unambiguous.
+RECORD_CRC_SEPARATOR = '\t'
+
+def record_with_crc(text):
+    """ Return one log line: the record text followed by its CRC-32. """
+    return '{}{}{:08x}'.format(text, RECORD_CRC_SEPARATOR, crc32(text.encode()))
+
+def check_record(line):
+    """ Split a log line into (text, valid). 'valid' is None for lines
+        written before records carried a CRC.
+    """
+    line = line.rstrip('\r\n')
+    text, separator, crc = line.rpartition(RECORD_CRC_SEPARATOR)
+    if not separator or len(crc) != 8:
+        return line, None
+    try:
+        return text, int(crc, 16) == crc32(text.encode())
+    except ValueError:
+        return line, None
+
+def hmac_sha256(key, data):
+    """ HMAC-SHA256 (RFC 2104), MicroPython has no hmac module. """
+    if len(key) > 64:
+        key = hashlib.sha256(key).digest()
+    key = key + bytes(64 - len(key))
+    inner = hashlib.sha256(bytes(b ^ 0x36 for b in key))
+    inner.update(data)
+    outer = hashlib.sha256(bytes(b ^ 0x5c for b in key))
+    outer.update(inner.digest())
+    return outer.digest()
+
+# # Example data
+# data = {
+#     'type': "telemetry",
+#     'pid': 101,
+#     'valid': True,
+#     'epochtime': 768364735,
+#     'localtime': "2024-05-07 02:38:57",
+#     'data': {
+#         'temperature': 20.13,
+#         'altitude': None,
+#         'acceleration': {'accel_x': 0.56, 'accel_y': 0.01, 'accel_z': 9.89},
+#         'gyroscope': {'gyro_x': 0.56, 'gyro_y': 0.01, 'gyro_z': 9.89},
+#         'magnetometric': {'mag_x': 0.56, 'mag_y': 0.01, 'mag_z': 9.89},
+#         'pressure': 980,
+#         'uv_index': 434,
+#         'air_quality': None,
+#         'gps_coordinates': {'latitude': 47.843570709228516, 'longitude': 21.253999710083008},
+#         'battery_level': 67
+#     }
+# }
+# 
+# # Calculate checksum
+# checksum = get_data_checksum(data)
+# print("Checksum:", checksum)
+# 
+# # Decode the checksum hexadecimal back to bytes (mostly for demonstration, not practical for hashes)
+# dec = decode_hex(checksum)
+# print("Decoded Hex to Bytes:", dec)
+# 
+# # # Calculate checksum
+# # crc_value = crc32(data)
+# # print("CRC32 Checksum:", crc_value)
@@ -0,0 +1,292 @@
+"""
+This module computes IMU and magnetometer calibrations from CanSat logs
+and writes them in the fixed-point format the can applies in flight
+(sensors/calibration.py on the Main Can).
+
+The log must be recorded without a calibration file on the can, so the
+values are uncorrected:
+    - accelerometer: hold the can still in each of the six orientations
+      (every axis pointing up and down) for a few seconds;
+    - magnetometers: rotate the can slowly through as many orientations
+      as possible, away from metal and magnets.
+The gyro offset is measured by the can itself on the pad at every boot.
+"""
+import ast
+import configparser
+import json
+import os
+
+import numpy as np
+
+from dataintegrity import check_record
+from logformat import LOG_MAGIC
+from binary_log_parser import read_log
+
+# Must match CAL_Q in sensors/calibration.py
+CAL_Q = 14
+
+ACCEL_AXES = ('accel_x', 'accel_y', 'accel_z')
+MAG_AXES = ('mag_x', 'mag_y', 'mag_z')
+
+
+def read_configuration(file_path: str = 'config.ini') -> dict:
+    """
+    Reads the calibration configuration from a configuration file.
+
+    Parameters:
+        file_path (str): The path to the configuration file. Defaults to 'config.ini'.
+
+    Returns:
+        dict: Configuration parameters.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"{file_path} not found.")
+
+    config = configparser.ConfigParser()
+    with open(file_path, 'r', encoding='utf-8') as config_file:
+        config.read_file(config_file)
+
+    try:
+        return {
+            "input_file": config.get('CALIBRATION', 'InputFile'),
+            "serial": config.get('CALIBRATION', 'Serial'),
+            "output_dir": config.get('CALIBRATION', 'OutputDir', fallback='.'),
+            "accel_lsb_per_g": config.getfloat('CALIBRATION', 'AccelLsbPerG'),
+            "icm_mag_lsb_per_unit": config.getfloat('CALIBRATION', 'IcmMagLsbPerUnit'),
+            "lis_mag_lsb_per_gauss": config.getfloat('CALIBRATION', 'LisMagLsbPerGauss'),
+            "still_window": config.getint('CALIBRATION', 'StillWindow'),
+            "still_threshold": config.getfloat('CALIBRATION', 'StillThreshold'),
+        }
+
+    except (configparser.NoSectionError, configparser.NoOptionError) as noe:
+        raise ValueError(f"Configuration reading error: {str(noe)}")
+
+
+def load_samples(input_file: str) -> dict:
+    """
+    Reads the accelerometer and magnetometer samples from a CanSat log,
+    binary or text.
+
+    Parameters:
+        input_file (str): The path to the log written by the DataLogger.
+
+    Returns:
+        dict: Arrays of shape (n, 3) keyed by 'accel', 'icm_mag' and 'lis_mag'.
+    """
+    sources = (
+        ('accel', 'acc', 'icm20948', ACCEL_AXES),
+        ('icm_mag', 'mag', 'icm20948', MAG_AXES),
+        ('lis_mag', 'mag', 'lis3mdl', MAG_AXES),
+    )
+    with open(input_file, 'rb') as file:
+        binary = file.read(len(LOG_MAGIC)) == LOG_MAGIC
+    if binary:
+        _, columns, _ = read_log(input_file)
+        samples = {}
+        for name, group, sensor, axes in sources:
+            values = np.column_stack([columns[f"{group}.{sensor}.{axis}"] for axis in axes]).astype(float)
+            samples[name] = values[~np.isnan(values).any(axis=1)]
+        return samples
+
+    samples = {'accel': [], 'icm_mag': [], 'lis_mag': []}
+    with open(input_file, 'r', encoding='utf-8') as file:
+        for line in file:
+            line, valid = check_record(line.strip())
+            if not line or valid is False:
+                continue
+            try:
+                record = ast.literal_eval(line.replace("null", "None").replace("true", "True").replace("false", "False"))
+            except (ValueError, SyntaxError) as e:
+                print(f"Skipping invalid line: {line}. Error {e}")
+                continue
+            data = record.get('data') or {}
+            for name, group, sensor, axes in sources:
+                values = (data.get(group) or {}).get(sensor)
+                if values and all(axis in values for axis in axes):
+                    samples[name].append([values[axis] for axis in axes])
+    return {name: np.array(values, dtype=float).reshape(-1, 3) for name, values in samples.items()}
+
+
+def find_still_means(samples: np.ndarray, window: int, threshold: float) -> np.ndarray:
+    """
+    Averages the windows in which the sensor did not move.
+
+    Parameters:
+        samples (np.ndarray): Samples of shape (n, 3).
+        window (int): Number of consecutive samples per window.
+        threshold (float): Largest standard deviation on any axis for a still window.
+
+    Returns:
+        np.ndarray: Mean of every still window, shape (m, 3).
+    """
+    means = []
+    for start in range(0, len(samples) - window + 1, window):
+        chunk = samples[start:start + window]
+        if np.all(chunk.std(axis=0) < threshold):
+            means.append(chunk.mean(axis=0))
+    return np.array(means).reshape(-1, 3)
+
+
+def fit_accelerometer(still_means: np.ndarray) -> tuple:
+    """
+    Six-position accelerometer calibration.
+
+    Each still window is assigned to the orientation whose axis carries
+    gravity; the correction out = M (raw - offset) is then fitted by least
+    squares so that every orientation reads exactly 1 g on its axis. This
+    solves scale, cross-axis misalignment and bias at once.
+
+    Parameters:
+        still_means (np.ndarray): Still window means in g, shape (m, 3).
+
+    Returns:
+        tuple: (3x3 matrix, offset vector in g).
+    """
+    axis = np.argmax(np.abs(still_means), axis=1)
+    sign = np.sign(still_means[np.arange(len(still_means)), axis])
+    references, measured = [], []
+    for ax in range(3):
+        for direction in (1.0, -1.0):
+            selected = still_means[(axis == ax) & (sign == direction)]
+            if not len(selected):
+                raise ValueError(f"No still samples with axis {'xyz'[ax]} pointing {'up' if direction > 0 else 'down'}")
+            reference = np.zeros(3)
+            reference[ax] = direction
+            references.append(reference)
+            measured.append(selected.mean(axis=0))
+
+    measured = np.array(measured)
+    design = np.hstack([measured, np.ones((len(measured), 1))])
+    solution, _, _, _ = np.linalg.lstsq(design, np.array(references), rcond=None)
+    matrix = solution[:3].T
+    offset = -np.linalg.solve(matrix, solution[3])
+    return matrix, offset
+
+
+def fit_ellipsoid(samples: np.ndarray) -> tuple:
+    """
+    Hard/soft-iron magnetometer calibration by ellipsoid fitting.
+
+    Fits the quadric x'Ax + 2g'x = 1 to the samples, moves it to the
+    origin and returns the symmetric matrix that maps the ellipsoid onto a
+    sphere. The sphere radius is the geometric mean of the ellipsoid radii,
+    so the corrected field keeps the units of the input.
+
+    Parameters:
+        samples (np.ndarray): Magnetometer samples, shape (n, 3).
+
+    Returns:
+        tuple: (3x3 soft-iron matrix, hard-iron offset).
+    """
+    if len(samples) < 9:
+        raise ValueError("At least 9 magnetometer samples are needed for an ellipsoid fit")
+    x, y, z = samples[:, 0], samples[:, 1], samples[:, 2]
+    design = np.column_stack([x * x, y * y, z * z, 2 * x * y, 2 * x * z, 2 * y * z, 2 * x, 2 * y, 2 * z])
+    v, _, _, _ = np.linalg.lstsq(design, np.ones(len(samples)), rcond=None)
+
+    quadric = np.array([[v[0], v[3], v[4]],
+                        [v[3], v[1], v[5]],
+                        [v[4], v[5], v[2]]])
+    center = -np.linalg.solve(quadric, v[6:9])
+    shape = quadric / (1.0 + center @ quadric @ center)
+
+    eigenvalues, eigenvectors = np.linalg.eigh(shape)
+    if np.any(eigenvalues <= 0):
+        raise ValueError("Magnetometer samples do not describe an ellipsoid, rotate the can through more orientations")
+    radii = 1.0 / np.sqrt(eigenvalues)
+    radius = np.prod(radii) ** (1.0 / 3.0)
+    matrix = radius * (eigenvectors @ np.diag(np.sqrt(eigenvalues)) @ eigenvectors.T)
+    return matrix, center
+
+
+def to_fixed_point(matrix: np.ndarray, offset: np.ndarray, lsb_per_unit: float) -> dict:
+    """
+    Converts a correction to the on-can format.
+
+    The can applies the matrix to raw counts, so only the offset depends on
+    the sensor sensitivity.
+
+    Parameters:
+        matrix (np.ndarray): 3x3 correction matrix.
+        offset (np.ndarray): Offset in the logged units.
+        lsb_per_unit (float): Raw counts per logged unit.
+
+    Returns:
+        dict: {'matrix': nine Q14 integers, 'offset': three raw-count integers}.
+    """
+    fixed = np.rint(np.asarray(matrix) * (1 << CAL_Q)).astype(int)
+    if np.any(np.abs(fixed) >= 1 << 20):
+        raise ValueError("Correction matrix out of range, check the logged data")
+    return {
+        'matrix': [int(value) for value in fixed.flatten()],
+        'offset': [int(value) for value in np.rint(np.asarray(offset) * lsb_per_unit)],
+    }
+
+
+def write_calibration(serial: str, entries: dict, output_dir: str = '.') -> str:
+    """
+    Merges the new corrections into calibration_<serial>.json.
+
+    Entries that were not recalibrated (e.g. the gyro) are kept.
+
+    Parameters:
+        serial (str): Device serial (hex unique ID) reported by the can.
+        entries (dict): {sensor: {kind: correction}}.
+        output_dir (str): Directory of the calibration files.
+
+    Returns:
+        str: The path written.
+    """
+    path = os.path.join(output_dir, f"calibration_{serial}.json")
+    calibration = {}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            calibration = json.load(file)
+    calibration['serial'] = serial
+    calibration['q'] = CAL_Q
+    for sensor, kinds in entries.items():
+        calibration.setdefault(sensor, {}).update(kinds)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(calibration, file)
+    return path
+
+
+def calibrate(config: dict) -> dict:
+    """
+    Runs every calibration the log has enough data for.
+
+    Parameters:
+        config (dict): Configuration from read_configuration().
+
+    Returns:
+        dict: {sensor: {kind: correction}} in the on-can format.
+    """
+    samples = load_samples(config["input_file"])
+    entries = {}
+
+    still = find_still_means(samples['accel'], config["still_window"], config["still_threshold"])
+    try:
+        matrix, offset = fit_accelerometer(still)
+        entries.setdefault('icm20948', {})['accel'] = to_fixed_point(matrix, offset, config["accel_lsb_per_g"])
+        print(f"Accelerometer: {len(still)} still windows, offset {offset} g")
+    except ValueError as e:
+        print(f"Accelerometer not calibrated: {e}")
+
+    for name, sensor, lsb in (('icm_mag', 'icm20948', config["icm_mag_lsb_per_unit"]),
+                              ('lis_mag', 'lis3mdl', config["lis_mag_lsb_per_gauss"])):
+        try:
+            matrix, offset = fit_ellipsoid(samples[name])
+            entries.setdefault(sensor, {})['mag'] = to_fixed_point(matrix, offset, lsb)
+            print(f"{sensor} magnetometer: {len(samples[name])} samples, hard-iron offset {offset}")
+        except (ValueError, np.linalg.LinAlgError) as e:
+            print(f"{sensor} magnetometer not calibrated: {e}")
+
+    return entries
+
+
+if __name__ == "__main__":
+    config = read_configuration('config.ini')
+    entries = calibrate(config)
+    if entries:
+        path = write_calibration(config["serial"], entries, config["output_dir"])
+        print(f"Calibration written to {path}, copy it to the can's flash")
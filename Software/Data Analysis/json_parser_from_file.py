@@ -6,6 +6,8 @@ import json
 import configparser
 import os
 
+from dataintegrity import check_record
+
 def read_configuration(file_path: str = 'config.ini') -> dict:
     """
     Reads configuration from a configuration file.
@@ -44,8 +46,14 @@ def convert_to_json(input_file, output_file):
         lines = file.readlines()
     # Clean and convert each line from the input file
     data_list = []
+    corrupt = 0
     for line in lines:
-        line = line.strip()
+        line, valid = check_record(line.strip())
+        if valid is False:
+            # Torn or corrupted record, its CRC-32 does not match
+            corrupt += 1
+            print(f"Skipping corrupt line: {line}")
+            continue
         if line:
             try:
                 # Convert string representation of dict to actual dict
@@ -54,6 +62,9 @@ def convert_to_json(input_file, output_file):
             except Exception as e:
                 print(f"Skipping invalid line: {line}. Error {e}")
 
+    if corrupt:
+        print(f"{corrupt} corrupt records skipped")
+
     # Convert list of dicts to JSON and save to output file
     with open(output_file, 'w', encoding='utf-8') as json_file:
         json.dump(data_list, json_file, indent=4)
@@ -0,0 +1,115 @@
+"""
+A reset can cut a log file at any byte. These tests cut a segment the can's
+DataLogger wrote at every offset and check that the next boot seals it and
+binary_log_parser reads back every whole record.
+"""
+import os
+
+import pytest
+
+from binary_log_parser import read_log
+from logformat import FILE_HEADER_SIZE, SAMPLE_RECORD_SIZE, SEAL_RECORD_SIZE, segment_filename
+from utils.datalogger import DataLogger
+
+BASE = 'rcrc24log'
+SAMPLES = 30
+
+
+def sample(pid):
+    """ A sample as the main loop of the can builds it. """
+    data = {
+        'temp': {'bme688': 20.5, 'lps25h': 21.0, 'mcp9808': 20.75, 'bmp280': 21.25},
+        'pres': {'bme688': 1013.25, 'lps25h': 1013.5, 'bmp280': 1012.75},
+        'alt': {'bme688': 100.0 + pid, 'lps25h': 101.0 + pid, 'bmp280': 99.0 + pid},
+        'acc': {'icm20948': {'accel_x': 0.0, 'accel_y': 0.0, 'accel_z': 1.0}},
+        'gps': {'lat': 38.1187241, 'lon': 23.7090535},
+    }
+    return {'pid': pid, 'epoch': 770148653 + pid, 'data': data, 'esp32': {'fmem': 100000, 'wss': 'Not Connected'}}
+
+
+@pytest.fixture
+def image(tmp_path, monkeypatch, can_clock):
+    """ Bytes of a segment that was never closed, as a reset leaves it. """
+    monkeypatch.chdir(tmp_path)
+    logger = DataLogger()
+    logger.start_session()
+    for pid in range(SAMPLES):
+        can_clock.advance(50)
+        logger.write_data(sample(pid))
+    logger.commit()
+    with open(segment_filename(BASE, 1, 0), 'rb') as file:
+        return file.read()
+
+
+def test_clean_close_is_sealed(tmp_path, monkeypatch, can_clock):
+    monkeypatch.chdir(tmp_path)
+    logger = DataLogger()
+    logger.start_session()
+    for pid in range(SAMPLES):
+        logger.write_data(sample(pid))
+    logger.close()
+
+    header, columns, stats = read_log(segment_filename(BASE, 1, 0))
+    assert header['session'] == 1 and header['segment'] == 0
+    assert stats['sealed'] == 'closed'
+    assert stats['samples'] == SAMPLES and stats['corrupt'] == 0 and stats['torn_bytes'] == 0
+    assert list(columns['pid']) == list(range(SAMPLES))
+    assert list(columns['alt.bme688']) == [100.0 + pid for pid in range(SAMPLES)]
+    # The next boot finds nothing to recover
+    assert DataLogger().start_session() == {'recovered': None, 'session': 2}
+
+
+def test_truncated_at_every_offset(image, tmp_path, monkeypatch, can_clock):
+    assert len(image) == FILE_HEADER_SIZE + SAMPLES * SAMPLE_RECORD_SIZE
+    name = segment_filename(BASE, 1, 0)
+    for length in range(len(image) + 1):
+        directory = tmp_path / str(length)
+        directory.mkdir()
+        monkeypatch.chdir(directory)
+        with open(name, 'wb') as file:
+            file.write(image[:length])
+        with open('logsession.txt', 'w') as file:
+            file.write('1')
+
+        result = DataLogger().start_session()
+        assert result['session'] == 2, length
+        if length < FILE_HEADER_SIZE:
+            # Nothing was written yet, the file goes
+            assert result['recovered'] == name and result['records'] == 0
+            assert not os.path.exists(name)
+            continue
+        records, torn = divmod(length - FILE_HEADER_SIZE, SAMPLE_RECORD_SIZE)
+        assert result == {'recovered': name, 'records': records, 'torn_bytes': torn, 'session': 2}, length
+        assert os.path.getsize(name) == length + SEAL_RECORD_SIZE
+
+        _, columns, stats = read_log(name)
+        assert stats['sealed'] == 'recovered', length
+        assert stats['samples'] == records and stats['torn_bytes'] == torn and stats['corrupt'] == 0, length
+        assert list(columns['pid']) == list(range(records)), length
+
+        # Sealed once: the boot after that leaves it alone
+        assert DataLogger().start_session() == {'recovered': None, 'session': 3}
+
+
+def test_stale_tail_is_cut_off(image, tmp_path, monkeypatch, can_clock):
+    """ Flash after the cut may still hold whole records of a deleted file. """
+    monkeypatch.chdir(tmp_path)
+    name = segment_filename(BASE, 1, 0)
+    length = FILE_HEADER_SIZE + 7 * SAMPLE_RECORD_SIZE + 50
+    stale = image[FILE_HEADER_SIZE:FILE_HEADER_SIZE + 3 * SAMPLE_RECORD_SIZE]
+    with open(name, 'wb') as file:
+        file.write(image[:length] + stale)
+
+    assert DataLogger().start_session()['records'] == 7
+    _, columns, stats = read_log(name)
+    assert stats['samples'] == 7 and stats['torn_bytes'] == 50 + len(stale)
+    assert list(columns['pid']) == list(range(7))
+
+
+def test_lost_session_file(image, tmp_path, monkeypatch, can_clock):
+    """ Session numbers keep going up from the newest file. """
+    monkeypatch.chdir(tmp_path)
+    with open(segment_filename(BASE, 7, 3), 'wb') as file:
+        file.write(image)
+    result = DataLogger().start_session()
+    assert result['session'] == 8 and result['recovered'] == segment_filename(BASE, 7, 3)
@@ -0,0 +1,163 @@
+"""
+BLE log download end to end: the can's BluetoothComm and LogTransferServer
+on the ble_stub stand-in, the host's LogTransferClient as the central,
+with lost and corrupted notifications, small MTUs and a reconnect in the
+middle of a file.
+"""
+import importlib
+import os
+import random
+import sys
+
+import pytest
+
+import ble_stub
+from logtransfer import (LogTransferClient, CONTROL_UUID, DATA_UUID, OP_TEXT, STATUS_NOT_FOUND, DEFAULT_MTU,
+                         BLE_MTU)
+
+FILES = {'rcrc24log_00001_0000.bin': 20000, 'rcrc24log_00001_0001.bin': 777, 'rcrc24log_00002_0000.bin': 0}
+
+
+@pytest.fixture
+def can(tmp_path, monkeypatch):
+    """ BluetoothComm serving FILES from the can's working directory. """
+    monkeypatch.setitem(sys.modules, 'bluetooth', ble_stub)
+    monkeypatch.setitem(sys.modules, 'micropython', ble_stub)
+    monkeypatch.delitem(sys.modules, 'communications.bluetooth', raising=False)
+    bluetooth = importlib.import_module('communications.bluetooth')
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(1)
+    for name, size in FILES.items():
+        with open(name, 'wb') as file:
+            file.write(bytes(rng.randrange(256) for _ in range(size)))
+    with open('log.txt', 'w') as file:
+        file.write('not a flight log\n')
+    return bluetooth.BluetoothComm()
+
+
+@pytest.fixture
+def host(tmp_path):
+    os.mkdir(tmp_path / 'host')
+    return LogTransferClient(str(tmp_path / 'host'))
+
+
+def exchange(can, host, request, finished, loss=0.0, corrupt=0.0, seed=1, max_polls=20000):
+    """ Run the can and the host until finished(); the host acknowledges
+        on a timeout when a poll brought no notification.
+    """
+    rng = random.Random(seed)
+    can.ble.write(CONTROL_UUID, request)
+    for _ in range(max_polls):
+        if finished():
+            return
+        can.poll()
+        notifications = can.ble.take()
+        for uuid, data in notifications:
+            if uuid == CONTROL_UUID:
+                reply = host.on_control(data)
+            elif rng.random() < loss:
+                continue
+            else:
+                if rng.random() < corrupt:
+                    data = bytearray(data)
+                    data[rng.randrange(len(data))] ^= 0x40
+                reply = host.on_data(data)
+            if reply:
+                can.ble.write(CONTROL_UUID, reply)
+        if not notifications and not host.done:
+            can.ble.write(CONTROL_UUID, host.timeout())
+    raise AssertionError("Transfer did not finish")
+
+
+def download(can, host, name, **link):
+    request = host.start(name)
+    if request is not None:
+        exchange(can, host, request, lambda: host.done, **link)
+
+
+def downloaded(host, name):
+    with open(os.path.join(host.out_dir, name), 'rb') as file:
+        return file.read()
+
+
+def original(name):
+    with open(name, 'rb') as file:
+        return file.read()
+
+
+def test_list(can, host):
+    can.ble.connect()
+    exchange(can, host, host.list_request(), lambda: host.listed)
+    assert host.files == FILES
+
+
+@pytest.mark.parametrize('mtu', [DEFAULT_MTU, 100, BLE_MTU])
+def test_round_trip(can, host, mtu):
+    can.ble.connect(mtu)
+    exchange(can, host, host.list_request(), lambda: host.listed)
+    for name in host.files:
+        download(can, host, name)
+        assert downloaded(host, name) == original(name)
+        assert host.bad_chunks == 0
+    # The last acknowledgement reaches the can on its next poll
+    can.poll()
+    assert not can.server.busy
+    assert can.server.sent_bytes == sum(FILES.values())
+
+
+@pytest.mark.parametrize('loss, corrupt', [(0.1, 0.0), (0.3, 0.0), (0.0, 0.1), (0.2, 0.05)])
+def test_lossy_link(can, host, loss, corrupt):
+    can.ble.connect()
+    exchange(can, host, host.list_request(), lambda: host.listed)
+    for seed, name in enumerate(host.files):
+        download(can, host, name, loss=loss, corrupt=corrupt, seed=seed)
+        assert downloaded(host, name) == original(name)
+    assert not os.path.exists(os.path.join(host.out_dir, 'rcrc24log_00001_0000.bin.part'))
+
+
+def test_resume_after_disconnect(can, host):
+    name = 'rcrc24log_00001_0000.bin'
+    can.ble.connect()
+    exchange(can, host, host.list_request(), lambda: host.listed)
+    exchange(can, host, host.start(name), lambda: host.offset >= FILES[name] // 2)
+    can.ble.disconnect()
+    can.poll()
+    assert can.ble.advertising and not can.server.busy
+    # The host keeps the partial file, its handle closes with the link
+    host._file.close()
+    partial = host.offset
+
+    can.ble.connect()
+    sent = can.server.sent_bytes
+    download(can, host, name)
+    assert downloaded(host, name) == original(name)
+    # Only the rest was sent again
+    assert can.server.sent_bytes - sent == FILES[name] - partial
+    # A complete file is not asked for again
+    assert host.start(name) is None
+
+
+def test_missing_file(can, host):
+    can.ble.connect()
+    exchange(can, host, host.list_request(), lambda: host.listed)
+    host.files['rcrc24log_00009_0000.bin'] = 100
+    download(can, host, 'rcrc24log_00009_0000.bin')
+    assert host.error == STATUS_NOT_FOUND
+    assert not os.listdir(host.out_dir)
+
+
+def test_files_outside_the_log_are_refused(can, host):
+    can.ble.connect()
+    download(can, host, 'log.txt')
+    assert host.error == STATUS_NOT_FOUND
+
+
+def test_live_text_only_between_downloads(can, host):
+    assert not can.send_data({'alt': 100})
+    can.ble.connect()
+    assert can.send_data({'alt': 100})
+    assert can.ble.take() == [(CONTROL_UUID, bytes([OP_TEXT]) + b"{'alt': 100}")]
+    can.ble.write(CONTROL_UUID, host.start('rcrc24log_00001_0000.bin'))
+    can.poll()
+    assert can.server.busy and not can.send_data({'alt': 100})
+    assert all(uuid in (CONTROL_UUID, DATA_UUID) for uuid, _ in can.ble.take())
@@ -6,7 +6,7 @@ from utils.i2c_scanner import I2CScanner
 import config
 from machine import Pin, RTC, UART, I2C
 from utils.neopixel import NeoPixelControl
-from utils.logger import Logger
+from utils.logger import get_logger
 
 
 # import machine
@@ -22,7 +22,7 @@ esp.osdebug(None)  # Disable debug output to save power
 # import webrepl
 # webrepl.start()
 
-log = Logger()
+log = get_logger()
 
 print("Device Booted.")
 log.log_event("INFO", "CanSat mission started")
@@ -0,0 +1,165 @@
+""" LoRa time-on-air and duty-cycle budgeting.
+
+    EU868 sub-band g1 (868.0-868.6 MHz) allows a 1 % duty cycle, i.e.
+    36 s of transmission per hour. The rate controller spends that budget
+    evenly and skips samples (down-sampling) when a frame does not fit,
+    instead of blocking or exceeding the limit.
+"""
+import time
+
+DUTY_CYCLE = 0.01
+DUTY_WINDOW_MS = 3600000
+BURST_MS = 1000             # Airtime that may be saved up for bursts
+MAX_FRAME = 255             # Largest LoRa payload (lora.MAX_PAYLOAD)
+
+# RN2483 defaults for the settings LoRaComm does not change
+DEFAULT_SETTINGS = {
+    'sf': 12,
+    'bw': 125,
+    'cr': 1,                # 4/5 -> 1 ... 4/8 -> 4
+    'prlen': 8,
+    'crc': True,
+    'header': True,         # Explicit header
+}
+
+
+def radio_settings(commands):
+    """ Extract SF/BW/CR/preamble/CRC from 'radio set ...' commands (e.g. LoRaComm.commands). """
+    settings = dict(DEFAULT_SETTINGS)
+    for cmd in commands:
+        parts = cmd.split()
+        if len(parts) != 4 or parts[0] != 'radio' or parts[1] != 'set':
+            continue
+        name, value = parts[2], parts[3]
+        if name == 'sf':
+            settings['sf'] = int(value[2:])
+        elif name == 'bw':
+            settings['bw'] = int(value)
+        elif name == 'cr':
+            settings['cr'] = int(value.split('/')[1]) - 4
+        elif name == 'prlen':
+            settings['prlen'] = int(value)
+        elif name == 'crc':
+            settings['crc'] = value == 'on'
+    return settings
+
+
+def time_on_air_us(payload_len, sf, bw, cr=1, prlen=8, crc=True, header=True):
+    """ Time on air of a LoRa packet in microseconds (Semtech AN1200.13).
+        'bw' is in kHz, 'cr' is 1 for 4/5 up to 4 for 4/8.
+    """
+    symbol_us = (1 << sf) * 1000 // bw
+    # Low data rate optimisation is mandatory above 16 ms per symbol
+    de = 1 if symbol_us > 16000 else 0
+    ih = 0 if header else 1
+    numerator = 8 * payload_len - 4 * sf + 28 + (16 if crc else 0) - 20 * ih
+    denominator = 4 * (sf - 2 * de)
+    symbols = 8 + max(-(-numerator // denominator) * (cr + 4), 0)
+    return (prlen * 4 + 17) * symbol_us // 4 + symbols * symbol_us
+
+
+class DutyCycleBudget:
+    """ Airtime spent in the last 'window_ms', as a sliding window. """
+
+    def __init__(self, duty_cycle=DUTY_CYCLE, window_ms=DUTY_WINDOW_MS):
+        self.window_ms = window_ms
+        self.limit_ms = int(duty_cycle * window_ms)
+        self.used_ms = 0
+        self._log = []
+
+    def _expire(self, now):
+        while self._log and time.ticks_diff(now, self._log[0][0]) >= self.window_ms:
+            self.used_ms -= self._log.pop(0)[1]
+
+    def remaining(self, now=None):
+        if now is None:
+            now = time.ticks_ms()
+        self._expire(now)
+        return self.limit_ms - self.used_ms
+
+    def record(self, airtime_ms, now=None):
+        if now is None:
+            now = time.ticks_ms()
+        self._log.append((now, airtime_ms))
+        self.used_ms += airtime_ms
+
+
+class RateController:
+    """ Decides which telemetry frames go on air.
+
+        Airtime credit accrues at the duty-cycle rate (capped at
+        'burst_ms') and every frame sent spends its time on air, so the
+        budget is spread evenly over the hour. The sliding-window budget
+        is checked as well, so the legal limit holds even after bursts.
+
+        At high SFs a single frame takes longer than 'burst_ms'; the cap
+        then grows to two 'max_frame' frames, one sent plus one kept back
+        with 'keep_ms', or such frames could never be sent.
+    """
+
+    def __init__(self, settings, duty_cycle=DUTY_CYCLE, window_ms=DUTY_WINDOW_MS, burst_ms=BURST_MS,
+                 max_frame=MAX_FRAME):
+        self.settings = settings
+        self.duty_cycle = duty_cycle
+        self.min_burst_ms = burst_ms
+        self.max_frame = max_frame
+        self.budget = DutyCycleBudget(duty_cycle, window_ms)
+        self._toa_cache = {}
+        self.burst_ms = self._burst_cap()
+        self.credit_ms = self.burst_ms
+        self._last = time.ticks_ms()
+        self.sent = 0
+        self.skipped = 0
+
+    def _burst_cap(self):
+        return max(self.min_burst_ms, 2 * self.time_on_air_ms(self.max_frame))
+
+    def configure(self, **settings):
+        """ Follow a radio change, e.g. configure(sf=9). """
+        self.settings.update(settings)
+        self._toa_cache = {}
+        # Credit saved up at the old SF stays, only the cap moves
+        self.burst_ms = self._burst_cap()
+        self.credit_ms = min(self.credit_ms, self.burst_ms)
+
+    def time_on_air_ms(self, payload_len):
+        toa = self._toa_cache.get(payload_len)
+        if toa is None:
+            toa = -(-time_on_air_us(payload_len, **self.settings) // 1000)
+            self._toa_cache[payload_len] = toa
+        return toa
+
+    def _accrue(self, now):
+        elapsed = time.ticks_diff(now, self._last)
+        self._last = now
+        self.credit_ms = min(self.credit_ms + elapsed * self.duty_cycle, self.burst_ms)
+
+    def plan(self, frames, now=None, keep_ms=0):
+        """ Return the frames that may be sent now, from 'frames' in priority order.
+            Frames that do not fit are skipped (down-sampled), never delayed.
+            'keep_ms' of credit is left untouched, e.g. for the next critical frame.
+        """
+        if now is None:
+            now = time.ticks_ms()
+        self._accrue(now)
+        remaining = self.budget.remaining(now)
+        chosen = []
+        for frame in frames:
+            toa = self.time_on_air_ms(len(frame))
+            if toa + keep_ms <= self.credit_ms and toa + keep_ms <= remaining:
+                self.credit_ms -= toa
+                remaining -= toa
+                self.budget.record(toa, now)
+                chosen.append(frame)
+                self.sent += 1
+            else:
+                self.skipped += 1
+        return chosen
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'skipped': self.skipped,
+            'used_ms': self.budget.used_ms,
+            'limit_ms': self.budget.limit_ms,
+        }
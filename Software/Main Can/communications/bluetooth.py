@@ -1,8 +1,118 @@
+import bluetooth
+import struct
+from micropython import const
+from communications.logtransfer import (LogTransferServer, SERVICE_UUID, CONTROL_UUID, DATA_UUID, DEVICE_NAME,
+                                        BLE_MTU, DEFAULT_MTU, OP_TEXT, ATT_HEADER)
+
+_IRQ_CENTRAL_CONNECT = const(1)
+_IRQ_CENTRAL_DISCONNECT = const(2)
+_IRQ_GATTS_WRITE = const(3)
+_IRQ_MTU_EXCHANGED = const(21)
+
+_FLAG_WRITE_NO_RESPONSE = const(0x0004)
+_FLAG_WRITE = const(0x0008)
+_FLAG_NOTIFY = const(0x0010)
+
+_ADV_TYPE_FLAGS = const(0x01)
+_ADV_TYPE_NAME = const(0x09)
+_ADV_TYPE_UUID128_COMPLETE = const(0x07)
+
+ADV_INTERVAL_US = 100000
+CONTROL_BUFFER = 128        # Longest request: OP_READ header and a file name
+LOG_PREFIX = 'rcrc24log'    # DataLogger files
+
+_SERVICE = (
+    bluetooth.UUID(SERVICE_UUID),
+    (
+        (bluetooth.UUID(CONTROL_UUID), _FLAG_WRITE | _FLAG_WRITE_NO_RESPONSE | _FLAG_NOTIFY),
+        (bluetooth.UUID(DATA_UUID), _FLAG_NOTIFY),
+    ),
+)
+
+
+def _adv_field(adv_type, value):
+    return struct.pack('BB', len(value) + 1, adv_type) + value
+
+
 class BluetoothComm:
-    def __init__(self):
-        # Setup BLE communication
-        pass
+    """BLE peripheral serving the DataLogger files for download after the flight.
+
+    The GATT service and its protocol are described in logtransfer.py. The
+    IRQ handler only records what happened; poll(), called from the main
+    loop, answers requests and streams file chunks without blocking.
+    """
+
+    def __init__(self, name=DEVICE_NAME, prefix=LOG_PREFIX):
+        self.ble = bluetooth.BLE()
+        self.ble.active(True)
+        self.ble.config(gap_name=name, mtu=BLE_MTU)
+        self.ble.irq(self._irq)
+        ((self._control, self._data),) = self.ble.gatts_register_services((_SERVICE,))
+        self.ble.gatts_set_buffer(self._control, CONTROL_BUFFER, True)
+        self._conn = None
+        self._requests = []
+        self.server = LogTransferServer(prefix, self._notify_control, self._notify_data)
+        # Name in the advertisement, the 128-bit service UUID in the scan response
+        self._adv = _adv_field(_ADV_TYPE_FLAGS, b'\x06') + _adv_field(_ADV_TYPE_NAME, name.encode())
+        self._resp = _adv_field(_ADV_TYPE_UUID128_COMPLETE, bytes(bluetooth.UUID(SERVICE_UUID)))
+        self._advertise()
+
+    def _advertise(self):
+        self.ble.gap_advertise(ADV_INTERVAL_US, adv_data=self._adv, resp_data=self._resp)
+
+    def _irq(self, event, data):
+        if event == _IRQ_CENTRAL_CONNECT:
+            self._conn = data[0]
+            self.server.mtu = DEFAULT_MTU
+            try:
+                # Large notifications from the start, hosts rarely ask themselves
+                self.ble.gattc_exchange_mtu(self._conn)
+            except OSError:
+                pass
+        elif event == _IRQ_CENTRAL_DISCONNECT:
+            self._conn = None
+            self._requests.append(None)
+            self._advertise()
+        elif event == _IRQ_GATTS_WRITE:
+            conn, handle = data[0], data[1]
+            if handle == self._control:
+                self._requests.append(bytes(self.ble.gatts_read(self._control)))
+        elif event == _IRQ_MTU_EXCHANGED:
+            self.server.mtu = data[1]
+
+    def _notify(self, handle, data):
+        if self._conn is None:
+            return False
+        try:
+            self.ble.gatts_notify(self._conn, handle, data)
+            return True
+        except OSError:
+            # Notification queue full, offered again on the next poll
+            return False
+
+    def _notify_control(self, data):
+        return self._notify(self._control, data)
+
+    def _notify_data(self, data):
+        return self._notify(self._data, data)
+
+    @property
+    def connected(self):
+        return self._conn is not None
+
+    def poll(self):
+        """Serve the download host, never blocks."""
+        while self._requests:
+            request = self._requests.pop(0)
+            if request is None:
+                self.server.reset()
+            else:
+                self.server.on_control(request)
+        self.server.poll()
 
     def send_data(self, data):
-        # Code to send data via BLE
-        pass
\ No newline at end of file
+        # Live text to a connected host, skipped while a download runs
+        if self._conn is None or self.server.busy:
+            return False
+        text = str(data).encode()[:self.server.mtu - ATT_HEADER - 1]
+        return self._notify_control(bytes([OP_TEXT]) + text)
@@ -1,7 +1,34 @@
 import json
 import hashlib
-# import uzlib
+from array import array
 from collections import OrderedDict
+try:
+    # C CRC-32 where the port has it (CPython, ubinascii on the ESP32)
+    from binascii import crc32 as _crc32_c
+except ImportError:
+    _crc32_c = None
+try:
+    # CRC-16/CCITT in C, CPython only
+    from binascii import crc_hqx as _crc16_c
+except ImportError:
+    _crc16_c = None
+
+# Byte-at-a-time lookup tables, built once at import
+_CRC16_TABLE = array('H', [0] * 256)
+_CRC32_TABLE = array('I', [0] * 256)
+
+def _init_tables():
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) & 0xffff if crc & 0x8000 else (crc << 1) & 0xffff
+        _CRC16_TABLE[i] = crc
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xEDB88320 if crc & 1 else crc >> 1
+        _CRC32_TABLE[i] = crc
+
+_init_tables()
 
 def serialize_data(data):
     """ Convert data to a JSON formatted string. """
@@ -12,7 +39,8 @@ def deserialize_data(data_string):
     return json.loads(data_string)
 
 def get_data_checksum(data):
-    """ Generate an MD5 checksum for the data. """
+    """ Generate an MD5 checksum for the data (slow: sorts, serialises and hashes,
+        use crc32/crc16_ccitt on the bytes instead). """
     # Convert data to JSON ensuring consistent order
     sorted_dict = OrderedDict(sorted(data.items()))
     sorted_json = json.dumps(sorted_dict)
@@ -28,25 +56,68 @@ def get_data_checksum(data):
 def compute_crc32(data):
     """ Compute CRC32 checksum for given data. """
     serialized_data = serialize_data(data)
-    crc32_result = uzlib.crc32(serialized_data.encode())
-    return crc32_result
+    return crc32(serialized_data.encode())
 
 def decode_hex(hex_str):
     """ Convert a hexadecimal string to bytes. """
     byte_data = bytes.fromhex(hex_str)
     return byte_data
 
-def crc32(data):
-    crc = 0xffffffff
+def crc32(data, crc=0):
+    """ CRC-32 (IEEE 802.3, same as zlib.crc32) over bytes, bytearray or memoryview.
+        Pass the previous result as 'crc' to continue over several chunks.
+    """
+    if _crc32_c is not None:
+        return _crc32_c(data, crc) & 0xffffffff
+    table = _CRC32_TABLE
+    crc ^= 0xffffffff
     for b in data:
-        crc ^= b
-        for _ in range(8):
-            if crc & 1:
-                crc = (crc >> 1) ^ 0xEDB88320
-            else:
-                crc >>= 1
+        crc = table[(crc ^ b) & 0xff] ^ (crc >> 8)
     return crc ^ 0xffffffff
 
+def crc16_ccitt(data, crc=0xffff):
+    """ CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF) used by the radio frames.
+        Pass the previous result as 'crc' to continue over several chunks.
+    """
+    if _crc16_c is not None:
+        return _crc16_c(data, crc)
+    table = _CRC16_TABLE
+    for b in data:
+        crc = ((crc << 8) & 0xff00) ^ table[(crc >> 8) ^ b]
+    return crc
+
+# Stored text records end with a tab and the CRC-32 of the text as 8 hex
+# digits. repr() and JSON never emit a raw tab, so the split is unambiguous.
+RECORD_CRC_SEPARATOR = '\t'
+
+def record_with_crc(text):
+    """ Return one log line: the record text followed by its CRC-32. """
+    return '{}{}{:08x}'.format(text, RECORD_CRC_SEPARATOR, crc32(text.encode()))
+
+def check_record(line):
+    """ Split a log line into (text, valid). 'valid' is None for lines
+        written before records carried a CRC.
+    """
+    line = line.rstrip('\r\n')
+    text, separator, crc = line.rpartition(RECORD_CRC_SEPARATOR)
+    if not separator or len(crc) != 8:
+        return line, None
+    try:
+        return text, int(crc, 16) == crc32(text.encode())
+    except ValueError:
+        return line, None
+
+def hmac_sha256(key, data):
+    """ HMAC-SHA256 (RFC 2104), MicroPython has no hmac module. """
+    if len(key) > 64:
+        key = hashlib.sha256(key).digest()
+    key = key + bytes(64 - len(key))
+    inner = hashlib.sha256(bytes(b ^ 0x36 for b in key))
+    inner.update(data)
+    outer = hashlib.sha256(bytes(b ^ 0x5c for b in key))
+    outer.update(inner.digest())
+    return outer.digest()
+
 # # Example data
 # data = {
 #     'type': "telemetry",
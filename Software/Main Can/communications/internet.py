@@ -1,9 +1,9 @@
 from config import WIFI_CREDENTIALS  # Import your Wi-Fi credentials list
 import network
 import time
-from utils.logger import Logger
+from utils.logger import get_logger
 
-log = Logger()
+log = get_logger()
 
 def connect_to_wifi():
     log.log_event("INFO", "Trying to connect to the internet...")
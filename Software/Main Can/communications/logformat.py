@@ -0,0 +1,215 @@
+""" Binary flight log: the record format shared by the can and the host.
+
+    A log file is a header followed by records, appended and never
+    rewritten. Every record carries its length and a CRC, so a reader
+    skips a damaged one and finds the next.
+
+    Files are named after the session (one per boot) and the segment
+    (one per file of the session), both counted up and never reused, see
+    segment_filename(). A segment ends with a REC_SEAL record, written on
+    a clean close or, after a reset, by the recovery scan at the next
+    boot; bytes between the last good record and the seal are a record
+    torn by the reset.
+
+    File header (big endian):
+        magic      4s  LOG_MAGIC
+        version    B   LOG_VERSION, bumped when the layout changes
+        schema     H   LOG_SCHEMA_HASH of the writer (schema.py)
+        created    I   can time in seconds when the file was opened
+        session    I   boot counter, kept in flash
+        segment    H   file number within the session
+
+    Record:
+        length     H   bytes after this field, the CRC included
+        type       B   REC_*
+        ticks      I   time.ticks_ms() when the record was written
+        payload        depends on the type
+        crc        H   CRC-16/CCITT over length .. payload
+
+    REC_SAMPLE payload:
+        pid        I   sample counter
+        epoch      I   can time in seconds
+        fields         every LOG_FIELDS value in order, NaN when missing
+
+    REC_SEAL payload:
+        end        I   end of the last good record, where a torn one starts
+        records    I   good records before it
+        reason     B   SEAL_CLOSED or SEAL_RECOVERED
+
+    A sample record takes SAMPLE_RECORD_SIZE (169) bytes, the text line
+    it replaces about 1 KB. Sample records all have the same size, the
+    host reads a whole file of them as one NumPy array.
+"""
+import struct
+try:
+    from communications.dataintegrity import crc16_ccitt
+    from communications.schema import LOG_FIELDS, LOG_SCHEMA_HASH
+except ImportError:
+    # Host copy keeps the modules next to each other
+    from dataintegrity import crc16_ccitt
+    from schema import LOG_FIELDS, LOG_SCHEMA_HASH
+
+LOG_MAGIC = b'CLOG'
+LOG_VERSION = 2
+LOG_EXTENSION = '.bin'
+
+FILE_HEADER_FORMAT = '>4sBHIIH'
+FILE_HEADER_SIZE = struct.calcsize(FILE_HEADER_FORMAT)
+
+REC_SAMPLE = 0x01
+REC_SEAL = 0x02
+
+SEAL_CLOSED = 0
+SEAL_RECOVERED = 1
+
+LENGTH_SIZE = 2
+CRC_SIZE = 2
+RECORD_HEADER_FORMAT = '>HBI'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+SAMPLE_FORMAT = RECORD_HEADER_FORMAT + 'II' + ''.join(field[3] for field in LOG_FIELDS)
+SAMPLE_RECORD_SIZE = struct.calcsize(SAMPLE_FORMAT) + CRC_SIZE
+SEAL_FORMAT = RECORD_HEADER_FORMAT + 'IIB'
+SEAL_RECORD_SIZE = struct.calcsize(SEAL_FORMAT) + CRC_SIZE
+
+NAN = float('nan')
+
+
+def segment_filename(base, session, segment):
+    # Zero padded, so the names sort in the order they were written
+    return "{}_{:05d}_{:04d}{}".format(base, session, segment, LOG_EXTENSION)
+
+
+def parse_segment_filename(base, name):
+    """ (session, segment) of a segment_filename() name, None for other files. """
+    if not name.startswith(base + '_') or not name.endswith(LOG_EXTENSION):
+        return None
+    parts = name[len(base) + 1:-len(LOG_EXTENSION)].split('_')
+    if len(parts) != 2 or not parts[0].isdigit() or not parts[1].isdigit():
+        return None
+    return int(parts[0]), int(parts[1])
+
+
+def file_header(created, session=0, segment=0):
+    return struct.pack(FILE_HEADER_FORMAT, LOG_MAGIC, LOG_VERSION, LOG_SCHEMA_HASH, int(created) & 0xFFFFFFFF,
+                       session & 0xFFFFFFFF, segment & 0xFFFF)
+
+
+def read_file_header(data):
+    """ Return {'version', 'schema', 'created', 'session', 'segment'}, raises
+        ValueError when 'data' does not start with a log header this module
+        can read.
+    """
+    if len(data) < FILE_HEADER_SIZE:
+        raise ValueError("Log file too short ({} bytes)".format(len(data)))
+    magic, version, schema = struct.unpack_from('>4sBH', data, 0)
+    if magic != LOG_MAGIC:
+        raise ValueError("Not a binary flight log")
+    if version != LOG_VERSION:
+        raise ValueError("Unsupported log version {}".format(version))
+    if schema != LOG_SCHEMA_HASH:
+        raise ValueError("Log uses schema {:04x}, expected {:04x}".format(schema, LOG_SCHEMA_HASH))
+    created, session, segment = struct.unpack_from(FILE_HEADER_FORMAT, data, 0)[3:]
+    return {'version': version, 'schema': schema, 'created': created, 'session': session, 'segment': segment}
+
+
+def _number(value):
+    # bool is an int, but no sensor reports one; strings like 'Not Connected' are missing values
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return NAN
+
+
+def _sample_values(data):
+    values = []
+    for group, sensor, keys, _ in LOG_FIELDS:
+        value = data.get(group)
+        if sensor is not None:
+            value = value.get(sensor) if isinstance(value, dict) else None
+        if keys is None:
+            values.append(_number(value))
+        elif isinstance(value, dict):
+            for key in keys:
+                values.append(_number(value.get(key)))
+        else:
+            values.extend(NAN for _ in keys)
+    return values
+
+
+def encode_sample(record, ticks, pid, epoch, data):
+    """ Pack one sample into 'record', a bytearray of SAMPLE_RECORD_SIZE
+        reused for every sample. 'data' is the full-resolution sensor data
+        with the 'esp32' group added.
+    """
+    struct.pack_into(SAMPLE_FORMAT, record, 0, SAMPLE_RECORD_SIZE - LENGTH_SIZE, REC_SAMPLE, ticks & 0xFFFFFFFF,
+                     pid & 0xFFFFFFFF, int(epoch) & 0xFFFFFFFF, *_sample_values(data))
+    end = SAMPLE_RECORD_SIZE - CRC_SIZE
+    struct.pack_into('>H', record, end, crc16_ccitt(memoryview(record)[:end]))
+    return record
+
+
+def read_record(data, offset):
+    """ Check the record at 'offset'. Returns (type, ticks, payload start,
+        end of the record); raises ValueError on a torn or corrupt record.
+    """
+    if offset + RECORD_HEADER_SIZE + CRC_SIZE > len(data):
+        raise ValueError("Record cut short at {}".format(offset))
+    length, rec_type, ticks = struct.unpack_from(RECORD_HEADER_FORMAT, data, offset)
+    end = offset + LENGTH_SIZE + length
+    if length < RECORD_HEADER_SIZE - LENGTH_SIZE + CRC_SIZE or end > len(data):
+        raise ValueError("Bad record length {} at {}".format(length, offset))
+    if crc16_ccitt(memoryview(data)[offset:end - CRC_SIZE]) != struct.unpack_from('>H', data, end - CRC_SIZE)[0]:
+        raise ValueError("Record CRC mismatch at {}".format(offset))
+    return rec_type, ticks, offset + RECORD_HEADER_SIZE, end
+
+
+def encode_seal(ticks, end, records, reason):
+    """ The REC_SEAL record that closes a segment. """
+    record = bytearray(SEAL_RECORD_SIZE)
+    struct.pack_into(SEAL_FORMAT, record, 0, SEAL_RECORD_SIZE - LENGTH_SIZE, REC_SEAL, ticks & 0xFFFFFFFF,
+                     end, records, reason)
+    struct.pack_into('>H', record, SEAL_RECORD_SIZE - CRC_SIZE, crc16_ccitt(memoryview(record)[:-CRC_SIZE]))
+    return record
+
+
+def read_seal(data, offset):
+    """ (end, records, reason) of the seal at 'offset', None when there is
+        no intact seal there.
+    """
+    try:
+        rec_type, _, start, end = read_record(data, offset)
+    except ValueError:
+        return None
+    if rec_type != REC_SEAL or end - start != SEAL_RECORD_SIZE - RECORD_HEADER_SIZE:
+        return None
+    return struct.unpack_from('>IIB', data, start)
+
+
+def scan_file(file, size):
+    """ Walk the records of an open log file, one record in RAM at a time.
+        Returns (end of the last good record, good records). Stops at the
+        first record that does not check out, which after a reset is the
+        torn one.
+    """
+    buf = bytearray(max(SAMPLE_RECORD_SIZE, SEAL_RECORD_SIZE))
+    view = memoryview(buf)
+    file.seek(0)
+    if file.readinto(view[:FILE_HEADER_SIZE]) != FILE_HEADER_SIZE:
+        raise ValueError("Log file too short")
+    read_file_header(buf)
+    offset = FILE_HEADER_SIZE
+    records = 0
+    while offset + LENGTH_SIZE <= size:
+        if file.readinto(view[:LENGTH_SIZE]) != LENGTH_SIZE:
+            break
+        length = struct.unpack_from('>H', buf, 0)[0]
+        if LENGTH_SIZE + length > len(buf) or offset + LENGTH_SIZE + length > size:
+            break
+        if file.readinto(view[LENGTH_SIZE:LENGTH_SIZE + length]) != length:
+            break
+        try:
+            read_record(view[:LENGTH_SIZE + length], 0)
+        except ValueError:
+            break
+        offset += LENGTH_SIZE + length
+        records += 1
+    return offset, records
@@ -0,0 +1,296 @@
+""" Log download over BLE: the protocol shared by the can and the host.
+
+    The can serves its DataLogger files through one GATT service with two
+    characteristics: CONTROL, written by the host and notified with the
+    answers, and DATA, notified with the file chunks. The transport only
+    needs to deliver bytes, so LogTransferServer and LogTransferClient
+    run on any stand-in for bluetooth or bleak as well.
+
+    Control requests (host -> can, big endian):
+        OP_LIST                        list the log files
+        OP_READ   offset I, window H,  stream 'name' from 'offset',
+                  name                 'window' chunks per acknowledgement
+        OP_ACK    offset I             everything before 'offset' arrived
+        OP_ABORT                       stop the transfer
+
+    Control answers (can -> host):
+        OP_LIST   STATUS_OK, size I, name   one per file
+        OP_LIST   STATUS_END                after the last one
+        OP_READ   status, size I            the read was accepted or not
+        OP_TEXT   text                      live data, see send_data()
+
+    Data chunk:
+        offset     I   file offset of the payload
+        crc        H   CRC-16/CCITT over offset and payload
+        payload        up to MTU - 3 - CHUNK_HEADER_SIZE bytes; empty at
+                       the end of the file
+
+    The can sends a window of chunks and waits for OP_ACK. A gap or a bad
+    CRC makes the host acknowledge the offset it still expects, and the
+    can resumes from there (go-back-N). An acknowledgement of the whole
+    file ends the read, whether or not the empty end chunk arrived. A read
+    that starts at the size of a partial download resumes it after a
+    disconnect.
+"""
+import os
+import struct
+try:
+    from communications.dataintegrity import crc16_ccitt
+except ImportError:
+    # Host copy keeps dataintegrity.py next to this module
+    from dataintegrity import crc16_ccitt
+
+SERVICE_UUID = 'c5a70001-2024-4cd0-8a11-43414e534154'
+CONTROL_UUID = 'c5a70002-2024-4cd0-8a11-43414e534154'
+DATA_UUID = 'c5a70003-2024-4cd0-8a11-43414e534154'
+DEVICE_NAME = 'CanSat2024'
+
+OP_LIST = 0x01
+OP_READ = 0x02
+OP_ACK = 0x03
+OP_ABORT = 0x04
+OP_TEXT = 0x05
+
+STATUS_OK = 0
+STATUS_END = 1
+STATUS_NOT_FOUND = 2
+STATUS_BAD_REQUEST = 3
+
+LIST_FORMAT = '>BBI'
+LIST_SIZE = struct.calcsize(LIST_FORMAT)
+READ_FORMAT = '>BIH'
+READ_SIZE = struct.calcsize(READ_FORMAT)
+ACK_FORMAT = '>BI'
+CHUNK_HEADER_FORMAT = '>IH'
+CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_HEADER_FORMAT)
+
+ATT_HEADER = 3              # Notification opcode and handle
+DEFAULT_MTU = 23            # Before the MTU exchange
+BLE_MTU = 247               # Requested, fits one LL packet with data length extension
+WINDOW = 16                 # Chunks per acknowledgement
+MAX_WINDOW = 64
+
+
+def chunk_payload_size(mtu):
+    return mtu - ATT_HEADER - CHUNK_HEADER_SIZE
+
+
+def chunk_crc(chunk, end):
+    """ CRC of a chunk without its crc field, 'end' is the end of the payload. """
+    crc = crc16_ccitt(memoryview(chunk)[:4])
+    return crc16_ccitt(memoryview(chunk)[CHUNK_HEADER_SIZE:end], crc)
+
+
+def _file_size(name):
+    try:
+        return os.stat(name)[6]
+    except OSError:
+        return None
+
+
+class LogTransferServer:
+    """ Can side. notify_control and notify_data send one notification and
+        return False when the BLE stack has no room, the same bytes are
+        offered again by the next poll().
+    """
+
+    def __init__(self, prefix, notify_control, notify_data, listdir=None):
+        self.prefix = prefix
+        self.notify_control = notify_control
+        self.notify_data = notify_data
+        self._listdir = listdir
+        self.mtu = DEFAULT_MTU
+        self._answers = []
+        self._chunk = bytearray(CHUNK_HEADER_SIZE + chunk_payload_size(512))
+        self._chunk_len = 0         # Built chunk still to be notified
+        self._file = None
+        self._size = 0
+        self._offset = 0
+        self._window = WINDOW
+        self._credit = 0
+        self.sent_bytes = 0
+
+    @property
+    def busy(self):
+        return self._file is not None
+
+    def files(self):
+        names = self._listdir() if self._listdir else os.listdir()
+        return sorted(name for name in names if name.startswith(self.prefix))
+
+    def reset(self):
+        """ Forget the transfer, e.g. when the host disconnected. """
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._answers = []
+        self._chunk_len = 0
+        self._credit = 0
+
+    def on_control(self, request):
+        """ Handle a request written to CONTROL. """
+        if not request:
+            return
+        op = request[0]
+        if op == OP_LIST:
+            for name in self.files():
+                size = _file_size(name)
+                if size is not None:
+                    self._answers.append(struct.pack(LIST_FORMAT, OP_LIST, STATUS_OK, size) + name.encode())
+            self._answers.append(struct.pack(LIST_FORMAT, OP_LIST, STATUS_END, 0))
+        elif op == OP_READ and len(request) > READ_SIZE:
+            self.reset()
+            _, offset, window = struct.unpack_from(READ_FORMAT, request, 0)
+            name = bytes(request[READ_SIZE:]).decode()
+            size = _file_size(name) if name.startswith(self.prefix) and '/' not in name else None
+            if size is None or offset > size:
+                self._answers.append(struct.pack(LIST_FORMAT, OP_READ, STATUS_NOT_FOUND if size is None else STATUS_BAD_REQUEST, 0))
+                return
+            self._file = open(name, 'rb')
+            self._size = size
+            self._window = max(1, min(window, MAX_WINDOW))
+            self._seek(offset)
+            self._answers.append(struct.pack(LIST_FORMAT, OP_READ, STATUS_OK, size))
+        elif op == OP_ACK and len(request) >= 5 and self._file is not None:
+            offset = struct.unpack_from(ACK_FORMAT, request, 0)[1]
+            if offset >= self._size:
+                # The host has the whole file
+                self.reset()
+            else:
+                self._seek(offset)
+        elif op == OP_ABORT:
+            self.reset()
+
+    def _seek(self, offset):
+        self._file.seek(offset)
+        self._offset = offset
+        self._chunk_len = 0
+        self._credit = self._window
+
+    def _build_chunk(self):
+        size = min(chunk_payload_size(self.mtu), len(self._chunk) - CHUNK_HEADER_SIZE)
+        view = memoryview(self._chunk)
+        read = self._file.readinto(view[CHUNK_HEADER_SIZE:CHUNK_HEADER_SIZE + size]) or 0
+        end = CHUNK_HEADER_SIZE + read
+        struct.pack_into('>I', self._chunk, 0, self._offset)
+        struct.pack_into('>H', self._chunk, 4, chunk_crc(self._chunk, end))
+        self._chunk_len = end
+        self._offset += read
+
+    def poll(self):
+        """ Send the pending answers, then chunks until the window is used up
+            or the BLE stack is full. Never blocks.
+        """
+        while self._answers:
+            if not self.notify_control(self._answers[0]):
+                return
+            self._answers.pop(0)
+        while self._file is not None and self._credit:
+            if not self._chunk_len:
+                self._build_chunk()
+            if not self.notify_data(memoryview(self._chunk)[:self._chunk_len]):
+                return
+            self.sent_bytes += self._chunk_len - CHUNK_HEADER_SIZE
+            if self._chunk_len == CHUNK_HEADER_SIZE:
+                # End of file sent, wait for the final acknowledgement
+                self._credit = 0
+            else:
+                self._credit -= 1
+            self._chunk_len = 0
+
+
+class LogTransferClient:
+    """ Host side: reassembles files into 'out_dir'. Every method returns
+        the request to write to CONTROL next, or None.
+    """
+
+    def __init__(self, out_dir='.', window=WINDOW):
+        self.out_dir = out_dir
+        self.window = window
+        self.files = {}
+        self.listed = False
+        self.done = True
+        self.error = None
+        self.bad_chunks = 0
+        self._file = None
+        self._path = None
+        self._expected = 0
+        self._received = 0
+        self._size = None
+
+    def list_request(self):
+        self.files = {}
+        self.listed = False
+        return bytes([OP_LIST])
+
+    def start(self, name):
+        """ Request 'name', resuming a partial download. None when it is already complete. """
+        path = os.path.join(self.out_dir, name)
+        if os.path.exists(path) and os.path.getsize(path) == self.files.get(name):
+            return None
+        self._path = path
+        self._file = open(path + '.part', 'ab')
+        self._expected = self._file.tell()
+        self._received = 0
+        self._size = None
+        self.bad_chunks = 0
+        self.done = False
+        self.error = None
+        return struct.pack(READ_FORMAT, OP_READ, self._expected, self.window) + name.encode()
+
+    @property
+    def offset(self):
+        return self._expected
+
+    def on_control(self, answer):
+        if len(answer) < LIST_SIZE:
+            return None
+        op, status, size = struct.unpack_from(LIST_FORMAT, answer, 0)
+        if op == OP_LIST:
+            if status == STATUS_END:
+                self.listed = True
+            else:
+                self.files[bytes(answer[LIST_SIZE:]).decode()] = size
+        elif op == OP_READ and status == STATUS_OK:
+            self._size = size
+        elif op == OP_READ:
+            self.error = status
+            self._close(False)
+            if os.path.getsize(self._path + '.part') == 0:
+                os.remove(self._path + '.part')
+        return None
+
+    def on_data(self, chunk):
+        if self.done or len(chunk) < CHUNK_HEADER_SIZE:
+            return None
+        offset, crc = struct.unpack_from(CHUNK_HEADER_FORMAT, chunk, 0)
+        self._received += 1
+        if crc != chunk_crc(chunk, len(chunk)):
+            self.bad_chunks += 1
+        elif offset == self._expected:
+            if len(chunk) == CHUNK_HEADER_SIZE:
+                self._close(True)
+                return struct.pack(ACK_FORMAT, OP_ACK, offset)
+            self._file.write(chunk[CHUNK_HEADER_SIZE:])
+            self._expected += len(chunk) - CHUNK_HEADER_SIZE
+        elif len(chunk) == CHUNK_HEADER_SIZE:
+            # End of file, but something before it went missing
+            return self.timeout()
+        if self._received >= self.window:
+            return self.timeout()
+        return None
+
+    def timeout(self):
+        """ Acknowledge what arrived, also when the window went missing. """
+        self._received = 0
+        if not self.done and self._expected == self._size:
+            # Only the end-of-file chunk is missing; the can ends the read on this acknowledgement
+            self._close(True)
+        return struct.pack(ACK_FORMAT, OP_ACK, self._expected)
+
+    def _close(self, complete):
+        self._file.close()
+        self._file = None
+        self.done = True
+        if complete:
+            os.replace(self._path + '.part', self._path)
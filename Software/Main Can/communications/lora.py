@@ -1,11 +1,48 @@
-from machine import UART, Pin
+from machine import UART, Pin, reset_cause, PWRON_RESET
 import time
 import json
+import ubinascii
 from collections import OrderedDict
-from utils.logger import Logger
+from utils.logger import get_logger
+from communications.telemetry import BatchEncoder
 
-log = Logger()
-loraLog = Logger(log_file="LoraLog.txt")
+log = get_logger()
+loraLog = get_logger("LoraLog.txt")
+
+# 'radio tx <hex payload>\r\n' for the largest RN2483 payload
+TX_PREFIX = b'radio tx '
+MAX_PAYLOAD = 255
+
+# Driver states
+RADIO_IDLE = 0
+RADIO_WAIT_RESPONSE = 1     # Command written, waiting for its first response
+RADIO_WAIT_DONE = 2         # 'ok' to radio tx/rx, waiting for radio_tx_ok/radio_rx/radio_err
+
+# Queued request kinds
+REQ_CMD = 0
+REQ_TX = 1
+REQ_RX = 2
+
+CMD_TIMEOUT_MS = 1500
+RADIO_TIMEOUT_MS = 15000    # Longest SF12 packet plus margin, the radio wdt catches the rest
+BUSY_BACKOFF_MS = 50        # Doubled on every consecutive 'busy'
+BUSY_BACKOFF_MAX_MS = 2000
+BUSY_MAX_RETRIES = 6
+QUEUE_LEN = 8
+
+# Request priorities, lower goes first. A request that becomes due jumps
+# ahead of lower-priority ones still waiting, so critical telemetry never
+# queues behind bulk data.
+PRIO_CONTROL = 0            # Module commands and telecommand acknowledgements
+PRIO_CRITICAL = 1           # Position, altitude, battery
+PRIO_BULK = 2               # IMU, temperatures, FEC parity; dropped when stale
+PRIO_LISTEN = 3             # Receive windows, after everything queued with them
+PRIO_WINDOW = -1            # A receive window whose announcement is on air, nothing goes between
+BULK_MAX_AGE_MS = 2000      # Bulk frames not on air by then are dropped
+
+# Batching mode: reduced samples share one packet and its preamble
+BATCH_SAMPLES = 10          # Samples per batch frame (BATCH_MAX_SAMPLES at most)
+BATCH_LATENCY_MS = 3000     # Oldest sample waits no longer than this
 
 class LoRaComm:
     commands = OrderedDict([
@@ -51,38 +88,306 @@ class LoRaComm:
         self.uart = UART(2, baudrate=baudrate, tx=Pin(tx_pin), rx=Pin(rx_pin))
         time.sleep(0.5)  # Allow some time for the UART setup
         self.freq = freq
+        # Reusable command buffer, the TX path never builds command strings
+        self._tx_buf = bytearray(len(TX_PREFIX) + 2 * MAX_PAYLOAD + 2)
+        self._tx_buf[:len(TX_PREFIX)] = TX_PREFIX
+        self._tx_view = memoryview(self._tx_buf)
+
+        # Command/response state machine, advanced by poll()
+        self.state = RADIO_IDLE
+        self._queue = []
+        self._current = None
+        self._rx = b''
+        self._deadline = 0
+        self._radio_start = 0
+        self._resume_at = time.ticks_ms()
+        self.events = []
+
+        # Statistics
+        self.tx_ok = 0
+        self.tx_err = 0
+        self.dropped = 0
+        self.last_time_on_air = None
+
+        # Filled in by init_lora()
+        self.version = None
+        self.hweui = None
+        self.init_ms = None
+
+        # Batching mode, off until enable_batching()
+        self.batch = None
+        self.batch_latency_ms = BATCH_LATENCY_MS
+
+        # Shared channel, a tdma.TdmaSchedule holds packets until the can's slot
+        self.tdma = None
+
         self.init_lora()
 
+    # --- Non-blocking driver -------------------------------------------------
 
-    def send_lora_cmd(self, cmd):
-        """Send a command to the RN2483 and handle busy responses."""
-        retry = True
-        full_cmd = "{}\x0d\x0a".format(cmd)
-        self.uart.write(full_cmd.encode('ASCII'))
-        time.sleep(0.2)
-        while retry:
-            response = self.uart.readline()
-            if response is None:
-                loraLog.log_event("WARNING", "No response received, possibly due to timeout or disconnection.")
-                break  # Exit the loop if no data is received
-                
-            #print(response)
-            resp=response.decode("utf-8").replace("\r\n","")
-            if "busy" in resp:
-                loraLog.log_event("WARNING", "Busy LoRa chip")
+    def _enqueue(self, kind, data, tag, priority=PRIO_CONTROL, max_age_ms=None):
+        deadline = None if max_age_ms is None else time.ticks_add(time.ticks_ms(), max_age_ms)
+        request = [kind, data, tag, 0, priority, deadline]
+        # Behind everything of the same or higher priority, FIFO within a priority
+        index = len(self._queue)
+        while index and self._queue[index - 1][4] > priority:
+            index -= 1
+        self._queue.insert(index, request)
+        if len(self._queue) > QUEUE_LEN:
+            # Drop the oldest request of the lowest priority, the least useful one
+            lowest = self._queue[-1][4]
+            for old in self._queue:
+                if old[4] == lowest:
+                    break
+            self._queue.remove(old)
+            self.dropped += 1
+            self.events.append(('dropped', old[2], None))
+
+    def _expire(self, now):
+        """Drop requests that waited past their deadline, late data is worth less than airtime."""
+        for request in [r for r in self._queue if r[5] is not None and time.ticks_diff(now, r[5]) > 0]:
+            self._queue.remove(request)
+            self.events.append(('stale', request[2], None))
+
+    def command(self, cmd, tag=None):
+        """Queue a command; its response arrives as a ('cmd', tag, response) event."""
+        self._enqueue(REQ_CMD, "{}\x0d\x0a".format(cmd).encode('ASCII'), tag)
+
+    def receive(self, symbols, tag=None, priority=PRIO_LISTEN):
+        """Queue a receive window of 'symbols' LoRa symbols (not ms, see
+        telecommand.rx_window_symbols); ends with an ('rx', tag, hex data) or
+        ('rx_err', tag, ...) event."""
+        self._enqueue(REQ_RX, "radio rx {}\x0d\x0a".format(symbols).encode('ASCII'), tag, priority)
+
+    def listen(self, frame, symbols, tag=None, rx_tag=None):
+        """Queue 'frame' and a receive window of 'symbols' right behind it.
+
+        The frame (telecommand.encode_listen) tells the base station the
+        window is open, so it has to go out last before the window: once it
+        is dispatched the window is pinned to the queue head.
+        """
+        self.transmit_frame(frame, tag, PRIO_LISTEN)
+        self.receive(symbols, rx_tag)
+
+    def _dispatch(self, now):
+        request = self._queue.pop(0)
+        kind, data = request[0], request[1]
+        if kind == REQ_TX and request[4] == PRIO_LISTEN and self._queue and self._queue[0][0] == REQ_RX:
+            self._queue[0][4] = PRIO_WINDOW
+        if kind == REQ_TX:
+            # Hex encode the payload behind the 'radio tx ' prefix
+            start = len(TX_PREFIX)
+            end = start + 2 * len(data)
+            self._tx_buf[start:end] = ubinascii.hexlify(data)
+            self._tx_buf[end] = 0x0d
+            self._tx_buf[end + 1] = 0x0a
+            data = self._tx_view[:end + 2]
+        self.uart.write(data)
+        self._current = request
+        self.state = RADIO_WAIT_RESPONSE
+        self._deadline = time.ticks_add(now, CMD_TIMEOUT_MS)
+
+    def _finish(self, event):
+        self.events.append(event)
+        self._current = None
+        self.state = RADIO_IDLE
+
+    def _busy(self, now):
+        """The module refused the request, retry it later with exponential backoff."""
+        request = self._current
+        request[3] += 1
+        if request[3] > BUSY_MAX_RETRIES:
+            self._finish(('busy', request[2], request[3]))
+            return
+        self._queue.insert(0, request)
+        self._current = None
+        self.state = RADIO_IDLE
+        self._resume_at = time.ticks_add(now, min(BUSY_BACKOFF_MS << (request[3] - 1), BUSY_BACKOFF_MAX_MS))
+
+    def _handle(self, line, now):
+        request = self._current
+        if request is None:
+            self.events.append(('unsolicited', None, line))
+            return
+        kind, tag = request[0], request[2]
+        if self.state == RADIO_WAIT_RESPONSE:
+            if line == 'busy':
+                self._busy(now)
+            elif kind == REQ_CMD:
+                self._finish(('cmd', tag, line))
+            elif line == 'ok':
+                # Accepted, the packet is on air (or the receiver open) now
+                self.state = RADIO_WAIT_DONE
+                self._radio_start = now
+                self._deadline = time.ticks_add(now, RADIO_TIMEOUT_MS)
+            elif kind == REQ_TX:
+                self.tx_err += 1
+                self._finish(('tx_err', tag, line))
             else:
-                #loraLog.log_event("INFO", "Command: {} | Response: {}".format("radio tx", resp))
-                retry = False   
-            
-#             return None
+                self._finish(('rx_err', tag, line))
+        elif self.state == RADIO_WAIT_DONE:
+            elapsed = time.ticks_diff(now, self._radio_start)
+            if line == 'radio_tx_ok':
+                self.tx_ok += 1
+                self.last_time_on_air = elapsed
+                self._finish(('tx_ok', tag, elapsed))
+            elif line.startswith('radio_rx'):
+                self._finish(('rx', tag, line[8:].strip()))
+            elif kind == REQ_TX:
+                self.tx_err += 1
+                self._finish(('tx_err', tag, line))
+            else:
+                # radio_err after a receive window means nothing was received
+                self._finish(('rx_err', tag, line))
+
+    def _step(self):
+        now = time.ticks_ms()
+        pending = self.uart.any()
+        if pending:
+            chunk = self.uart.read(pending)
+            if chunk:
+                self._rx += chunk
+        end = self._rx.find(b'\r\n')
+        while end >= 0:
+            line = self._rx[:end]
+            self._rx = self._rx[end + 2:]
+            try:
+                self._handle(line.decode('utf-8'), now)
+            except UnicodeError:
+                loraLog.log_event("WARNING", "Lora - Undecodable response", response=line)
+            end = self._rx.find(b'\r\n')
+
+        if self.state != RADIO_IDLE and time.ticks_diff(now, self._deadline) > 0:
+            request = self._current
+            if request[0] == REQ_TX:
+                self.tx_err += 1
+            self._finish(('timeout', request[2], self.state))
+
+        if self.state == RADIO_IDLE and self._queue and time.ticks_diff(now, self._resume_at) >= 0:
+            self._expire(now)
+            if self._queue and self._queue[0][0] == REQ_TX and self.tdma is not None:
+                wait = self.tdma.wait_ms(len(self._queue[0][1]), now)
+                if wait:
+                    # Not our slot, or the packet would run past its end
+                    self._resume_at = time.ticks_add(now, wait)
+                    return
+            if self._queue:
+                self._dispatch(now)
+
+    def poll(self):
+        """Advance the radio without blocking and return the events since the last call.
+
+        Events are (event, tag, detail) tuples: ('tx_ok', tag, time on air in ms),
+        ('tx_err', tag, response), ('rx', tag, hex data), ('rx_err', tag, response),
+        ('cmd', tag, response), ('busy', tag, retries), ('timeout', tag, state),
+        ('dropped', tag, None), ('stale', tag, None) and ('unsolicited', None, line).
+        """
+        self._step()
+        events = self.events
+        self.events = []
+        return events
+
+    @property
+    def idle(self):
+        return self.state == RADIO_IDLE and not self._queue
+
+    # --- Blocking helpers, for setup and diagnostics only ----------------------
+
+    def run_commands(self, cmds, timeout_ms=CMD_TIMEOUT_MS * 2):
+        """Send commands back to back and wait for all their responses.
+
+        Each command is written as soon as the module answered the one
+        before, so no time is lost on fixed delays. Returns the responses in
+        order, None for a command that was not answered.
+        """
+        batch = object()
+        responses = [None] * len(cmds)
+        queued = 0
+        answered = 0
+        last_event = time.ticks_ms()
+        while answered < len(cmds) and time.ticks_diff(time.ticks_ms(), last_event) < timeout_ms + BUSY_BACKOFF_MAX_MS:
+            # Keep the queue topped up, the driver paces the commands on the responses
+            while queued < len(cmds) and len(self._queue) < QUEUE_LEN:
+                self.command(cmds[queued], (batch, queued))
+                queued += 1
+            self._step()
+            for event in [e for e in self.events if type(e[1]) is tuple and e[1][0] is batch]:
+                self.events.remove(event)
+                index = event[1][1]
+                if event[0] == 'cmd':
+                    responses[index] = event[2]
+                else:
+                    loraLog.log_event("WARNING", "Lora - Command not answered", command=cmds[index], event=event[0])
+                answered += 1
+                last_event = time.ticks_ms()
+            if answered < len(cmds):
+                time.sleep_ms(1)
+        if answered < len(cmds):
+            loraLog.log_event("WARNING", "No response received, possibly due to timeout or disconnection.", command=cmds[answered])
+        return responses
+
+    def send_lora_cmd(self, cmd, timeout_ms=CMD_TIMEOUT_MS * 2):
+        """Send a command to the RN2483 and wait for its response (None if there is none)."""
+        return self.run_commands([cmd], timeout_ms)[0]
+
+    def _warm_start(self):
+        """True when only the ESP32 restarted: the module is powered and answering,
+        so it still holds the settings from before."""
+        if reset_cause() == PWRON_RESET:
+            return False
+        self.version = self.send_lora_cmd('sys get ver', CMD_TIMEOUT_MS)
+        return self.version is not None and self.version.startswith('RN2483')
+
+    @staticmethod
+    def _same_setting(wanted, current):
+        """Compare a 'radio set' value with the 'radio get' answer, e.g. '125' and '125.0'."""
+        if current is None:
+            return False
+        if wanted == current:
+            return True
+        try:
+            return float(wanted) == float(current)
+        except ValueError:
+            return False
 
     def init_lora(self):
+        """Configure the module for raw LoRa, as fast as the module allows.
+
+        After a warm start (ESP32 reset, module still powered) 'sys reset' is
+        skipped and the 'radio set' commands whose value 'radio get' already
+        reports are not sent again. Every command waits for the previous
+        response only. The time taken is kept in init_ms and logged.
+        """
+        start = time.ticks_ms()
         log.log_event("INFO", "Starting LoRa on {} MHz".format(round(self.freq/1000000,2)))
         loraLog.log_event("INFO", "Starting LoRa on {} MHz".format(round(self.freq/1000000,2)))
         print("  + LoRa setup started on {} MHz".format(round(self.freq/1000000,2)))
         # print(" [ LORA ] Starting LoRa on {} MHz".format(round(self.freq/1000000,2)))
-        for cmd, expected_resp in LoRaComm.commands.items():
-            response = self.send_lora_cmd(cmd)
+        # Whatever the module printed before we started listening
+        if self.uart.any():
+            self.uart.read(self.uart.any())
+
+        warm = self._warm_start()
+        if warm:
+            setup = [(cmd, expected) for cmd, expected in LoRaComm.commands.items() if cmd != 'sys reset']
+            # Radio settings are only readable once the LoRaWAN stack is paused
+            sets = [(cmd, expected) for cmd, expected in setup if cmd.startswith('radio set ')]
+            others = [(cmd, expected) for cmd, expected in setup if not cmd.startswith('radio set ')]
+            responses = self.run_commands([cmd for cmd, _ in others] + ['radio get ' + cmd.split()[2] for cmd, _ in sets])
+            current = responses[len(others):]
+            needed = [(cmd, expected) for (cmd, expected), value in zip(sets, current)
+                      if not self._same_setting(cmd.split()[3], value)]
+            checks = list(zip(others, responses)) + list(zip(needed, self.run_commands([cmd for cmd, _ in needed])))
+        else:
+            setup = list(LoRaComm.commands.items())
+            checks = list(zip(setup, self.run_commands([cmd for cmd, _ in setup])))
+            needed = [(cmd, expected) for cmd, expected in setup if cmd.startswith('radio set ')]
+
+        for (cmd, expected_resp), response in checks:
+            if cmd == 'sys get hweui':
+                self.hweui = response
+            elif cmd == 'sys reset' and response is not None:
+                self.version = response
             if response is None:
                 loraLog.log_event("WARNING", f"Lora - No response for command: {cmd}")
                 continue
@@ -91,23 +396,26 @@ class LoRaComm:
             else:
                 loraLog.log_event("INFO", "Lora - Command executed successfully", command = cmd, response=response)
 
+        self.init_ms = time.ticks_diff(time.ticks_ms(), start)
+        log.log_event("INFO", "LoRa setup done", init_ms=self.init_ms, warm=warm, settings_changed=len(needed))
+        loraLog.log_event("INFO", "LoRa setup done", init_ms=self.init_ms, warm=warm, settings_changed=len(needed))
+        print("  + LoRa setup done in {} ms ({} start, {} settings changed)".format(self.init_ms, "warm" if warm else "cold", len(needed)))
+
     def get_hardware_eui(self):
-        """Get the hardware EUI from the module."""
-        return self.send_lora_cmd('sys get hweui')
+        """Get the hardware EUI from the module, read once during init_lora()."""
+        if self.hweui is None:
+            self.hweui = self.send_lora_cmd('sys get hweui')
+        return self.hweui
 
     def get_version(self):
         """Get the firmware version of the module."""
-        return self.send_lora_cmd('sys get ver')
+        if self.version is None:
+            self.version = self.send_lora_cmd('sys get ver')
+        return self.version
     
     def to_hex(self, data):
-        """Convert a string to hex-encoded format without using zfill."""
-        hex_str = ''
-        for char in data:
-            hex_char = hex(ord(char))[2:]  # Convert character to hex and remove the '0x'
-            if len(hex_char) < 2:
-                hex_char = '0' + hex_char  # Manually add zero padding if necessary
-            hex_str += hex_char
-        return hex_str
+        """Convert a string to hex-encoded format."""
+        return ubinascii.hexlify(data.encode()).decode()
     
     def transmit(self, data, confirm=False):
         """Transmit data as a hex-encoded string using LoRaWAN.
@@ -122,14 +430,66 @@ class LoRaComm:
 #         response = self.send_lora_cmd(f'radio tx 48656C6C6F')
 #         print('Sent: radio tx 48656C6C6F => Transmission Response:', response)
         
-        # Convert the string data to hex
-        hex_data = self.to_hex(data)
         cmd_type = 'cnf' if confirm else 'uncnf'
         # Send the data over LoRaWAN
-        #print(f'radio tx {hex_data}')
-        response = self.send_lora_cmd(f'radio tx {hex_data}')
+        self.transmit_frame(data.encode())
         # response = self.send_lora_cmd(f'mac tx {cmd_type} 1 {hex_data}')
         
+    def transmit_frame(self, frame, tag=None, priority=PRIO_CRITICAL, max_age_ms=None):
+        """Queue a binary telemetry frame for transmission as a raw LoRa packet.
+
+        Returns immediately; the outcome arrives from poll() as a 'tx_ok'
+        event with the measured time on air or as 'tx_err'/'timeout'. The
+        payload is hex encoded in one C call into the preallocated command
+        buffer when the radio is free. Frames go out in 'priority' order; a
+        frame still queued 'max_age_ms' after this call is dropped with a
+        'stale' event instead of being sent late.
+        """
+        if len(frame) > MAX_PAYLOAD:
+            raise ValueError("LoRa payload too long ({} bytes)".format(len(frame)))
+        self._enqueue(REQ_TX, frame, tag, priority, max_age_ms)
+
+    # --- Batching mode -------------------------------------------------------
+
+    def enable_batching(self, max_samples=BATCH_SAMPLES, max_latency_ms=BATCH_LATENCY_MS, can=0):
+        """Collect reduced samples (dt, altitude, vertical speed, position) into
+        full-size frames instead of sending every sample on its own."""
+        if self.batch is None or self.batch.max_samples != max_samples:
+            self.flush_batch()
+            self.batch = BatchEncoder(max_samples, can)
+        self.batch_latency_ms = max_latency_ms
+
+    def disable_batching(self):
+        """Leave batching mode, returns the last pending batch frame (or None)."""
+        frame = self.flush_batch()
+        self.batch = None
+        return frame
+
+    def batch_sample(self, pid, epoch, data, now=None):
+        """Add one sample to the batch. Returns the batch frame when it is full
+        or its oldest sample reached the latency deadline, otherwise None.
+        The caller queues the frame, e.g. with transmit_frame().
+        """
+        if now is None:
+            now = time.ticks_ms()
+        if not self.batch.fits(pid):
+            # pid jumped too far for the offsets, a new batch starts with this sample
+            frame = self.batch.flush()
+            self.batch.add(pid, epoch, now, data)
+            return frame
+        if self.batch.add(pid, epoch, now, data) or self.batch.age_ms(now) >= self.batch_latency_ms:
+            return self.batch.flush()
+        return None
+
+    def flush_batch(self, now=None):
+        """Return the pending batch frame (None when empty). With 'now', only
+        once the latency deadline passed, for loops that stopped adding samples."""
+        if self.batch is None:
+            return None
+        if now is not None and self.batch.age_ms(now) < self.batch_latency_ms:
+            return None
+        return self.batch.flush()
+
     def transmit_json(self, json_data, confirm=False):
         """Transmit JSON data as a hex-encoded string using LoRaWAN."""
         # Convert JSON object to string
@@ -138,10 +498,10 @@ class LoRaComm:
         self.transmit(json_string, confirm)
         
     def led_on(self):
-        self.send_lora_cmd(f'sys set pindig GPIO13 1')
+        self.command(f'sys set pindig GPIO13 1')
     
     def led_off(self):
-        self.send_lora_cmd(f'sys set pindig GPIO13 0')
+        self.command(f'sys set pindig GPIO13 0')
 # from network import LoRa
 # import socket
 # import time
@@ -1,8 +1,8 @@
 import ntptime
 import utime
-from utils.logger import Logger
+from utils.logger import get_logger
 
-log = Logger()
+log = get_logger()
 
 # EET is UTC+2 and EEST is UTC+3
 # If observing daylight saving time, use UTC+3, otherwise use UTC+2
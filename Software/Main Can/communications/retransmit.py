@@ -0,0 +1,140 @@
+""" Store-and-forward of sent telemetry frames.
+
+    The can keeps the frames it encoded, as they went on air, so the base
+    station can ask for a lost range again with CMD_RETRANSMIT. The newest
+    frames stay in RAM; older ones spill into a ring of fixed-size slots
+    in a flash file, slot = pid % flash_frames, so no index is needed and
+    the file never grows past flash_frames slots.
+
+    Flash slot layout (big endian):
+        pid        H   pid of the frame in the slot
+        length     B   frame length, 0 for an empty slot
+        frame          the frame bytes, zero padded to MAX_FRAME
+
+    A delta frame is useless without its keyframe, so the keyframe is sent
+    first when the requested range does not contain it.
+"""
+import struct
+try:
+    from communications.telemetry import FRAME_DELTA, DELTA_HEADER_FORMAT, MAX_FRAME
+except ImportError:
+    from telemetry import FRAME_DELTA, DELTA_HEADER_FORMAT, MAX_FRAME
+
+RAM_FRAMES = 32             # Newest frames kept in RAM
+FLASH_FRAMES = 256          # Older frames kept in flash, 66 kB
+RETRANSMIT_MAX = 64         # Largest range one command may ask for
+RETRANSMIT_PER_CYCLE = 2    # Frames sent again per main loop cycle, the radio queue is short
+STORE_FILE = 'retransmit.bin'
+
+SLOT_HEADER_FORMAT = '>HB'
+SLOT_HEADER_SIZE = struct.calcsize(SLOT_HEADER_FORMAT)
+SLOT_SIZE = SLOT_HEADER_SIZE + MAX_FRAME
+# Offset of the keyframe reference in a delta frame
+DELTA_REF = struct.calcsize(DELTA_HEADER_FORMAT[:5])
+
+
+class RetransmitStore:
+    """ Bounded store of sent frames by pid, and the queue of frames the
+        base station asked for again.
+    """
+
+    def __init__(self, ram_frames=RAM_FRAMES, flash_frames=FLASH_FRAMES, path=STORE_FILE):
+        self.ram_frames = ram_frames
+        self.flash_frames = flash_frames
+        self._frames = {}
+        self._order = []
+        self._slot = bytearray(SLOT_SIZE)
+        # pids restart at every boot, frames of an earlier run must not be served
+        try:
+            self._file = open(path, 'w+b')
+        except OSError:
+            self._file = None
+        self._resend = []
+        self._resent_keys = set()
+        self._next = None
+        self.resent = 0
+
+    def add(self, pid, frame):
+        """ Keep an encoded frame, the oldest RAM frame spills to flash. """
+        pid &= 0xFFFF
+        if pid not in self._frames:
+            self._order.append(pid)
+            if len(self._order) > self.ram_frames:
+                old = self._order.pop(0)
+                self._spill(old, self._frames.pop(old))
+        self._frames[pid] = bytes(frame)
+
+    def _spill(self, pid, frame):
+        if self._file is None or len(frame) > MAX_FRAME:
+            return
+        struct.pack_into(SLOT_HEADER_FORMAT, self._slot, 0, pid, len(frame))
+        self._slot[SLOT_HEADER_SIZE:SLOT_HEADER_SIZE + len(frame)] = frame
+        try:
+            self._file.seek((pid % self.flash_frames) * SLOT_SIZE)
+            self._file.write(self._slot)
+        except OSError:
+            # Flash full or failing, keep going with RAM only
+            self._file = None
+
+    def get(self, pid):
+        """ Return the frame of 'pid' as it was sent, None when it is no longer kept. """
+        pid &= 0xFFFF
+        frame = self._frames.get(pid)
+        if frame is not None or self._file is None:
+            return frame
+        try:
+            self._file.seek((pid % self.flash_frames) * SLOT_SIZE)
+            header = self._file.read(SLOT_HEADER_SIZE)
+            if len(header) < SLOT_HEADER_SIZE:
+                return None
+            slot_pid, length = struct.unpack(SLOT_HEADER_FORMAT, header)
+            if slot_pid != pid or not length:
+                return None
+            frame = self._file.read(length)
+        except OSError:
+            return None
+        return frame if len(frame) == length else None
+
+    def request(self, first, last):
+        """ Queue the frames from 'first' to 'last' (pids, inclusive) to be
+            sent again. Replaces an earlier request; returns the number of
+            frames still kept. Raises ValueError on a range that is too long.
+        """
+        count = ((last - first) & 0xFFFF) + 1
+        if count > RETRANSMIT_MAX:
+            raise ValueError("Retransmit range of {} frames, at most {}".format(count, RETRANSMIT_MAX))
+        self._resend = [(first + i) & 0xFFFF for i in range(count)]
+        self._resent_keys = set()
+        self._next = None
+        return sum(1 for pid in self._resend if self.get(pid) is not None)
+
+    @property
+    def pending(self):
+        return self.peek() is not None
+
+    def peek(self):
+        """ Next (pid, frame) to send again, without taking it; None when done. """
+        while self._next is None and self._resend:
+            pid = self._resend[0]
+            frame = self.get(pid)
+            if frame is None:
+                self._resend.pop(0)
+                continue
+            if frame[1] == FRAME_DELTA:
+                key_pid = (pid - frame[DELTA_REF]) & 0xFFFF
+                key = None if key_pid in self._resent_keys else self.get(key_pid)
+                if key is not None:
+                    self._next = (key_pid, key, False)
+                    break
+            self._next = (pid, frame, True)
+        return None if self._next is None else self._next[:2]
+
+    def pop(self):
+        """ Take the frame returned by peek(), once it was handed to the radio. """
+        pid, frame, queued = self._next
+        self._next = None
+        if queued:
+            self._resend.pop(0)
+        if frame[1] != FRAME_DELTA:
+            self._resent_keys.add(pid)
+        self.resent += 1
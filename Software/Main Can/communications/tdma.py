@@ -0,0 +1,107 @@
+""" Time-division access to one LoRa channel shared by several cans.
+
+    Time is cut into cycles of 'slots' slots of SLOT_MS; a can starts a
+    transmission only inside its own slot, and only when the packet ends
+    before the slot does. GUARD_MS at both ends of every slot absorbs the
+    clock error between the cans.
+
+    Cans agree on time through UTC: the RTC when NTP set it at boot, GPS
+    time of day otherwise. Only the time of day matters, cycles divide a
+    day evenly, so the date and the RTC epoch do not.
+
+    The number of slots and the can ID are set in config.py; the slot of a
+    can is its ID modulo the number of slots.
+"""
+import time
+
+SLOT_MS = 2000              # Fits the largest frame up to SF9 at 125 kHz
+GUARD_MS = 250              # GPS timing reaches the can with up to a cycle of delay
+DAY_MS = 86400000
+GPS_WINDOW_MS = 60000       # GPS observations the clock offset is taken from
+RTC_MIN_YEAR = 2024         # An RTC NTP never set starts in 2000
+
+
+def can_id_from_hweui(hweui):
+    """ Can ID from the RN2483 EUI, its serial number ends in the last byte.
+        0xFF addresses every can (telecommand.CAN_BROADCAST), it becomes 0.
+    """
+    return int(hweui.strip()[-2:], 16) % 0xFF
+
+
+class TimeBase:
+    """ UTC milliseconds of the day, from time.ticks_ms() and the last sync. """
+
+    def __init__(self):
+        self.source = None
+        self._offset = 0            # ms of day minus ticks, modulo DAY_MS
+        self._gps = []              # (ticks, offset) observed in the last GPS_WINDOW_MS
+        self._last_fix = None
+
+    def sync_rtc(self, now=None):
+        """ Take the time from the RTC, if NTP set it. Returns True on success. """
+        if time.gmtime()[0] < RTC_MIN_YEAR:
+            return False
+        if now is None:
+            now = time.ticks_ms()
+        ms = time.time_ns() // 1000000 if hasattr(time, 'time_ns') else time.time() * 1000
+        self._offset = (ms - now) % DAY_MS
+        self.source = 'ntp'
+        return True
+
+    def sync_gps(self, seconds_of_day, now=None):
+        """ Follow the GPS time of the last fix, unless NTP set the clock.
+
+            A fix is read some time after it was made, so every observation
+            is late; the smallest delay, the largest offset of the recent
+            ones, is the one kept.
+        """
+        if self.source == 'ntp' or seconds_of_day is None or seconds_of_day == self._last_fix:
+            # The same fix read again is older with every read, not news
+            return
+        self._last_fix = seconds_of_day
+        if now is None:
+            now = time.ticks_ms()
+        observed = (int(seconds_of_day * 1000) - now) % DAY_MS
+        self._gps = [(t, o) for t, o in self._gps if time.ticks_diff(now, t) < GPS_WINDOW_MS]
+        self._gps.append((now, observed))
+        # Offsets near midnight wrap, compare them relative to the newest one
+        self._offset = (observed + max((o - observed + DAY_MS // 2) % DAY_MS - DAY_MS // 2 for _, o in self._gps)) % DAY_MS
+        self.source = 'gps'
+
+    def ms_of_day(self, now=None):
+        if now is None:
+            now = time.ticks_ms()
+        return (now + self._offset) % DAY_MS
+
+
+class TdmaSchedule:
+    """ Holds transmissions back until the can's own slot.
+
+        'airtime_ms' gives the time on air of a payload length at the
+        current radio settings, e.g. RateController.time_on_air_ms.
+    """
+
+    def __init__(self, slot, slots, time_base, airtime_ms, slot_ms=SLOT_MS, guard_ms=GUARD_MS):
+        if not 0 <= slot < slots or DAY_MS % (slots * slot_ms):
+            raise ValueError("Slot {} of {} x {} ms does not fit a day".format(slot, slots, slot_ms))
+        self.slot = slot
+        self.slots = slots
+        self.slot_ms = slot_ms
+        self.guard_ms = guard_ms
+        self.time_base = time_base
+        self.airtime_ms = airtime_ms
+
+    def wait_ms(self, payload_len, now=None):
+        """ 0 when a packet of 'payload_len' bytes may start now, otherwise
+            the time until the next start of the can's slot.
+        """
+        cycle = self.slots * self.slot_ms
+        t = self.time_base.ms_of_day(now) % cycle
+        start = self.slot * self.slot_ms + self.guard_ms
+        end = (self.slot + 1) * self.slot_ms - self.guard_ms
+        if start <= t:
+            toa = self.airtime_ms(payload_len)
+            # A packet longer than the slot goes at its start, there is no better moment
+            if t + toa <= end or (toa > end - start and t < start + self.guard_ms):
+                return 0
+        return (start - t) % cycle or cycle
@@ -30,51 +30,14 @@ WIFI_CREDENTIALS = [
     ("Cdosr", "c4ns4t2024")
 ]
 
-KEY_MAP = {
-    "pid": "pid",
-    "type": "type",
-    "epoch": "etm",
-    "telemetry": "tele",
-    "valid": "vld",
-    "esp32": "e32",
-    "wss": "wss",
-    "fmem": "fm",
-    "altitude": "alt",
-    "temperature": "tmp",
-    "bmp280": "b28",
-    "bme688": "b68",
-    "lps25h": "l25",
-    "lis3mdl": "l3m",
-    "pressure": "prs",
-    "acceleration": "acc",
-    "gyroscope": "gyr",
-    "gps_coordinates": "gps",
-    "air_quality": "aq",
-    "ccs811": "c81",
-    "eCO2": "eco",
-    "tVOC": "tvoc",
-    "telemetry": "tlm",
-    "mpu9250": "mpu",
-    "mcp9808": "mcp",
-    "accel_x": "a_x",
-    "accel_y": "a_y",
-    "accel_z": "a_z",
-    "gyro_x": "g_x",
-    "gyro_y": "g_y",
-    "gyro_z": "g_z",
-    "mag_x": "m_x",
-    "mag_y": "m_y",
-    "mag_z": "m_z",
-    "longitude": "lon",
-    "latitude": "lat",
-    "speed": "spd",
-    "timestamp": "tmsp",
-    "magnetic_variation": "mv",
-    "course": "crs",
-    "null": "na",
-    "pres": "pre",
-    "temp": "tme",
-    "volt": "V",
-    "soc": "soc",
-    "icm20948": "icm"
-}
\ No newline at end of file
+# KEY_MAP lives in communications/schema.py with the telemetry fields
+
+# Shared secret of the telecommand uplink, must match the base station.
+# Change it before flight.
+TELECOMMAND_KEY = b"CDOSR-CanSat2024-uplink"
+
+# Cans sharing one LoRa frequency (communications/tdma.py). The can ID goes
+# in every frame, None takes it from the last byte of the RN2483 EUI; give
+# every can its own slot, i.e. IDs that differ modulo TDMA_SLOTS.
+CAN_ID = None
+TDMA_SLOTS = 1  # 1: one can on the frequency, it transmits whenever it wants
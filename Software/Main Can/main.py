@@ -1,12 +1,13 @@
 # Import necessary modules
 from sensors.accelerometer import ICM20948
 from sensors.pressure import LPS25H, BME688
-from sensors.air_quality import AirQualitySensor
+from sensors.air_quality import AirQualitySensor, CCS811
 from sensors.temperature import TemperatureSensor, MCP9808, BME280
 from sensors.uv_sensor import VEML6075
+from sensors.mems_module import LIS3MDL
 from sensors.gps import M8NNeo
 from communications.bluetooth import BluetoothComm
-from communications.lora import LoRaComm
+from communications.lora import LoRaComm, PRIO_CONTROL, PRIO_CRITICAL, PRIO_BULK, BULK_MAX_AGE_MS
 from storage.sdcard import SDCard
 from sensors.battery import MAX17048
 from sensors.esp import ESP32Data
@@ -17,11 +18,21 @@ import ntptime
 from machine import RTC, Pin, UART, I2C
 import network
 import time
-from config import WIFI_CREDENTIALS, KEY_MAP # Import your Wi-Fi credentials list
+import ubinascii
+from config import WIFI_CREDENTIALS, TELECOMMAND_KEY, CAN_ID, TDMA_SLOTS # Import your Wi-Fi credentials list
 from communications.ntp import get_epoch_time, get_formatted_localtime
-from communications.dataintegrity import get_data_checksum
+from communications.telemetry import (TelemetryEncoder, encode_frame, KEYFRAME_INTERVAL, FRAME_BULK, CRITICAL_FIELDS, BULK_FIELDS,
+                                      FRAME_BATCH, HEADER_SIZE, CRC_SIZE, BATCH_MAX_SAMPLES, frame_pid)
+from communications.airtime import RateController, radio_settings
+from communications.fec import FecEncoder
+from communications.retransmit import RetransmitStore, RETRANSMIT_PER_CYCLE
+from communications.tdma import TimeBase, TdmaSchedule, can_id_from_hweui
+from communications.telecommand import (TelecommandReceiver, encode_listen, rx_window_symbols, RX_WINDOW_MS, COMMAND_NAMES, STATUS_NAMES,
+                                        STATUS_OK, STATUS_BAD_ARGS, STATUS_FAILED, CMD_SET_PERIOD, CMD_SET_SF, CMD_SET_POWER,
+                                        CMD_RETRANSMIT, CMD_SET_MODE, CMD_SET_BATCH,
+                                        MODE_FLIGHT, MODE_RECOVERY, MODE_NAMES, MODE_PERIOD_MS)
 from sensors.sensor_manager import SensorManager
-from utils.logger import Logger
+from utils.logger import get_logger, poll_all, flush_all
 import json
 import os
 from utils.neopixel import NeoPixelControl
@@ -63,7 +74,7 @@ np_controller.set_pixel(1,255,255,0)
 # test_buzzer(1)
 
 # Instantiate the loggers
-log = Logger()
+log = get_logger()
 dlog = DataLogger()
 #sd_card = SDCard(2, 40)
 
@@ -86,6 +97,12 @@ def initialize_system():
     except Exception as e:
         log.log_event("ERROR", "ICM20948 not initialised", running="main.py", function="initialize_system()", module="LPS25H", error=e)
 
+    try:
+        magnetometer = LIS3MDL()
+        log.log_event("INFO", f"LIS3MDL initialised done on I2C{magnetometer.channel}", running="main.py", function="initialize_system()", module="LIS3MDL")
+    except Exception as e:
+        log.log_event("ERROR", "LIS3MDL not initialised", running="main.py", function="initialize_system()", module="LIS3MDL", error=e)
+
     try:
         temperature_1 = MCP9808()
         # print(f"ICM20948 initialised done on I2C{ICM20948().channel}")
@@ -108,6 +125,12 @@ def initialize_system():
         log.log_event("ERROR", "BME280 not initialised", running="main.py", function="initialize_system()", module="BME280", error=e)
 #     print(f"    BME280 initialised done on I2C{MCP9808().channel}")
     
+    try:
+        air_quality_sensor = CCS811()
+        log.log_event("INFO", f"CCS811 initialised done on I2C{air_quality_sensor.channel}", running="main.py", function="initialize_system()", module="CCS811")
+    except Exception as e:
+        log.log_event("ERROR", "CCS811 not initialised", running="main.py", function="initialize_system()", module="CCS811", error=e)
+
     try:
         uv_sensor = VEML6075()
         log.log_event("INFO", f"VEML6075 initialised done on I2C{VEML6075().channel}", running="main.py", function="initialize_system()", module="VEML6075")
@@ -135,9 +158,18 @@ def initialize_system():
     print("  + Sensors initialized successfully.")
     log.log_event("INFO", "Sensors initialized successfully.")
     
+    # Before anything serves the log files: seal what a reset left open
     try:
+        session = dlog.start_session()
+        log.log_event("INFO", "Data log session {}".format(session.pop('session')), running="main.py", function="initialize_system()", **session)
+    except Exception as e:
+        log.log_event("ERROR", "Data log recovery failed", running="main.py", function="initialize_system()", error=e)
+
+    try:
+        # Serves the log files to the download host after the flight
         bluetooth_comm = BluetoothComm()
     except Exception as e:
+        bluetooth_comm = None
         print(f"Bluetooth init error {e}")
     
     try:
@@ -229,12 +261,28 @@ def transmit_data_BT(data):
     #bluetooth_comm.send_data(data)
     # lora_comm.transmit_data(data)
     
-def transmit_data_LoRa(data):
-    """Transmit data over  LoRa."""
+def transmit_data_LoRa(pid, frame, priority=PRIO_CRITICAL, max_age_ms=None):
+    """Queue a telemetry frame for LoRa, the result is reported by poll_radio()."""
     # bluetooth_comm.send_data(data)
-    lora_comm.transmit_json(data)
-    jdata = json.loads(data)
-    print(f"Data package {jdata['pid']} sent ...")
+    lora_comm.transmit_frame(frame, pid, priority, max_age_ms)
+
+def poll_radio(uplink=None):
+    """Advance the radio, report finished transmissions and hand uplink packets to 'uplink'; never blocks."""
+    for event, pid, detail in lora_comm.poll():
+        if event == 'tx_ok':
+            print(f"Data package {pid} sent ({detail} ms on air) ...")
+        elif event == 'rx' and uplink is not None:
+            try:
+                result = uplink.receive(ubinascii.unhexlify(detail))
+            except ValueError:
+                result = None
+            if result is None:
+                log.log_event("WARNING", "Telecommand rejected", running="main.py", function="poll_radio()")
+            else:
+                seq, opcode, status = result
+                log.log_event("INFO", "Telecommand received", running="main.py", function="poll_radio()", seq=seq, command=COMMAND_NAMES.get(opcode, opcode), status=STATUS_NAMES[status])
+        elif event in ('tx_err', 'busy', 'timeout', 'dropped'):
+            log.log_event("WARNING", "LoRa transmission failed", running="main.py", function="poll_radio()", pid=pid, event=event, detail=detail)
 
 def is_data_valid(data):
     # Example validation logic
@@ -263,100 +311,6 @@ def handle_invalid_data():
     # Logic to handle invalid data, e.g., notify a monitoring service, log extensively, or attempt a sensor re-initialization
     print("Handling invalid sensor data...")
     
-def encode_data(data, key_map):
-    encoded_packet = {}
-    for key, value in data.items():
-        new_key = key_map.get(key, key)  # Use shorthand if available
-        if isinstance(value, dict):
-            # Recursive call to handle nested dictionaries
-            encoded_packet[new_key] = encode_data(value, key_map)
-        else:
-            encoded_packet[new_key] = value
-    return encoded_packet
-
-def decode_data(encoded_data, key_map):
-    decoded_packet = {}
-    reverse_key_map = {v: k for k, v in key_map.items()}  # Reverse mapping for decoding
-    for key, value in encoded_data.items():
-        new_key = reverse_key_map.get(key, key)  # Expand key using reversed map
-        if isinstance(value, dict):
-            # Recursive call to handle nested dictionaries
-            decoded_packet[new_key] = decode_data(value, reverse_key_map)
-        else:
-            decoded_packet[new_key] = value
-    return decoded_packet
-    
-    
-# Function to split the data into packets
-def split_data(data):
-    packets = []
-    # Encoding data for transmission
-    if data["valid"] == True:
-        
-        # Packet 1: Basic Info and Core Data
-        packet1 = {
-            "pid": data["pid"],
-            "type": data["type"],
-            "epoch": data["epoch"],
-            "bat": data["data"].get("bat"),
-            "gps": data["data"].get("gps")#,
-            # "valid": data["valid"],
-            # "esp32": data["esp32"]
-        }
-        packets.append(encode_data(packet1, KEY_MAP))
-
-        # Packet 2: GPS and battery data
-        temperature_data = data["data"].get("temp", {})
-        packet2 = {
-            "pid": data["pid"],
-            "pres": data["data"].get("pres", "N/A"),
-            "temp": {
-                "bmp280": temperature_data.get("bmp280", "N/A"),  # Default to "N/A" if not found
-                "mcp9808": temperature_data.get("mcp9808", "N/A"),  # Default to "N/A" if not found
-                "bme688": temperature_data.get("bme688", "N/A"),  # Default to "N/A" if not found
-                "lps25h": temperature_data.get("lps25h", "N/A")   # Default to "N/A" if not found
-            }
-        }
-        #print(f"Packet 2 length = {encode_data(packet2, KEY_MAP)} => {len(str(encode_data(packet2, KEY_MAP)))}")
-        packets.append(encode_data(packet2, KEY_MAP))
-
-        # Packet 2: Sensor Data Part 1
-        packet3 = {
-            "pid": data["pid"],
-            "alt": data["data"].get("alt", "N/A"),
-            "hum": data["data"].get("hum", "N/A")
-        }
-        #print(f"Packet 3 length = {encode_data(packet3, KEY_MAP)} => {len(str(encode_data(packet3, KEY_MAP)))}")
-        packets.append(encode_data(packet3, KEY_MAP))
-
-        # Packet 2: Sensor Data Part 1
-        packet4 = {
-            "pid": data["pid"],
-            "acc": data["data"].get("acc"),
-            "gyro": data["data"].get("gyro")
-            #"air_quality": data["data"].get("air_quality")
-        }
-        #print(f"Packet 4 length = {encode_data(packet4, KEY_MAP)} => {len(str(encode_data(packet4, KEY_MAP)))}")
-        packets.append(encode_data(packet4, KEY_MAP))
-
-
-        # Packet 4: Sensor Data Part 3
-#         packet5 = {
-#             "pid": data["pid"],
-#             "acc": data["data"].get("acc"),
-#             "gyro": data["data"].get("gyro")
-#         }
-#         packets.append(encode_data(packet5, KEY_MAP))
-
-        # Packet 5: GPS and Environmental Data
-#         packet6 = {
-#             "pid": data["pid"],
-#             "gps": data["data"].get("gps")
-#         }
-#         packets.append(encode_data(packet6, KEY_MAP))
-
-    return packets
-
 def collect_sensor_data(sensor_manager, interval=5):
     """Collect data every few seconds and process in bulk."""
     start_time = utime.time()
@@ -373,16 +327,98 @@ def main_loop():
     """Main operation loop."""
     counter = 1 # Initialize the counter for PID
     sensor_manager = SensorManager()  # Create an instance of SensorManager
+    # Spends the duty-cycle budget for the configured SF/BW/CR evenly
+    rate_controller = RateController(radio_settings(LoRaComm.commands))
+    # Every frame carries the can ID, the base station tells the cans on the frequency apart by it
+    can_id = CAN_ID
+    if can_id is None:
+        try:
+            can_id = can_id_from_hweui(lora_comm.get_hardware_eui())
+        except (AttributeError, ValueError):
+            can_id = 0
+            log.log_event("WARNING", "No RN2483 EUI, can ID 0", running="main.py", function="main_loop()")
+    # UTC time of day from NTP or GPS, the cans take turns by it
+    time_base = TimeBase()
+    time_base.sync_rtc()
+    if TDMA_SLOTS > 1:
+        lora_comm.tdma = TdmaSchedule(can_id % TDMA_SLOTS, TDMA_SLOTS, time_base, rate_controller.time_on_air_ms)
+    log.log_event("INFO", "Can ID {}, TDMA slot {} of {}".format(can_id, can_id % TDMA_SLOTS, TDMA_SLOTS), running="main.py", function="main_loop()", time=time_base.source)
+    # Keyframes plus small delta frames in between, for the critical fields
+    telemetry_encoder = TelemetryEncoder(mask=CRITICAL_FIELDS, can=can_id)
+    # Parity frames let the ground station rebuild lost frames
+    fec_encoder = FecEncoder(can=can_id)
+    # Recent frames, so the base station can ask for lost ones again
+    retransmit_store = RetransmitStore()
+    # Operator commands, heard in a short window after every few transmissions
+    uplink = TelecommandReceiver(TELECOMMAND_KEY, can=can_id)
+    # A window owed since a cycle whose budget had no room for its announcement
+    listen_due = False
+    control = {'mode': MODE_FLIGHT, 'period_ms': MODE_PERIOD_MS[MODE_FLIGHT], 'radio': [], 'batch': 0}
+
+    def set_period(period_ms):
+        control['period_ms'] = period_ms
+        return STATUS_OK
+
+    def set_radio(name, value, low, high):
+        if not low <= value <= high:
+            return STATUS_BAD_ARGS
+        # Applied once the acknowledgement is queued, the base station still listens with the old settings
+        control['radio'].append((name, value))
+        return STATUS_OK
+
+    def set_mode(mode):
+        if mode >= len(MODE_NAMES):
+            return STATUS_BAD_ARGS
+        control['mode'] = mode
+        control['period_ms'] = MODE_PERIOD_MS[mode]
+        # The samples up to a change of flight phase must survive a brownout
+        dlog.commit()
+        log.log_event("INFO", "Data log committed", running="main.py", function="set_mode()", mode=MODE_NAMES[mode], **dlog.stats())
+        # In recovery every frame must locate the can on its own
+        telemetry_encoder.keyframe_interval = 0 if mode == MODE_RECOVERY else KEYFRAME_INTERVAL
+        return STATUS_OK
+
+    def set_batch(samples, latency_ms):
+        if samples > BATCH_MAX_SAMPLES:
+            return STATUS_BAD_ARGS
+        # Batching stops in the main loop, so the pending samples still go out
+        control['batch'] = samples
+        if samples:
+            lora_comm.enable_batching(samples, latency_ms, can_id)
+        return STATUS_OK
+
+    def retransmit(first, last):
+        # Sent from spare airtime in the main loop; nothing kept means the range is too old
+        return STATUS_OK if retransmit_store.request(first, last) else STATUS_FAILED
+
+    uplink.register(CMD_SET_PERIOD, set_period)
+    uplink.register(CMD_SET_SF, lambda sf: set_radio('sf', sf, 7, 12))
+    uplink.register(CMD_SET_POWER, lambda dbm: set_radio('pwr', dbm, -3, 15))
+    uplink.register(CMD_SET_MODE, set_mode)
+    uplink.register(CMD_SET_BATCH, set_batch)
+    uplink.register(CMD_RETRANSMIT, retransmit)
+    critical_size = HEADER_SIZE + CRC_SIZE   # Last critical frame, its airtime is kept for the next one
+
     while True:
         try:
+            cycle_start = time.ticks_ms()
             
             # Get the current timestamp
             epoch_timestamp = get_epoch_time()  # This returns the number of seconds since the Epoch
             localtime = utime.localtime(epoch_timestamp)
             formatted_time = get_formatted_localtime(localtime)
             
+            # Handle radio responses that arrived during the last cycle
+            poll_radio(uplink)
+            if bluetooth_comm is not None:
+                bluetooth_comm.poll()
+            # Log entries that waited long enough, the flight period does not wait at all
+            poll_all()
+
             # Collect sensor data
             collected_data, radio_data = sensor_manager.collect_data()
+            # No 'gtm' until the receiver has a fix; sync_gps skips None
+            time_base.sync_gps(radio_data['gps'].get('gtm'), cycle_start)
             #print(collected_data)
             
 #             if not is_data_valid(collected_data):
@@ -417,43 +453,112 @@ def main_loop():
 
             # print(f"Collecting radio data #{counter}: radio_data")
             
-            # Hash, save, and transmit logic remains the same as before
-            hash = get_data_checksum(sensor_data)
-
-            # Save data locally
+            # Save data locally, as one binary record with a CRC-16
             #save_data(sensor_data)
             dlog.write_data(sensor_data)
  #           save_data_SD(sensor_data)
  #           print("saved")
-            if counter % 10 == 0:
-                packets = split_data(radio_pack)
-#                 pl = []
-#                 for p in packets:
-#                     pl.append(p)
-                #print("{}: {} ".format(counter, pl))
-                # Print each packet as JSON string for transmission
-                for i, packet in enumerate(packets, 1):
-                    json_packet = json.dumps(packet)
-
-                    # Send data to ground station or other devices
-                    
-                    # lora_comm.led_on()
-                    transmit_data_LoRa(json_packet)
-                    #transmit_data_LoRa(f"packet {counter}")
-                    # print(f"packet {counter}")
-                    np_controller.clear()
-                    np_controller.set_pixel(1,255,0,0) 
-                    time.sleep(0.02)
-                    np_controller.clear()
-                    np_controller.set_pixel(1,0,255,0)
-                    # lora_comm.led_off()
+            # Position, altitude and battery go in a small keyframe or delta
+            # frame; IMU, temperatures etc. in a bulk frame for spare airtime
+            # In batching mode the critical fields of several samples share one frame
+            if lora_comm.batch is None:
+                frame = telemetry_encoder.encode(counter, epoch_timestamp, radio_data)
+                frames = [frame]
+            else:
+                frames = [lora_comm.batch_sample(counter, epoch_timestamp, radio_data, cycle_start)]
+                if not control['batch']:
+                    # The samples still pending go out after the frame batch_sample() returned
+                    frames.append(lora_comm.disable_batching())
+                    # Deltas must not refer to a keyframe from before the batches
+                    telemetry_encoder.force_keyframe()
+                frames = [frame for frame in frames if frame is not None]
+            bulk = encode_frame(counter, epoch_timestamp, radio_data, FRAME_BULK, BULK_FIELDS, can_id)
+
+            # Acknowledgements go first, the operator is waiting on them
+            for ack in rate_controller.plan(uplink.take_acks()):
+                transmit_data_LoRa('ack', ack, PRIO_CONTROL)
+
+            parity = []
+            listen = False
+            # Kept whether or not they go on air now, a skipped sample can be asked for later
+            for frame in frames:
+                retransmit_store.add(frame_pid(frame), frame)
+
+            # Samples that don't fit the airtime budget are skipped, not delayed
+            for frame in rate_controller.plan(frames):
+
+                # Send data to ground station or other devices
+                
+                # lora_comm.led_on()
+                pid = counter
+                if frame[1] == FRAME_BATCH:
+                    # A batch frame goes out under the pid of its first sample
+                    pid = frame_pid(frame)
+                else:
+                    telemetry_encoder.sent()
+                transmit_data_LoRa(pid, frame)
+                # Two frames in one cycle when batching stops, keep the parity and window of both
+                parity += fec_encoder.add(pid, frame)
+                listen = uplink.sent() or listen
+                np_controller.clear()
+                np_controller.set_pixel(1,255,0,0) 
+                time.sleep(0.02)
+                np_controller.clear()
+                np_controller.set_pixel(1,0,255,0)
+                # lora_comm.led_off()
+
+            # Parity, then bulk data, only from airtime the next critical frame
+            # will not need; stale ones are dropped by the radio, not sent late
+            low_priority = parity
+            if len(bulk) > HEADER_SIZE + CRC_SIZE:
+                low_priority = parity + [bulk]
+            if frames:
+                critical_size = len(frames[0])
+            for packet in rate_controller.plan(low_priority, keep_ms=rate_controller.time_on_air_ms(critical_size)):
+                transmit_data_LoRa(counter, packet, PRIO_BULK, BULK_MAX_AGE_MS)
+
+            # Frames the base station asked for again, a few per cycle from what is left
+            for _ in range(RETRANSMIT_PER_CYCLE):
+                resend = retransmit_store.peek()
+                if resend is None or not rate_controller.plan([resend[1]], keep_ms=rate_controller.time_on_air_ms(critical_size)):
+                    break
+                retransmit_store.pop()
+                transmit_data_LoRa(resend[0], resend[1], PRIO_BULK, BULK_MAX_AGE_MS)
+
+            listen_due = listen_due or listen
+            if listen_due:
+                # The window follows the frame and its parity, announced so the
+                # base station sends its command into it and nowhere else
+                beacon = encode_listen(counter, RX_WINDOW_MS, can_id)
+                if rate_controller.plan([beacon]):
+                    lora_comm.listen(beacon, rx_window_symbols(RX_WINDOW_MS, rate_controller.settings['sf'], rate_controller.settings['bw']), 'listen', 'uplink')
+                    listen_due = False
+
+            # Radio changes ordered by telecommand
+            for name, value in control['radio']:
+                lora_comm.command("radio set {} {}".format(name, "sf{}".format(value) if name == 'sf' else value))
+                if name == 'sf':
+                    rate_controller.configure(sf=value)
+            control['radio'] = []
 
             counter += 1
+
+            # Keep the commanded sample period, the radio and the logs are served while waiting
+            while time.ticks_diff(time.ticks_ms(), cycle_start) < control['period_ms']:
+                poll_radio(uplink)
+                if bluetooth_comm is not None:
+                    bluetooth_comm.poll()
+                dlog.poll()
+                poll_all()
+                time.sleep_ms(10)
             
         except ValueError as e:
             print(f"Data validation error: {e}")
         except Exception as e:
             print(f"Unexpected error in main.py: {e}")
+            # Buffered samples and log entries are written before the loop ends
+            dlog.close()
+            flush_all()
             break
 #             initialize_system()  # Optionally re-initialize system components
 #             continue  # Continue with the next iteration of the loop
@@ -470,4 +575,5 @@ if __name__ == "__main__":
         np_controller.clear()
         np_controller.set_pixel(1,255,0,0)
         print("An error occurred during initialization or main loop:", str(e))
+        flush_all()
         # Optional: Reboot or handle the error in other ways
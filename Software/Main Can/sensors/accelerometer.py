@@ -4,9 +4,11 @@ from machine import I2C, Pin
 import config
 import time
 import struct
-from utils.logger import Logger
+from utils.logger import get_logger
+from sensors.registers import ShadowRegisters
+from sensors.calibration import get_calibration, GyroBiasEstimator
 
-log = Logger()
+log = get_logger()
 
 class MPU9250:
     
@@ -232,9 +234,9 @@ class ICM20948:
     PWR_MGMT_2 = 0x07
     ACCEL_XOUT_H = 0x2D
     GYRO_XOUT_H = 0x33
-    ACCEL_CONFIG = 0x14
-    GYRO_CONFIG = 0x01
-    GYRO_SCALE_FACTOR = 131.0
+    ACCEL_CONFIG = 0x14     # User bank 2
+    GYRO_CONFIG = 0x01      # GYRO_CONFIG_1, user bank 2
+    REG_BANK_SEL = 0x7F     # Every bank, the bank number goes in bits 5:4
 
     # Constants for accelerometer and gyroscope sensitivity
     ACCEL_FS_SEL_2G = (0x00 << 1)
@@ -268,22 +270,29 @@ class ICM20948:
         elif ICM20948.ICM20948_ALTERNATE_ADDR in self.i2c.scan():
             self.address = ICM20948.ICM20948_ALTERNATE_ADDR
         self.channel=i2c_channel
+        # Bank selection is shared by every object talking to this chip
+        self.shadow = ShadowRegisters.for_device(self.i2c, i2c_channel, self.address)
+        # Corrections are shared with every other object on this chip
+        calibration = get_calibration()
+        self.accel_cal = calibration.get('icm20948', 'accel')
+        self.gyro_cal = calibration.get('icm20948', 'gyro')
+        self.mag_cal = calibration.get('icm20948', 'mag')
         self.initialize_sensor()
         self.init_icm20948()
         #log.log_event("INFO", "ICM20948 initialised", running="accelerometer.py", function="initialize_system()")
 
     def init_icm20948(self):
         # Reset device
-        self._write_register(0x7F, 0x00)  # User Bank 0
+        self._select_bank(0x00)  # User Bank 0
         self._write_register(0x06, 0x01)  # Reset
         time.sleep(0.1)
         # Wake up device and disable I2C interface
         self._write_register(0x06, 0x01)  # Set clock source
-        self._write_register(0x7F, 0x00)  # Select User Bank 0
+        self._select_bank(0x00)  # Select User Bank 0
         self._write_register(0x03, 0x20)  # Disable I2C interface
 
         # Set up I2C Master Mode to communicate with AK09916 magnetometer
-        self._write_register(0x7F, 0x03)  # Select User Bank 3
+        self._select_bank(0x03)  # Select User Bank 3
         self._write_register(0x01, 0x4D)  # I2C Master mode and clock
         self._write_register(0x02, 0x07)  # I2C Master reset
         time.sleep(0.01)
@@ -296,13 +305,13 @@ class ICM20948:
 
     def read_magnetometer(self):
         # Access magnetometer data via ICM-20948 I2C Master
-        self._write_register(0x7F, 0x03)  # Select User Bank 3
+        self._select_bank(0x03)  # Select User Bank 3
         data = self._read_register(0x2A, 8)  # Read 6 bytes of magnetometer data
 
-        # Convert bytes to integers
-        x = self._bytes_to_int(data[1], data[0])
-        y = self._bytes_to_int(data[3], data[2])
-        z = self._bytes_to_int(data[5], data[4])
+        # Convert bytes to integers, hard/soft-iron corrected
+        x, y, z = self.mag_cal.apply(self._bytes_to_int(data[1], data[0]),
+                                     self._bytes_to_int(data[3], data[2]),
+                                     self._bytes_to_int(data[5], data[4]))
 
         return { 'mag_x': x,
                  'mag_y': y,
@@ -310,13 +319,13 @@ class ICM20948:
     
     def read_magnetometer_round(self):
         # Access magnetometer data via ICM-20948 I2C Master
-        self._write_register(0x7F, 0x03)  # Select User Bank 3
+        self._select_bank(0x03)  # Select User Bank 3
         data = self._read_register(0x2A, 8)  # Read 6 bytes of magnetometer data
 
-        # Convert bytes to integers
-        x = self._bytes_to_int(data[1], data[0])
-        y = self._bytes_to_int(data[3], data[2])
-        z = self._bytes_to_int(data[5], data[4])
+        # Convert bytes to integers, hard/soft-iron corrected
+        x, y, z = self.mag_cal.apply(self._bytes_to_int(data[1], data[0]),
+                                     self._bytes_to_int(data[3], data[2]),
+                                     self._bytes_to_int(data[5], data[4]))
 
         return { 'mag_x': round(x, 3),
                  'mag_y': round(y, 3),
@@ -325,17 +334,26 @@ class ICM20948:
     def _write_register(self, register, value):
         self.i2c.writeto_mem(self.address, register, bytearray([value]))
 
+    def _select_bank(self, bank):
+        # Only hits the bus when the bank actually changes
+        self.shadow.write(self.REG_BANK_SEL, bank << 4)
+
     def _read_register(self, register, length):
-        return self.i2c.readfrom_mem(self.address, register, length)
+        return self.shadow.read_into(register, bytearray(length))
 
     def _bytes_to_int(self, msb, lsb):
         value = msb << 8 | lsb
         return value - 65536 if value > 32767 else value
 
     def initialize_sensor(self):
+        # A soft reboot may have left the chip in another bank, PWR_MGMT_1 is in bank 0
+        self.shadow.trigger(self.REG_BANK_SEL, 0x00, 0x00)
         # Reset device
         self.i2c.writeto_mem(self.address, self.PWR_MGMT_1, b'\x80')
         time.sleep(0.1)  # Wait for 100 milliseconds
+        # The reset puts every register, bank selection included, back to default
+        self.shadow.invalidate()
+        self.shadow.note(self.REG_BANK_SEL, 0x00)
 
         # Wake up device and disable sleep mode
         self.i2c.writeto_mem(self.address, self.PWR_MGMT_1, b'\x01')
@@ -345,58 +363,101 @@ class ICM20948:
         self.set_accel_config(self.ACCEL_FS_SEL_16G)
         self.set_gyro_config(self.GYRO_FS_SEL_2000DPS)
 
-        self.i2c.writeto_mem(self.address, self.GYRO_CONFIG, b'\x00')
+    def _set_full_scale(self, register, config_value):
+        # Only the FS_SEL bits change, the low-pass settings next to them stay
+        self._select_bank(0x02)
+        current = self._read_register(register, 1)[0]
+        self._write_register(register, (current & ~0x06) | config_value)
+        # Read back: the scale must match what the chip actually uses
+        config = self._read_register(register, 1)[0] & 0x06
+        self._select_bank(0x00)
+        return config
 
     def set_accel_config(self, config_value):
-        self.i2c.writeto_mem(self.address, self.ACCEL_CONFIG, bytes([config_value]))
+        # Cache the range so reads don't have to fetch it again
+        self.accel_fs = self._set_full_scale(self.ACCEL_CONFIG, config_value)
+        self._accel_scale = 1.0 / self.ACCEL_SENSITIVITY_SCALE_FACTOR[self.accel_fs]
+        if self.accel_fs != config_value:
+            log.log_event("WARNING", "ICM20948 accelerometer range not set", running="accelerometer.py", function="set_accel_config()", wanted=config_value, got=self.accel_fs)
 
     def set_gyro_config(self, config_value):
-        self.i2c.writeto_mem(self.address, self.GYRO_CONFIG, bytes([config_value]))
+        self.gyro_fs = self._set_full_scale(self.GYRO_CONFIG, config_value)
+        self._gyro_scale = 1.0 / self.GYRO_SENSITIVITY_SCALE_FACTOR[self.gyro_fs]
+        if self.gyro_fs != config_value:
+            log.log_event("WARNING", "ICM20948 gyroscope range not set", running="accelerometer.py", function="set_gyro_config()", wanted=config_value, got=self.gyro_fs)
+
+    def read_raw_acceleration(self):
+        """ Bias/scale corrected acceleration in raw counts. """
+        # Sensor data is in bank 0; no bus traffic unless the magnetometer moved it
+        self._select_bank(0x00)
+        accel_data = self._read_register(self.ACCEL_XOUT_H, 6)
+        return self.accel_cal.apply(*struct.unpack('>hhh', accel_data))
+
+    def read_raw_gyroscope(self):
+        """ Bias corrected angular rate in raw counts. """
+        self._select_bank(0x00)
+        gyro_data = self._read_register(self.GYRO_XOUT_H, 6)
+        return self.gyro_cal.apply(*struct.unpack('>hhh', gyro_data))
 
     def read_acceleration(self):
-        accel_data = self.i2c.readfrom_mem(self.address, self.ACCEL_XOUT_H, 6)
-        x, y, z = struct.unpack('>hhh', accel_data)
-        scaleFactor = self.ACCEL_SENSITIVITY_SCALE_FACTOR[self.get_accel_config()]
+        x, y, z = self.read_raw_acceleration()
+        scale = self._accel_scale
         return {
-            'accel_x': x / scaleFactor,
-            'accel_y': y / scaleFactor,
-            'accel_z': z / scaleFactor
+            'accel_x': x * scale,
+            'accel_y': y * scale,
+            'accel_z': z * scale
         }
     
     def read_acceleration_round(self):
-        accel_data = self.i2c.readfrom_mem(self.address, self.ACCEL_XOUT_H, 6)
-        x, y, z = struct.unpack('>hhh', accel_data)
-        scaleFactor = self.ACCEL_SENSITIVITY_SCALE_FACTOR[self.get_accel_config()]
+        x, y, z = self.read_raw_acceleration()
+        scale = self._accel_scale
         return {
-            'accel_x': round(x / scaleFactor, 3),
-            'accel_y': round(y / scaleFactor, 3),
-            'accel_z': round(z / scaleFactor, 3)
+            'accel_x': round(x * scale, 3),
+            'accel_y': round(y * scale, 3),
+            'accel_z': round(z * scale, 3)
         }
 
     def read_gyroscope(self):
-        gyro_data = self.i2c.readfrom_mem(self.address, self.GYRO_XOUT_H, 6)
-        x, y, z = struct.unpack('>hhh', gyro_data)
-        scaleFactor = self.GYRO_SENSITIVITY_SCALE_FACTOR[self.get_gyro_config()]
-        gyro_x = x / self.GYRO_SCALE_FACTOR
-        gyro_y = y / self.GYRO_SCALE_FACTOR
-        gyro_z = z / self.GYRO_SCALE_FACTOR
-        return {'gyro_x': gyro_x, 'gyro_y': gyro_y, 'gyro_z': gyro_z}
+        x, y, z = self.read_raw_gyroscope()
+        scale = self._gyro_scale
+        return {'gyro_x': x * scale, 'gyro_y': y * scale, 'gyro_z': z * scale}
     
     def read_gyroscope_round(self):
-        gyro_data = self.i2c.readfrom_mem(self.address, self.GYRO_XOUT_H, 6)
-        x, y, z = struct.unpack('>hhh', gyro_data)
-        scaleFactor = self.GYRO_SENSITIVITY_SCALE_FACTOR[self.get_gyro_config()]
-        gyro_x = x / self.GYRO_SCALE_FACTOR
-        gyro_y = y / self.GYRO_SCALE_FACTOR
-        gyro_z = z / self.GYRO_SCALE_FACTOR
-        return {'gyro_x': round(gyro_x, 3),
-                'gyro_y': round(gyro_y, 3),
-                'gyro_z': round(gyro_z, 3)}
+        x, y, z = self.read_raw_gyroscope()
+        scale = self._gyro_scale
+        return {'gyro_x': round(x * scale, 3),
+                'gyro_y': round(y * scale, 3),
+                'gyro_z': round(z * scale, 3)}
+
+    def estimate_gyro_bias(self, samples=200, timeout_ms=5000):
+        """ Measure the gyro zero-rate offset while the can is still on the pad.
+            The stored offset is kept if the can does not stay still long enough.
+        """
+        estimator = GyroBiasEstimator(samples)
+        stored = (self.gyro_cal.ox, self.gyro_cal.oy, self.gyro_cal.oz)
+        start = time.ticks_ms()
+        while not estimator.done and time.ticks_diff(time.ticks_ms(), start) < timeout_ms:
+            # Estimated on uncorrected samples
+            self._select_bank(0x00)
+            gyro_data = self._read_register(self.GYRO_XOUT_H, 6)
+            estimator.add(*struct.unpack('>hhh', gyro_data))
+            time.sleep_ms(2)
+        bias = estimator.bias()
+        if bias is None:
+            log.log_event("WARNING", "Gyro bias not estimated, can was moving", running="accelerometer.py", function="estimate_gyro_bias()", restarts=estimator.restarts, offset=stored)
+            return None
+        self.gyro_cal.set_offset(*bias)
+        log.log_event("INFO", "Gyro bias estimated", running="accelerometer.py", function="estimate_gyro_bias()", bias=bias, restarts=estimator.restarts)
+        return bias
 
     def get_accel_config(self):
-        config = self.i2c.readfrom_mem(self.address, self.ACCEL_CONFIG, 1)[0]
+        self._select_bank(0x02)
+        config = self._read_register(self.ACCEL_CONFIG, 1)[0]
+        self._select_bank(0x00)
         return config & 0x06  # Mask to keep only FS_SEL bits
 
     def get_gyro_config(self):
-        config = self.i2c.readfrom_mem(self.address, self.GYRO_CONFIG, 1)[0]
+        self._select_bank(0x02)
+        config = self._read_register(self.GYRO_CONFIG, 1)[0]
+        self._select_bank(0x00)
         return config & 0x06  # Mask to keep only FS_SEL bits
@@ -1,4 +1,11 @@
 from machine import I2C, Pin
+from micropython import const
+import json
+import struct
+import time
+from utils.logger import get_logger
+
+log = get_logger()
 
 # default address
 CCS811_ADDR = const(0x5B) # or 0x5A
@@ -20,6 +27,26 @@ CCS811_ERROR_ID = const(0xE0)
 CCS811_APP_START = const(0xF4)
 CCS811_SW_RESET = const(0xFF)
 
+# STATUS register bits
+CCS811_STATUS_ERROR = const(0x01)
+CCS811_STATUS_DATA_READY = const(0x08)
+CCS811_STATUS_APP_VALID = const(0x10)
+CCS811_STATUS_FW_MODE = const(0x80)
+
+# MEAS_MODE register: drive mode 1 (one sample per second) and nINT on data ready
+CCS811_DRIVE_MODE_1SEC = const(0x10)
+CCS811_INT_DATARDY = const(0x08)
+
+# ALG_RESULT_DATA burst: eCO2 (2), TVOC (2), STATUS, ERROR_ID, RAW_DATA (2)
+CCS811_ALG_RESULT_LEN = const(8)
+
+# Baseline persistence. A conditioned sensor only needs its baseline
+# restored to skip the burn-in; a fresh one should run for 20 minutes
+# before its baseline is worth saving.
+CCS811_BASELINE_FILE = 'ccs811_baseline.json'
+CCS811_BASELINE_MIN_RUNTIME_MS = const(1200000)     # 20 minutes
+CCS811_BASELINE_SAVE_INTERVAL_MS = const(600000)    # 10 minutes
+
 # CCS811_REF_RESISTOR = const(100000)
 
 class AirQualitySensor:
@@ -38,33 +65,46 @@ class AirQualitySensor:
 class CCS811:
     """CCS811 gas sensor. Measures eCO2 in ppm and TVOC in ppb"""
 
-    def __init__(self, i2c_channel=0, scl_pin=7, sda_pin=15, freq=400000, address=CCS811_ADDR):
+    ERROR_MESSAGES = (
+        (5, 'HeaterSupply'),
+        (4, 'HeaterFault'),
+        (3, 'MaxResistance'),
+        (2, 'MeasModeInvalid'),
+        (1, 'ReadRegInvalid'),
+        (0, 'MsgInvalid'),
+    )
+
+    def __init__(self, i2c_channel=0, scl_pin=7, sda_pin=15, freq=400000, address=CCS811_ADDR, int_pin=None, baseline_file=CCS811_BASELINE_FILE):
         self.i2c = I2C(i2c_channel, scl=Pin(scl_pin), sda=Pin(sda_pin))
         self.address = address
-        self.tVOC = 0
-        self.eCO2 = 0
+        self.channel = i2c_channel
+        # nINT is open drain and active low; without it the STATUS byte of
+        # the result burst tells us whether the sample is new
+        self.int_pin = Pin(int_pin, Pin.IN, Pin.PULL_UP) if int_pin is not None else None
+        self.baseline_file = baseline_file
+        self.tVOC = None
+        self.eCO2 = None
+        self.error_id = 0
+        self._result = bytearray(CCS811_ALG_RESULT_LEN)
+        self._env = bytearray(4)
+        self._last_env = None
+        self._start = time.ticks_ms()
+        self._last_baseline_save = self._start
         self.configure_ccs811()
+        self.restore_baseline()
 
-    def print_error(self):
+    def print_error(self, error=None):
         """Error code. """
-
-        error = self.i2c.readfrom_mem(self.address, CCS811_ERROR_ID, 1)
+        if error is None:
+            error = self.i2c.readfrom_mem(self.address, CCS811_ERROR_ID, 1)[0]
         message = 'Error: '
 
-        if (error[0] >> 5) & 1:
-            message += 'HeaterSupply '
-        elif (error[0] >> 4) & 1:
-            message += 'HeaterFault '
-        elif (error[0] >> 3) & 1:
-            message += 'MaxResistance '
-        elif (error[0] >> 2) & 1:
-            message += 'MeasModeInvalid '
-        elif (error[0] >> 1) & 1:
-            message += 'ReadRegInvalid '
-        elif (error[0] >> 0) & 1:
-            message += 'MsgInvalid '
+        for bit, name in CCS811.ERROR_MESSAGES:
+            if (error >> bit) & 1:
+                message += name + ' '
 
         print(message)
+        log.log_event("ERROR", "CCS811 error", running="air_quality.py", error_id=error, error=message)
         
     def configure_ccs811(self):
         try:
@@ -88,7 +128,10 @@ class CCS811:
                 self.print_error()
                 raise ValueError('Error at AppStart.')
 
-            self.set_drive_mode(0x18)
+            mode = CCS811_DRIVE_MODE_1SEC
+            if self.int_pin is not None:
+                mode |= CCS811_INT_DATARDY
+            self.set_drive_mode(mode)
 
             if self.check_for_error():
                 self.print_error()
@@ -105,95 +148,130 @@ class CCS811:
         baseline = (baselineMSB << 8) | baselineLSB
         return baseline
 
-    def check_for_error(self):
-        value = self.i2c.readfrom_mem(self.address, CCS811_STATUS, 1)
-        v = ((value[0] >> 0) & 1)
+    def set_base_line(self, baseline):
+        """ Write a previously saved baseline back to the sensor. """
+        self.i2c.writeto_mem(self.address, CCS811_BASELINE, struct.pack('>H', baseline & 0xFFFF))
 
-        return ((value[0] >> 0) & 1)
+    def save_baseline(self):
+        """ Persist the current baseline to flash so the next boot can skip the burn-in. """
+        baseline = self.get_base_line()
+        try:
+            with open(self.baseline_file, 'w') as file:
+                json.dump({'baseline': baseline, 'epoch': time.time()}, file)
+            self._last_baseline_save = time.ticks_ms()
+        except OSError as e:
+            log.log_event("WARNING", "CCS811 baseline not saved", running="air_quality.py", error=str(e))
+        return baseline
 
-    def app_valid(self):
-        value = self.i2c.readfrom_mem(self.address, CCS811_STATUS, 1)
-        v = ((value[0] >> 4) & 1)
+    def restore_baseline(self):
+        """ Restore the baseline saved by a previous boot, if there is one. """
+        try:
+            with open(self.baseline_file, 'r') as file:
+                baseline = json.load(file)['baseline']
+        except (OSError, ValueError, KeyError):
+            return None
+        self.set_base_line(baseline)
+        log.log_event("INFO", "CCS811 baseline restored", running="air_quality.py", baseline=baseline)
+        return baseline
+
+    def maybe_save_baseline(self):
+        """ Save the baseline once the sensor is conditioned, then periodically. """
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self._start) < CCS811_BASELINE_MIN_RUNTIME_MS:
+            return False
+        if time.ticks_diff(now, self._last_baseline_save) < CCS811_BASELINE_SAVE_INTERVAL_MS:
+            return False
+        self.save_baseline()
+        return True
+
+    def read_status(self):
+        return self.i2c.readfrom_mem(self.address, CCS811_STATUS, 1)[0]
 
-        return ((value[0] >> 4) & 1)
+    def check_for_error(self):
+        return self.read_status() & CCS811_STATUS_ERROR
+
+    def app_valid(self):
+        return self.read_status() & CCS811_STATUS_APP_VALID
 
     def set_drive_mode(self, mode):
         
         self.i2c.writeto_mem(self.address, CCS811_MEAS_MODE, bytes([mode]))
 
-    def data_available(self):
-
-        status = self.i2c.readfrom_mem(self.address, 0x00, 1)
-        value = self.i2c.readfrom_mem(self.address, CCS811_STATUS, 1)
+    def set_environmental_data(self, humidity, temperature):
+        """ Write relative humidity (%) and temperature (C) to ENV_DATA so the
+            eCO2/TVOC algorithm is compensated. The register holds both in
+            units of 1/512; unchanged values are not rewritten.
+        """
+        if humidity is None or temperature is None:
+            return False
+        hum = int(humidity * 512 + 0.5)
+        temp = int((temperature + 25) * 512 + 0.5)
+        hum = min(max(hum, 0), 0xFFFF)
+        temp = min(max(temp, 0), 0xFFFF)
+        if (hum, temp) == self._last_env:
+            return False
+        struct.pack_into('>HH', self._env, 0, hum, temp)
+        self.i2c.writeto_mem(self.address, CCS811_ENV_DATA, self._env)
+        self._last_env = (hum, temp)
+        return True
 
-        return value[0] << 3
+    def data_available(self):
+        """ True when a new result is waiting. Uses nINT when wired. """
+        if self.int_pin is not None:
+            return self.int_pin.value() == 0
+        return bool(self.read_status() & CCS811_STATUS_DATA_READY)
 
     def readeCO2(self):
         """ Equivalent Carbone Dioxide in parts per millions. Clipped to 400 to 8192ppm."""
-
-        if self.data_available():
-
-            d = self.i2c.readfrom_mem(self.address, CCS811_ALG_RESULT_DATA, 4)
-
-            co2MSB = d[0]
-            co2LSB = d[1]
-
-            return ((co2MSB << 8) | co2LSB)
-
-        elif self.check_for_error():
-                self.print_error()
+        self.readValues()
+        return self.eCO2
 
     def readtVOC(self):
         """ Total Volatile Organic Compound in parts per billion. """
-
-        if self.data_available():
-
-            d = self.i2c.readfrom_mem(self.address, CCS811_ALG_RESULT_DATA, 4)
-
-            tvocMSB = d[2]
-            tvocLSB = d[3]
-
-            return ((tvocMSB << 8) | tvocLSB)
-
-        elif self.check_for_error():
-                self.print_error()
+        self.readValues()
+        return self.tVOC
 
     def readValues(self):
-        """ Total Volatile Organic Compound in parts per billion. """
-
-        if self.data_available():
-
-            d = self.i2c.readfrom_mem(self.address, CCS811_ALG_RESULT_DATA, 4)
-
-            co2MSB = d[0]
-            co2LSB = d[1]
-            tvocMSB = d[2]
-            tvocLSB = d[3]
+        """ Read eCO2, TVOC and STATUS in one 8-byte burst.
+            Returns True when a new sample was latched, False otherwise.
+        """
+        # nINT is high while no new sample is waiting; skip the bus entirely
+        if self.int_pin is not None and self.int_pin.value():
+            return False
 
-            self.eCO2 = ((co2MSB << 8) | co2LSB)
-            self.tVOC = ((tvocMSB << 8) | tvocLSB)
+        d = self._result
+        self.i2c.readfrom_mem_into(self.address, CCS811_ALG_RESULT_DATA, d)
+        status = d[4]
 
-            return True
+        if status & CCS811_STATUS_ERROR:
+            self.error_id = d[5]
+            self.print_error(self.error_id)
+            return False
 
-        elif self.check_for_error():
-            self.print_error()
+        if not status & CCS811_STATUS_DATA_READY:
             return False
 
+        self.eCO2, self.tVOC = struct.unpack_from('>HH', d)
+        return True
+
     def reset(self):
         """ Initiate a software reset. """
 
         seq = bytearray([0x11, 0xE5, 0x72, 0x8A])
         self.i2c.writeto_mem(self.address, CCS811_SW_RESET, seq)
+        self._last_env = None
         
-    def read_quality(self):
+    def read_quality(self, humidity=None, temperature=None):
         """
         Reads the air quality data from the CCS811 sensor and validates it.
+        Humidity and temperature, when given, are used for compensation.
+        The last valid sample is held until the sensor latches a new one.
         """
         try:
-            if self.readValues():
-                return {'eCO2': self.eCO2, 'tVOC' : self.tVOC}
-            else:
-                return {'eCO@': None, 'tVOC': None}
+            self.set_environmental_data(humidity, temperature)
+            self.readValues()
+            self.maybe_save_baseline()
+            return {'eCO2': self.eCO2, 'tVOC' : self.tVOC}
         except Exception as e:
-            logger.error(f"Failed to read temperature from MCP9808: {e}")
+            log.log_event("ERROR", "Failed to read air quality from CCS811", running="air_quality.py", error=str(e))
             return {}  # Return an empty dictionary in case of error
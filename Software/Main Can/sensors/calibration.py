@@ -0,0 +1,199 @@
+# Imports
+import json
+import machine
+import ubinascii
+from utils.logger import get_logger
+
+log = get_logger()
+
+# Correction matrices are stored as Q14 fixed-point integers, so applying
+# them costs nine integer multiplies and three shifts per sample and never
+# allocates a float on the hot path.
+CAL_Q = 14
+CAL_ONE = 1 << CAL_Q
+CAL_ROUND = 1 << (CAL_Q - 1)
+
+# One calibration file per device, so swapping boards never applies
+# another unit's corrections
+CALIBRATION_FILE = 'calibration_{}.json'
+
+# Pad-time gyro bias estimation
+GYRO_BIAS_SAMPLES = 200
+GYRO_BIAS_MAX_SPREAD = 48   # Raw counts (~3 dps at ±2000 dps); more means the can moved
+
+
+def device_serial():
+    """ Return the unique ID of this board as a hex string. """
+    return ubinascii.hexlify(machine.unique_id()).decode()
+
+
+class AxisCorrection:
+    """ Affine correction of one 3-axis sensor: out = M * (raw - offset).
+
+        'matrix' is a row-major list of nine Q14 integers (combined scale,
+        misalignment and soft-iron correction) and 'offset' three integers
+        in raw counts (bias or hard-iron offset). Both are computed on the
+        host; the can only applies them.
+    """
+
+    def __init__(self, matrix=None, offset=None):
+        self.set(matrix, offset)
+
+    def set(self, matrix=None, offset=None):
+        if matrix is None:
+            matrix = [CAL_ONE, 0, 0, 0, CAL_ONE, 0, 0, 0, CAL_ONE]
+        if offset is None:
+            offset = [0, 0, 0]
+        if len(matrix) != 9 or len(offset) != 3:
+            raise ValueError("Calibration needs a 3x3 matrix and 3 offsets")
+        # Unpacked once, attribute access is much cheaper than indexing
+        self.m00, self.m01, self.m02, self.m10, self.m11, self.m12, self.m20, self.m21, self.m22 = [int(v) for v in matrix]
+        self.ox, self.oy, self.oz = [int(v) for v in offset]
+        self.identity = (self.m00 == self.m11 == self.m22 == CAL_ONE
+                         and not (self.m01 or self.m02 or self.m10 or self.m12 or self.m20 or self.m21))
+
+    def set_offset(self, x, y, z):
+        self.ox, self.oy, self.oz = int(x), int(y), int(z)
+
+    def apply(self, x, y, z):
+        """ Correct one raw sample, returns integer raw counts. """
+        x -= self.ox
+        y -= self.oy
+        z -= self.oz
+        if self.identity:
+            return x, y, z
+        return ((self.m00 * x + self.m01 * y + self.m02 * z + CAL_ROUND) >> CAL_Q,
+                (self.m10 * x + self.m11 * y + self.m12 * z + CAL_ROUND) >> CAL_Q,
+                (self.m20 * x + self.m21 * y + self.m22 * z + CAL_ROUND) >> CAL_Q)
+
+    def to_dict(self):
+        return {
+            'matrix': [self.m00, self.m01, self.m02, self.m10, self.m11, self.m12, self.m20, self.m21, self.m22],
+            'offset': [self.ox, self.oy, self.oz]
+        }
+
+    @classmethod
+    def from_dict(cls, entry):
+        return cls(entry.get('matrix'), entry.get('offset'))
+
+
+class GyroBiasEstimator:
+    """ Estimates the gyro zero-rate offset while the can sits on the pad.
+
+        Feed raw samples with add(); the window restarts whenever the
+        spread on any axis exceeds 'max_spread' counts, since the can was
+        moved. The bias is the mean of 'samples' consecutive still samples.
+    """
+
+    def __init__(self, samples=GYRO_BIAS_SAMPLES, max_spread=GYRO_BIAS_MAX_SPREAD):
+        self.samples = samples
+        self.max_spread = max_spread
+        self.restarts = 0
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sx = self.sy = self.sz = 0
+        self.lo = None
+        self.hi = None
+
+    def add(self, x, y, z):
+        """ Add one raw sample. Returns True once the estimate is complete. """
+        if self.lo is None:
+            self.lo = [x, y, z]
+            self.hi = [x, y, z]
+        else:
+            lo, hi = self.lo, self.hi
+            for i, v in ((0, x), (1, y), (2, z)):
+                if v < lo[i]:
+                    lo[i] = v
+                elif v > hi[i]:
+                    hi[i] = v
+                if hi[i] - lo[i] > self.max_spread:
+                    # Motion detected, start a new still window
+                    self.restarts += 1
+                    self.reset()
+                    return False
+        self.sx += x
+        self.sy += y
+        self.sz += z
+        self.count += 1
+        return self.done
+
+    @property
+    def done(self):
+        return self.count >= self.samples
+
+    def bias(self):
+        """ Mean of the still window in raw counts, None until complete. """
+        if not self.done:
+            return None
+        n = self.count
+        half = n // 2
+        # Rounded integer mean
+        return ((self.sx + half) // n, (self.sy + half) // n, (self.sz + half) // n)
+
+
+class Calibration:
+    """ Calibration set of this device, stored in calibration_<serial>.json.
+
+        The file holds one entry per sensor and measurement kind, e.g.
+        {"serial": "...", "q": 14, "icm20948": {"accel": {...}, "gyro": {...},
+        "mag": {...}}, "lis3mdl": {"mag": {...}}}. Sensors without an entry
+        get an identity correction.
+    """
+
+    def __init__(self, serial=None):
+        self.serial = serial or device_serial()
+        self.filename = CALIBRATION_FILE.format(self.serial)
+        self.entries = {}
+        self.loaded = False
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as file:
+                data = json.load(file)
+        except OSError:
+            log.log_event("WARNING", "No calibration for this device, using raw sensor data", running="calibration.py", serial=self.serial)
+            return False
+        if data.get('q', CAL_Q) != CAL_Q:
+            log.log_event("ERROR", "Calibration fixed-point format mismatch", running="calibration.py", serial=self.serial, q=data.get('q'))
+            return False
+        for sensor, kinds in data.items():
+            if isinstance(kinds, dict):
+                for kind, entry in kinds.items():
+                    self.get(sensor, kind).set(entry.get('matrix'), entry.get('offset'))
+        self.loaded = True
+        log.log_event("INFO", "Calibration loaded", running="calibration.py", serial=self.serial)
+        return True
+
+    def save(self):
+        data = {'serial': self.serial, 'q': CAL_Q}
+        for (sensor, kind), correction in self.entries.items():
+            data.setdefault(sensor, {})[kind] = correction.to_dict()
+        try:
+            with open(self.filename, 'w') as file:
+                json.dump(data, file)
+        except OSError as e:
+            log.log_event("ERROR", "Calibration not saved", running="calibration.py", serial=self.serial, error=str(e))
+            return False
+        return True
+
+    def get(self, sensor, kind):
+        """ Return the (shared) correction for one sensor and kind. """
+        correction = self.entries.get((sensor, kind))
+        if correction is None:
+            correction = AxisCorrection()
+            self.entries[(sensor, kind)] = correction
+        return correction
+
+
+_calibration = None
+
+def get_calibration():
+    """ Return the calibration of this device, loaded on first use. """
+    global _calibration
+    if _calibration is None:
+        _calibration = Calibration()
+        _calibration.load()
+    return _calibration
@@ -1,6 +1,8 @@
 # Imports
 from micropython import const
 from machine import I2C, Pin
+from sensors.registers import Register, RegisterMap
+from sensors.calibration import get_calibration
 
 # # device I2C address
 # LIS3MDL_ADDR     = const(0x1E)
@@ -63,7 +65,7 @@ class LIS3MDL:
     LIS_CTRL_REG2   = const(0x21)   # [+] Set gauss scale
     LIS_CTRL_REG3   = const(0x22)   # [+] Set operating/power modes
     LIS_CTRL_REG4   = const(0x23)   # [+] Set operating mode and rate for Z-axis
-    LIS_CTRL_REG5   = const(0x24)   # [ ] Set fast read, block data update modes
+    LIS_CTRL_REG5   = const(0x24)   # [+] Set fast read, block data update modes
 
     LIS_STATUS_REG  = const(0x27)   # [ ] Read device status (Is new data available?)
 
@@ -82,6 +84,58 @@ class LIS3MDL:
     LIS_INT_THS_L   = const(0x32)   # [-] Interrupt threshold, low byte
     LIS_INT_THS_H   = const(0x33)   # [-] Interrupt threshold, high byte
 
+    # Setting the MSB of the sub-address enables register auto-increment,
+    # so a whole output block can be read in a single I2C transaction
+    LIS_AUTO_INCREMENT = const(0x80)
+
+    # CTRL_REG1 / CTRL_REG4 / CTRL_REG5 bits
+    LIS_TEMP_EN     = const(0x80)
+    LIS_FAST_ODR    = const(0x02)
+    LIS_BDU         = const(0x40)   # Block data update (no torn LSB/MSB pairs)
+
+    # Operating modes (OM bits in CTRL_REG1, OMZ bits in CTRL_REG4)
+    LIS_MODE_LP     = const(0x00)   # Low power
+    LIS_MODE_MP     = const(0x01)   # Medium performance
+    LIS_MODE_HP     = const(0x02)   # High performance
+    LIS_MODE_UHP    = const(0x03)   # Ultra-high performance
+
+    # Regular output data rates (Hz) -> DO[2:0] bits of CTRL_REG1
+    ODR_MAP = {
+        0.625: 0x00,
+        1.25: 0x01,
+        2.5: 0x02,
+        5: 0x03,
+        10: 0x04,
+        20: 0x05,
+        40: 0x06,
+        80: 0x07,
+    }
+
+    # With FAST_ODR set the rate is given by the operating mode
+    FAST_ODR_MAP = {
+        155: LIS_MODE_UHP,
+        300: LIS_MODE_HP,
+        560: LIS_MODE_MP,
+        1000: LIS_MODE_LP,
+    }
+
+    # Full scale (gauss) -> (CTRL_REG2 value, LSB/gauss)
+    SENSITIVITY_MAP = {
+        4: (0x00, 6842),    # ±4 gauss -> 6842 LSB/gauss
+        8: (0x20, 3421),    # ±8 gauss -> 3421 LSB/gauss
+        12: (0x40, 2281),   # ±12 gauss -> 2281 LSB/gauss
+        16: (0x60, 1711)    # ±16 gauss -> 1711 LSB/gauss
+    }
+
+    # Register map for the output blocks; X, Y, Z and temperature are
+    # adjacent so any combination is read in a single burst
+    REGISTERS = (
+        Register('OUT_X', LIS_OUT_X_L, 2, signed=True),
+        Register('OUT_Y', LIS_OUT_Y_L, 2, signed=True),
+        Register('OUT_Z', LIS_OUT_Z_L, 2, signed=True),
+        Register('TEMP_OUT', LIS_TEMP_OUT_L, 2, signed=True),
+    )
+
     # Output registers used by the magnetometer
     magRegisters = [
         LIS_OUT_X_L,    # low byte of X value
@@ -99,10 +153,17 @@ class LIS3MDL:
     ]
     
     def __init__(self, i2c_channel=0, scl_pin=7, sda_pin=15, freq=400000, address=0x1E):
-        # Initialize the 6-axis accelerometer and gyroscope
+        # Initialize the 3-axis magnetometer
         self.i2c = I2C(i2c_channel, scl=Pin(scl_pin), sda=Pin(sda_pin))
+        self.channel = i2c_channel
         self.address = address
+        self.gauss_range = 4
         self.sensitivity = 6842  # Default to ±4 gauss
+        self._scale = 1.0 / self.sensitivity
+        self.odr = 10
+        self.regs = RegisterMap(self.i2c, self.address, LIS3MDL.REGISTERS, auto_increment=LIS_AUTO_INCREMENT)
+        # Hard/soft-iron correction, applied in raw counts
+        self.mag_cal = get_calibration().get('lis3mdl', 'mag')
         # Initialization commands to configure the sensors
         if (self.WhoAmI() != b'\x3d'):
             raise OSError("No LIS3MDL device on address {} found".format(self.address))
@@ -115,7 +176,7 @@ class LIS3MDL:
         """ Clean up routines. """
         try:
             # Power down magnetometer
-            self._WriteRegister(LIS3MDL_ADDR, self.LIS_CTRL_REG3, 0x03)
+            self._WriteRegister(self.address, LIS_CTRL_REG3, 0x03)
         except:
             pass
 
@@ -148,16 +209,43 @@ class LIS3MDL:
 
 
     def updateSensitivity(self, gauss_range):
-        sensitivity_map = {
-            4: 6842,  # ±4 gauss -> 6842 LSB/gauss
-            8: 3421,  # ±8 gauss -> 3421 LSB/gauss
-            12: 2281, # ±12 gauss -> 2281 LSB/gauss
-            16: 1711  # ±16 gauss -> 1711 LSB/gauss
-        }
-        self.sensitivity = sensitivity_map.get(gauss_range, 6842)  # Default to ±4 gauss if not specified
+        """ Set the full scale range and cache the matching sensitivity. """
+        if gauss_range not in LIS3MDL.SENSITIVITY_MAP:
+            gauss_range = 4  # Default to ±4 gauss if not supported
+        reg_value, sensitivity = LIS3MDL.SENSITIVITY_MAP[gauss_range]
         # Update the sensor configuration to use the new gauss range
-        reg_value = {4: 0x00, 8: 0x20, 12: 0x40, 16: 0x60}[gauss_range]
         self._WriteRegister(self.address, LIS_CTRL_REG2, reg_value)
+        self.gauss_range = gauss_range
+        self.sensitivity = sensitivity
+        self._scale = 1.0 / sensitivity
+
+
+    def setDataRate(self, odr):
+        """ Configure the output data rate in Hz.
+            Regular rates go up to 80 Hz (in ultra-high-performance mode);
+            155, 300, 560 and 1000 Hz use the FAST_ODR setting, where the
+            rate is selected through the operating mode.
+            Returns the (CTRL_REG1 rate bits, CTRL_REG4 value) written.
+        """
+        if odr in LIS3MDL.FAST_ODR_MAP:
+            mode = LIS3MDL.FAST_ODR_MAP[odr]
+            rate_bits = (mode << 5) | LIS_FAST_ODR
+        elif odr in LIS3MDL.ODR_MAP:
+            mode = LIS_MODE_UHP
+            rate_bits = (mode << 5) | (LIS3MDL.ODR_MAP[odr] << 2)
+        else:
+            raise ValueError("Unsupported LIS3MDL data rate {} Hz".format(odr))
+
+        ctrl_reg4 = mode << 2
+        self.odr = odr
+
+        # Keep the temperature enable bit as configured
+        ctrl_reg1 = rate_bits
+        if self.lisTempEnabled:
+            ctrl_reg1 |= LIS_TEMP_EN
+        self._WriteRegister(self.address, LIS_CTRL_REG4, ctrl_reg4)
+        self._WriteRegister(self.address, LIS_CTRL_REG1, ctrl_reg1)
+        return rate_bits, ctrl_reg4
 
 
     def _getSensorRawLoHi3(self, address, outRegs):
@@ -167,20 +255,8 @@ class LIS3MDL:
             'address' is the I2C slave address.
             'outRegs' is a list of the output registers to read.
         """
-        # Read register outputs and combine low and high byte values
-        xl = self._ReadRegister(address, outRegs[0])
-        xh = self._ReadRegister(address, outRegs[1])
-        yl = self._ReadRegister(address, outRegs[2])
-        yh = self._ReadRegister(address, outRegs[3])
-        zl = self._ReadRegister(address, outRegs[4])
-        zh = self._ReadRegister(address, outRegs[5])
-
-        xVal = self._combineSignedLoHi(xl, xh)
-        yVal = self._combineSignedLoHi(yl, yh)
-        zVal = self._combineSignedLoHi(zl, zh)
-
-        # Return the vector
-        return [xVal, yVal, zVal]
+        # One 6-byte auto-increment read instead of six single-byte reads
+        return list(self.regs.read_many('OUT_X', 'OUT_Y', 'OUT_Z'))
 
     def _getSensorRawLoHi1(self, address, outRegs):
         """ Return a scalar representing the combined raw signed 16 bit
@@ -189,64 +265,38 @@ class LIS3MDL:
             'address' is the I2C slave address.
             'outRegs' is a list of the output registers to read.
         """
-        # Read register outputs and combine low and high byte values
-        xl = self._ReadRegister(address, outRegs[0])
-        xh = self._ReadRegister(address, outRegs[1])
-
-        xVal = self._combineSignedLoHi(xl, xh)
-        # Return the scalar
-        return xVal
+        return self.regs.read('TEMP_OUT')
 
 
-    def enableLIS(self, magnetometer = True, temperature = True):
+    def enableLIS(self, magnetometer = True, temperature = True, odr = 10, gauss_range = 4):
         """ Enable and set up the given sensors in the magnetometer
-            device and determine whether to auto increment registers
-            during I2C read operations.
+            device. Output registers are always read with auto increment
+            and block data update, so a sample is never split between
+            two conversions.
         """
         print("Enabling LIS sensors")
         # Disable magnetometer and temperature sensor first
-        self._WriteRegister(LIS3MDL_ADDR, LIS_CTRL_REG1, 0x00)
-        self._WriteRegister(LIS3MDL_ADDR, LIS_CTRL_REG3, 0x03)
+        self._WriteRegister(self.address, LIS_CTRL_REG1, 0x00)
+        self._WriteRegister(self.address, LIS_CTRL_REG3, 0x03)
 
         # Initialize flags
         self.magEnabled = False
-        self.lisTempEnabled = False
+        self.lisTempEnabled = temperature
 
-        # Enable device in continuous conversion mode
-        self._WriteRegister(LIS3MDL_ADDR, LIS_CTRL_REG3, 0x00)
-
-        # Initial value for CTRL_REG1
-        ctrl_reg1 = 0x00
+        # Block data update
+        self._WriteRegister(self.address, LIS_CTRL_REG5, LIS_BDU)
 
         if magnetometer:
-            # Magnetometer
-
-            # CTRL_REG1
-            # Ultra-high-performance mode for X and Y
-            # Output data rate 10Hz
-            # 01110000b
-            ctrl_reg1 += 0x70
-
-            # CTRL_REG2
-            # +/- 4 gauss full scale
-            self._WriteRegister(LIS3MDL_ADDR, LIS_CTRL_REG2, 0x00)
-
-            # CTRL_REG4
-            # Ultra-high-performance mode for Z
-            # 00001100b
-            self._WriteRegister(LIS3MDL_ADDR, LIS_CTRL_REG4, 0x0c)
-
+            # Full scale and cached sensitivity (CTRL_REG2)
+            self.updateSensitivity(gauss_range)
+            # Operating mode and data rate for X, Y (CTRL_REG1) and Z (CTRL_REG4)
+            self.setDataRate(odr)
             self.magEnabled = True
+        elif temperature:
+            self._WriteRegister(self.address, LIS_CTRL_REG1, LIS_TEMP_EN)
 
-        if temperature:
-            # Temperature sensor enabled
-            # 10000000b
-            ctrl_reg1 += 0x80
-            self.lisTempEnabled = True
-            
-
-        # Write calculated value to the CTRL_REG1 register
-        self._WriteRegister(LIS3MDL_ADDR, LIS_CTRL_REG1, ctrl_reg1)
+        # Enable device in continuous conversion mode
+        self._WriteRegister(self.address, LIS_CTRL_REG3, 0x00)
 
     def getMagnetometerRaw(self):
         """ Return a 3-dimensional vector (list) of raw magnetometer
@@ -265,10 +315,10 @@ class LIS3MDL:
         if not self.magEnabled:
             raise(Exception('Magnetometer has to be enabled first'))
         
-        raw_data = self._getSensorRawLoHi3(self.address, LIS3MDL.magRegisters)
-        # Convert raw data to Gauss
-        gauss_data = [value / self.sensitivity for value in raw_data]
-        return gauss_data
+        x, y, z = self.mag_cal.apply(*self._getSensorRawLoHi3(self.address, LIS3MDL.magRegisters))
+        # Convert corrected raw data to Gauss with the cached scale
+        scale = self._scale
+        return [x * scale, y * scale, z * scale]
 
     def getLISTemperatureRaw(self):
         """ Return the raw temperature value. """
@@ -284,7 +334,10 @@ class LIS3MDL:
         """ Return a 4-tuple of the raw output of the two sensors,
             magnetometer and temperature.
         """
-        return self.getMagnetometerRaw() + [self.getLISTemperatureRaw()]
+        if not (self.magEnabled and self.lisTempEnabled):
+            raise(Exception('Magnetometer and temperature sensor have to be enabled first'))
+        # All four outputs are adjacent: one 8-byte burst
+        return list(self.regs.read_many('OUT_X', 'OUT_Y', 'OUT_Z', 'TEMP_OUT'))
 
 
     def getLISTemperatureCelsius(self, rounded = True):
@@ -339,4 +392,4 @@ class LIS3MDL:
                     }
         except Exception as e:
             print(f"Failed to read magnetometer: {e}")
-            return {}  # Return an empty dictionary in case of error
\ No newline at end of file
+            return {}  # Return an empty dictionary in case of error
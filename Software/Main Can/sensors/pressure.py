@@ -5,9 +5,10 @@ import time
 import utime
 import struct
 import math
-from utils.logger import Logger
+from utils.logger import get_logger
+from sensors.registers import Register, RegisterMap, ShadowRegisters
 
-log = Logger()
+log = get_logger()
 
 def read24(arr: ReadableBuffer) -> float:
     """Parse an unsigned 24-bit value as a floating point and return it."""
@@ -81,6 +82,16 @@ class LPS25H(object):
     LPS25H_RPDS_L         = const(0x39)
     LPS25H_RPDS_H         = const(0x3A)
 
+    # Auto-increment bit of the sub-address for multi-byte reads
+    LPS25H_AUTO_INCREMENT = const(0x80)
+
+    # Register map for the output block; pressure and temperature are
+    # adjacent (0x28-0x2C) so a full sample is a single 5-byte burst
+    REGISTERS = (
+        Register('PRESS_OUT', LPS25H_PRESS_OUT_XL, 3, signed=True),
+        Register('TEMP_OUT', LPS25H_TEMP_OUT_L, 2, signed=True),
+    )
+
     # Registers used for reference pressure
     refRegisters = [
         LPS25H_REF_P_XL, # lowest byte of reference pressure value
@@ -107,6 +118,7 @@ class LPS25H(object):
         self.channel= i2c_channel
         self.address = address | SA0
         self.pressEnabled = False
+        self.regs = RegisterMap(self.i2c, self.address, LPS25H.REGISTERS, auto_increment=LPS25H_AUTO_INCREMENT)
         self.initialize_sensor()
         
 
@@ -215,7 +227,7 @@ class LPS25H(object):
         if not self.pressEnabled:
             raise(Exception('Temperature sensor has to be enabled first'))
 
-        return self._getSensorRawLoHi1(self.address, LPS25H.lpsTempRegisters)
+        return self.regs.read('TEMP_OUT')
 
 
     def getBarometerRaw(self):
@@ -225,7 +237,15 @@ class LPS25H(object):
             raise(Exception('Barometer has to be enabled first'))
 
         # Return sensor data as signed 24 bit value
-        return self._getSensorRawXLoLoHi1(self.address, LPS25H.lpsPressRegisters)
+        return self.regs.read('PRESS_OUT')
+
+
+    def getRawSample(self):
+        """ Return the raw (pressure, temperature) pair from one burst read. """
+        if not self.pressEnabled:
+            raise(Exception('Barometer has to be enabled first'))
+
+        return self.regs.read_many('PRESS_OUT', 'TEMP_OUT')
 
 
     def getBarometerMillibars(self, rounded = True):
@@ -470,23 +490,15 @@ class LPS25H(object):
             
     # Read pressure in hPa
     def read_pres(self):
-        xl = _ReadRegister(LPS25H_ADDR, PRESS_OUT_XL)
-        l = _ReadRegister(LPS25H_ADDR, PRESS_OUT_L)
-        h = _ReadRegister(LPS25H_ADDR, PRESS_OUT_H)
-        # Combine bytes to form the raw pressure value
-        pressure_raw = xl + (l << 8) + (h << 16)
+        # Raw pressure value from a single burst read
+        pressure_raw = self.regs.read('PRESS_OUT')
         # Convert to hPa
         return pressure_raw / 4096.0
 
     # Read temperature in degrees Celsius
     def read_temp(self):
-        l = _ReadRegister(LPS25H_ADDR, TEMP_OUT_L)
-        h = _ReadRegister(LPS25H_ADDR, TEMP_OUT_H)
-        # Combine bytes to form the raw temperature value
-        temp_raw = (l + (h << 8))
-        # Handle sign (16-bit signed)
-        if temp_raw > 32767:
-            temp_raw -= 65536
+        # Raw (signed 16-bit) temperature value from a single burst read
+        temp_raw = self.regs.read('TEMP_OUT')
         # Calculate actual temperature
         return 42.5 + temp_raw / 480.0
             
@@ -568,6 +580,8 @@ class BME688:
         self.address = address
         # self.pressEnabled = False
         self.channel = i2c_channel
+        # Last written control register values, to skip redundant writes
+        self.shadow = ShadowRegisters.for_device(self.i2c, i2c_channel, address)
         self.init_sensor()
         
         # Get variant
@@ -611,6 +625,7 @@ class BME688:
         # Example: reset command, setting up oversampling, filter settings, etc.
         self.write_register(BME680_REG_SOFTRESET, [0xb6])  # Soft reset command
         time.sleep(0.005)  # Wait for the reset to complete
+        self.shadow.invalidate()
         
 #         # Check device ID.
 #         try:
@@ -660,17 +675,23 @@ class BME688:
 #         self.sw_err = (byte_data & 0xF0) / 16
 
     def write_register(self, register, values):
-        self.i2c.writeto_mem(self.address, register, bytes(values))
+        try:
+            self.i2c.writeto_mem(self.address, register, bytes(values))
+        except OSError:
+            self.shadow.invalidate()
+            raise
+        for value in values:
+            self.shadow.note(register, value)
+            register += 1
         
     def write(self, register, values):
         for value in values:
-          self.i2c.writeto_mem(self.address, register, bytearray([value & 0xFF]))
+          self.shadow.write(register, value)
           register += 1
           
     def read(self, register, length):
-        result = bytearray(length)
-        self.i2c.readfrom_mem_into(self.address, register & 0xff, result)
-        return result
+        # Through the shadow, so a bus error also forgets the cached settings
+        return self.shadow.read_into(register & 0xff, bytearray(length))
     
     def read_byte(self, register):
         return self.read(register, 1)[0]
@@ -689,20 +710,20 @@ class BME688:
         if (time.ticks_diff(self.last_reading, time.ticks_ms()) * time.ticks_diff(0, 1) < self.min_refresh_time):
           return
 
+        # Configuration is only written when it changed since the last sample
         # set filter
         self.write(BME680_REG_CONFIG, [self.filter << 2])
-        # turn on temp oversample & pressure oversample
-        self.write(
-            BME680_REG_CTRL_MEAS,
-            [(self._temp_oversample << 5)|(self._pressure_oversample << 2)])
+        # temp oversample & pressure oversample, sleep mode
+        ctrl = (self._temp_oversample << 5)|(self._pressure_oversample << 2)
+        self.write(BME680_REG_CTRL_MEAS, [ctrl])
         # turn on humidity oversample
         self.write(BME680_REG_CTRL_HUM, [self._humidity_oversample])
         # gas measurements enabled
         self.write(BME680_REG_CTRL_GAS, [BME680_RUNGAS << 1])
         
-        ctrl = self.read_byte(BME680_REG_CTRL_MEAS)
-        ctrl = (ctrl & 0xFC) | 0x01  # enable single shot!
-        self.write(BME680_REG_CTRL_MEAS, [ctrl])
+        # enable single shot! The sensor returns to sleep afterwards, which
+        # leaves ctrl_meas holding the sleep-mode value again
+        self.shadow.trigger(BME680_REG_CTRL_MEAS, ctrl | 0x01, ctrl)
         new_data = False
         while not new_data:
             data = self.read(BME680_REG_MEAS_STATUS, 17)
@@ -0,0 +1,287 @@
+# Imports
+import struct
+
+# struct codes for the register widths struct can decode directly.
+# 24-bit registers (pressure/temperature ADCs) are combined by hand.
+_STRUCT_CODES = {1: 'B', 2: 'H', 4: 'I'}
+
+
+class Register:
+    """ Declaration of a single device register.
+
+        'address' is the first sub-address, 'width' the number of bytes,
+        'rshift' drops unused low bits (e.g. 20-bit ADC values stored
+        left-justified in 24 bits) and 'fields' maps bitfield names to
+        (position, bit count) tuples.
+    """
+
+    def __init__(self, name, address, width=1, signed=False, little_endian=True, rshift=0, fields=None):
+        if width not in (1, 2, 3, 4):
+            raise ValueError("Unsupported register width {}".format(width))
+        self.name = name
+        self.address = address
+        self.width = width
+        self.signed = signed
+        self.little_endian = little_endian
+        self.rshift = rshift
+        self.fields = fields or {}
+        if width == 3:
+            self.code = None
+            self.fmt = None
+        else:
+            code = _STRUCT_CODES[width]
+            self.code = code.lower() if signed else code
+            self.fmt = ('<' if little_endian else '>') + self.code
+
+    @property
+    def end(self):
+        return self.address + self.width
+
+    def decode(self, buf, offset=0):
+        """ Decode the register value found at 'offset' in 'buf'. """
+        if self.fmt is None:
+            b0, b1, b2 = buf[offset], buf[offset + 1], buf[offset + 2]
+            if self.little_endian:
+                value = b0 | (b1 << 8) | (b2 << 16)
+            else:
+                value = (b0 << 16) | (b1 << 8) | b2
+            if self.signed and value & 0x800000:
+                value -= 0x1000000
+        else:
+            value = struct.unpack_from(self.fmt, buf, offset)[0]
+        if self.rshift:
+            value >>= self.rshift
+        return value
+
+    def encode(self, value):
+        """ Return the bytes to write for 'value'. """
+        if self.fmt is None:
+            value &= 0xFFFFFF
+            b = bytes([value & 0xFF, (value >> 8) & 0xFF, (value >> 16) & 0xFF])
+            return b if self.little_endian else bytes(reversed(b))
+        return struct.pack(self.fmt, value)
+
+    def get_field(self, value, field):
+        """ Extract bitfield 'field' from a register value. """
+        pos, bits = self.fields[field]
+        return (value >> pos) & ((1 << bits) - 1)
+
+    def set_field(self, value, field, field_value):
+        """ Return 'value' with bitfield 'field' replaced by 'field_value'. """
+        pos, bits = self.fields[field]
+        mask = ((1 << bits) - 1) << pos
+        return (value & ~mask) | ((field_value << pos) & mask)
+
+
+class ReadPlan:
+    """ Bus transactions needed to read a set of registers.
+
+        Registers are sorted by address and merged into bursts whenever
+        the next register starts within 'max_gap' bytes of the current
+        burst and the burst stays within 'max_burst' bytes. Each burst owns
+        a preallocated buffer and, when all its registers share a byte
+        order and have struct codes, one precompiled struct format that
+        decodes the whole burst (gaps become pad bytes).
+    """
+
+    def __init__(self, registers, max_gap=0, max_burst=32):
+        self.names = tuple(reg.name for reg in registers)
+        self.bursts = []
+        burst = None
+        for reg in sorted(registers, key=lambda r: r.address):
+            if burst is not None and reg.address <= burst[1] + max_gap and reg.end - burst[0] <= max_burst:
+                burst[1] = max(burst[1], reg.end)
+                burst[2].append(reg)
+            else:
+                burst = [reg.address, reg.end, [reg]]
+                self.bursts.append(burst)
+
+        self.bursts = [self._compile(start, end, regs) for start, end, regs in self.bursts]
+        # Map the decoded (address) order back to the requested order
+        order = [reg.name for _, _, regs, _ in self.bursts for reg in regs]
+        self.in_order = order == list(self.names)
+        self.index = tuple(order.index(name) for name in self.names)
+
+    def _compile(self, start, end, regs):
+        buf = bytearray(end - start)
+        fmt = None
+        if all(reg.fmt is not None for reg in regs) and len(set(reg.little_endian for reg in regs)) == 1:
+            fmt = '<' if regs[0].little_endian else '>'
+            pos = start
+            for reg in regs:
+                if reg.address < pos:
+                    # Overlapping declarations cannot share one format
+                    fmt = None
+                    break
+                fmt += 'x' * (reg.address - pos) + reg.code
+                pos = reg.end
+        return (start, buf, regs, fmt)
+
+    def decode(self):
+        """ Decode the burst buffers into a tuple in the requested order. """
+        values = []
+        for start, buf, regs, fmt in self.bursts:
+            if fmt is not None:
+                decoded = struct.unpack_from(fmt, buf)
+                for reg, value in zip(regs, decoded):
+                    values.append(value >> reg.rshift if reg.rshift else value)
+            else:
+                for reg in regs:
+                    values.append(reg.decode(buf, reg.address - start))
+        if self.in_order:
+            return tuple(values)
+        return tuple(values[i] for i in self.index)
+
+
+class RegisterMap:
+    """ Register map of one I2C device.
+
+        Drivers declare their registers once and read any combination of
+        them with read()/read_many(); the map plans the minimum number of
+        burst transactions and caches the plan per combination.
+        'auto_increment' is OR-ed into the sub-address of multi-byte
+        reads for devices that need it (e.g. 0x80 on ST sensors).
+    """
+
+    def __init__(self, i2c, address, registers, auto_increment=0x00, max_gap=0, max_burst=32):
+        self.i2c = i2c
+        self.address = address
+        self.auto_increment = auto_increment
+        self.max_gap = max_gap
+        self.max_burst = max_burst
+        self.registers = {}
+        for reg in registers:
+            self.registers[reg.name] = reg
+        self._plans = {}
+        self.transactions = 0
+
+    def __getitem__(self, name):
+        return self.registers[name]
+
+    def plan(self, names):
+        """ Return the (cached) ReadPlan for the register names given. """
+        plan = self._plans.get(names)
+        if plan is None:
+            plan = ReadPlan([self.registers[name] for name in names], self.max_gap, self.max_burst)
+            self._plans[names] = plan
+        return plan
+
+    def _transfer(self, plan):
+        for start, buf, _, _ in plan.bursts:
+            reg = start | self.auto_increment if len(buf) > 1 else start
+            self.i2c.readfrom_mem_into(self.address, reg, buf)
+            self.transactions += 1
+
+    def read_many(self, *names):
+        """ Read the named registers and return their values in the order
+            requested, using as few bus transactions as possible.
+        """
+        plan = self.plan(names)
+        self._transfer(plan)
+        return plan.decode()
+
+    def read(self, name):
+        """ Read and decode a single register. """
+        return self.read_many(name)[0]
+
+    def read_field(self, name, field):
+        """ Read a register and return one of its bitfields. """
+        reg = self.registers[name]
+        return reg.get_field(self.read(name), field)
+
+    def write(self, name, value):
+        """ Encode and write a register value. """
+        reg = self.registers[name]
+        sub_address = reg.address | self.auto_increment if reg.width > 1 else reg.address
+        self.i2c.writeto_mem(self.address, sub_address, reg.encode(value))
+        self.transactions += 1
+
+    def write_field(self, name, field, field_value):
+        """ Read-modify-write one bitfield of a register. """
+        reg = self.registers[name]
+        self.write(name, reg.set_field(self.read(name), field, field_value))
+
+
+class ShadowRegisters:
+    """ Write-elision cache for the control registers of one device.
+
+        Remembers the last value written to each register and skips a
+        write that would not change anything. One cache exists per
+        (bus, address), so several driver objects talking to the same
+        chip stay consistent. The cache is dropped on reset and on any
+        bus error, since the device state is then unknown.
+    """
+
+    _devices = {}
+
+    @classmethod
+    def for_device(cls, i2c, channel, address):
+        """ Return the shared cache of the device at 'address' on bus 'channel'. """
+        key = (channel, address)
+        shadow = cls._devices.get(key)
+        if shadow is None:
+            shadow = cls(i2c, address)
+            cls._devices[key] = shadow
+        else:
+            shadow.i2c = i2c
+        return shadow
+
+    def __init__(self, i2c, address):
+        self.i2c = i2c
+        self.address = address
+        self._values = {}
+        self._buf = bytearray(1)
+        self.writes = 0
+        self.skipped = 0
+
+    def _write(self, reg, value):
+        self._buf[0] = value
+        try:
+            self.i2c.writeto_mem(self.address, reg, self._buf)
+        except OSError:
+            self.invalidate()
+            raise
+        self.writes += 1
+
+    def read_into(self, reg, buf):
+        """ Read the device into 'buf'; a bus error drops the cache too. """
+        try:
+            self.i2c.readfrom_mem_into(self.address, reg, buf)
+        except OSError:
+            self.invalidate()
+            raise
+        return buf
+
+    def write(self, reg, value):
+        """ Write 'value' unless the register already holds it.
+            Returns True when the bus was used.
+        """
+        value &= 0xFF
+        if self._values.get(reg) == value:
+            self.skipped += 1
+            return False
+        self._write(reg, value)
+        self._values[reg] = value
+        return True
+
+    def trigger(self, reg, value, settled=None):
+        """ Always write 'value' (e.g. a forced-mode start). 'settled' is what
+            the register reads back once the device has acted on it; None
+            means unknown.
+        """
+        self._write(reg, value & 0xFF)
+        self.note(reg, settled)
+
+    def note(self, reg, value):
+        """ Record a value written or read by other means (None forgets it). """
+        if value is None:
+            self._values.pop(reg, None)
+        else:
+            self._values[reg] = value & 0xFF
+
+    def invalidate(self):
+        """ Forget everything, e.g. after a reset or a bus error. """
+        self._values.clear()
+
+    def stats(self):
+        return {'writes': self.writes, 'skipped': self.skipped}
@@ -2,8 +2,8 @@
 # from sensors.altimeter import Altimeter
 from sensors.accelerometer import ICM20948 #MPU9250
 from sensors.pressure import LPS25H, BME688
-# from sensors.mems_module import LIS3MDL
-# from sensors.air_quality import AirQualitySensor, CCS811
+from sensors.mems_module import LIS3MDL
+from sensors.air_quality import CCS811
 from sensors.temperature import MCP9808, BME280
 from sensors.uv_sensor import VEML6075
 from sensors.gps import M8NNeo
@@ -12,9 +12,10 @@ from communications.lora import LoRaComm
 from storage.sdcard import SDCard
 from sensors.battery import MAX17048 
 from sensors.esp import ESP32Data
-from utils.logger import Logger
+from utils.logger import get_logger
+from utils.converters import ddm_to_degrees, nmea_time_to_seconds
 
-log = Logger()
+log = get_logger()
 
 class SensorManager:
     def __init__(self):
@@ -23,11 +24,26 @@ class SensorManager:
     def initialize_sensors(self):
         """Initialize or reinitialize all sensor objects."""
         self.accelerometer1 = ICM20948()
+        # Powered up on the pad, so this is the moment to measure the gyro
+        # offset for this flight
+        self.accelerometer1.estimate_gyro_bias()
         self.pressure1 = LPS25H()
         self.pressure2 = BME688()
         self.pressure1.enableLPS()
         self.magnetometric1 = ICM20948()
+        try:
+            self.magnetometric2 = LIS3MDL()
+            self.magnetometric2.enableLIS(odr=155)
+        except Exception as e:
+            # Second heading source is optional, keep acquiring without it
+            self.magnetometric2 = None
+            self.log_error("LIS3MDL", e)
         self.temperature1 = MCP9808()
+        try:
+            self.air_quality_sensor = CCS811()
+        except Exception as e:
+            self.air_quality_sensor = None
+            self.log_error("CCS811", e)
         self.temperature2 = BME280()
         self.uv_sensor = VEML6075()
         self.gps_sensor = M8NNeo()
@@ -84,6 +100,15 @@ class SensorManager:
 #             log.log_entry("ERROR", "Error reading acceleration/magnetometric/gyroscope data", running="sensor_manager.py", function="collect_data()", error=f"{e}" )
 #             print(f"Error reading acceleration/magnetometric/gyroscope data: {e}")
 
+        if self.magnetometric2 is not None:
+            try:
+                data['mag']['lis3mdl'] = self.magnetometric2.read_magnetometer()
+                radiodata['mag']['lis3mdl'] = {key: round(value, 3) for key, value in data['mag']['lis3mdl'].items()}
+            except Exception as e:
+                data['mag']['lis3mdl'] = None
+                radiodata['mag']['lis3mdl'] = None
+                self.log_error("LIS3MDL magnetometer", e)
+
         try:
             data['temp']['bme688'] = self.pressure2.temperature
             data['pres']['bme688'] = self.pressure2.pressure
@@ -135,12 +160,6 @@ class SensorManager:
 #             log.log_entry("ERROR", "Error reading temperature from MCP9808", running="sensor_manager.py", function="collect_data()", error=f"{e}" )
 #             print(f"Error reading temperature from MCP9808: {e}")
 
-#         try:
-#             data['air_quality']['ccs811'] = self.air_quality_sensor.read_quality()
-#         except Exception as e:
-#             data['air_quality']['ccs811'] = None
-#             print(f"Error reading air quality: {e}")
-
         try:
             data['temp']['bmp280'] = self.temperature2.get_temperature()
             data['pres']['bmp280'] = self.temperature2.get_pressure()
@@ -163,6 +182,22 @@ class SensorManager:
 #             log.log_entry("ERROR", "Error reading temperature from BMP280 sensor", running="sensor_manager.py", function="collect_data()", error=f"{e}" )
 #             print(f"Error reading temperature from BMP280 sensor: {e}")
 
+        if self.air_quality_sensor is not None:
+            try:
+                # Compensate eCO2/TVOC with the BME688, falling back to the BME280
+                humidity = data['hum'].get('bme688')
+                if humidity is None:
+                    humidity = data['hum'].get('bmp280')
+                temperature = data['temp'].get('bme688')
+                if temperature is None:
+                    temperature = data['temp'].get('bmp280')
+                data['air']['ccs811'] = self.air_quality_sensor.read_quality(humidity, temperature)
+                radiodata['air']['ccs811'] = data['air']['ccs811']
+            except Exception as e:
+                data['air']['ccs811'] = None
+                radiodata['air']['ccs811'] = None
+                self.log_error("air quality", e)
+
         try:
             data['uv']['uva'] = self.uv_sensor.read_uv_index()
             data['uv']['uvb'] = self.uv_sensor.read_uv_index()
@@ -184,10 +219,15 @@ class SensorManager:
         try:
             data['gps']['gps1'] = self.gps_sensor.get_gps_data()[0]
             data['gps']['gps2'] = self.gps_sensor.get_gps_data()[1]
-            if data['gps']['gps1']:
-                radiodata['gps']['lat'] = data['gps']['gps1']['latitude']
-                radiodata['gps']['lon'] = data['gps']['gps1']['longitude']
-                radiodata['gps']['gtm'] = data['gps']['gps1']['timestamp']
+            if data['gps']['gps1'] and data['gps']['gps1']['latitude']:
+                # Decimal degrees and seconds of day, ready for the binary frame
+                radiodata['gps']['lat'] = ddm_to_degrees(data['gps']['gps1']['latitude'])
+                radiodata['gps']['lon'] = ddm_to_degrees(data['gps']['gps1']['longitude'])
+                radiodata['gps']['gtm'] = nmea_time_to_seconds(data['gps']['gps1']['timestamp'])
+                # The binary flight log stores the decoded values, not the NMEA strings
+                data['gps']['lat'] = radiodata['gps']['lat']
+                data['gps']['lon'] = radiodata['gps']['lon']
+                data['gps']['gtm'] = radiodata['gps']['gtm']
         except Exception as e:
             data['gps']['gps1'] = None
             data['gps']['gps2'] = None
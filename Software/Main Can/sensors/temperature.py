@@ -1,5 +1,6 @@
 from machine import I2C, Pin
 import time
+from sensors.registers import Register, RegisterMap, ShadowRegisters
 
 # Default I2C address for device.
 MCP9808_I2CADDR_DEFAULT        = const(0x18)
@@ -303,11 +304,50 @@ class BME280:
     BME280_REGISTER_TEMP_DATA     = const(0xFA)
     BME280_REGISTER_HUMIDITY_DATA = const(0xFD)
 
+    # Register map: the trimming parameters live in two blocks
+    # (0x88-0xA1 and 0xE1-0xE7) and the ADC outputs in one (0xF7-0xFE),
+    # so calibration takes two bursts and a sample one
+    REGISTERS = (
+        Register('DIG_T1', BME280_REGISTER_DIG_T1, 2),
+        Register('DIG_T2', BME280_REGISTER_DIG_T2, 2, signed=True),
+        Register('DIG_T3', BME280_REGISTER_DIG_T3, 2, signed=True),
+        Register('DIG_P1', BME280_REGISTER_DIG_P1, 2),
+        Register('DIG_P2', BME280_REGISTER_DIG_P2, 2, signed=True),
+        Register('DIG_P3', BME280_REGISTER_DIG_P3, 2, signed=True),
+        Register('DIG_P4', BME280_REGISTER_DIG_P4, 2, signed=True),
+        Register('DIG_P5', BME280_REGISTER_DIG_P5, 2, signed=True),
+        Register('DIG_P6', BME280_REGISTER_DIG_P6, 2, signed=True),
+        Register('DIG_P7', BME280_REGISTER_DIG_P7, 2, signed=True),
+        Register('DIG_P8', BME280_REGISTER_DIG_P8, 2, signed=True),
+        Register('DIG_P9', BME280_REGISTER_DIG_P9, 2, signed=True),
+        Register('DIG_H1', BME280_REGISTER_DIG_H1, 1),
+        Register('DIG_H2', BME280_REGISTER_DIG_H2, 2, signed=True),
+        Register('DIG_H3', BME280_REGISTER_DIG_H3, 1),
+        Register('DIG_E4', BME280_REGISTER_DIG_H4, 1, signed=True),
+        Register('DIG_E5', BME280_REGISTER_DIG_H5, 1),
+        Register('DIG_E6', BME280_REGISTER_DIG_H6, 1, signed=True),
+        Register('DIG_H6', BME280_REGISTER_DIG_H7, 1, signed=True),
+        Register('PRESSURE_DATA', BME280_REGISTER_PRESSURE_DATA, 3, little_endian=False, rshift=4),
+        Register('TEMP_DATA', BME280_REGISTER_TEMP_DATA, 3, little_endian=False, rshift=4),
+        Register('HUMIDITY_DATA', BME280_REGISTER_HUMIDITY_DATA, 2, little_endian=False),
+    )
+
+    CALIBRATION = ('DIG_T1', 'DIG_T2', 'DIG_T3',
+                   'DIG_P1', 'DIG_P2', 'DIG_P3', 'DIG_P4', 'DIG_P5',
+                   'DIG_P6', 'DIG_P7', 'DIG_P8', 'DIG_P9',
+                   'DIG_H1', 'DIG_H2', 'DIG_H3', 'DIG_E4', 'DIG_E5', 'DIG_E6', 'DIG_H6')
+
 
     def __init__(self, i2c_channel=1, scl_pin=48, sda_pin=47, freq=400000, address=BME280_I2CADDR, mode=BME280_OSAMPLE_8):
         self.i2c = I2C(i2c_channel, scl=Pin(scl_pin), sda=Pin(sda_pin))
         self.address = address
         self.channel = i2c_channel
+        # 0xA0 sits between DIG_P9 and DIG_H1, allow a 1-byte gap in bursts
+        self.regs = RegisterMap(self.i2c, self.address, BME280.REGISTERS, max_gap=1)
+        # Last written control register values, to skip redundant writes
+        self.shadow = ShadowRegisters.for_device(self.i2c, i2c_channel, address)
+        self._raw_pressure = None
+        self._raw_humidity = None
         # Check that mode is valid.
         if mode not in [BME280_OSAMPLE_1, BME280_OSAMPLE_2, BME280_OSAMPLE_4,
                     BME280_OSAMPLE_8, BME280_OSAMPLE_16]:
@@ -321,7 +361,7 @@ class BME280:
         self.overscan_humidity = BME280_OSAMPLE_2
         self.__sealevel = 102000
         self.load_calibration()
-        self.write8(BME280_REGISTER_CONTROL, 0x3F)
+        self.shadow.write(BME280_REGISTER_CONTROL, 0x3F)
         self.t_fine = 0
         time.sleep(0.2)
 
@@ -410,52 +450,40 @@ class BME280:
         return self.readS16(register, little_endian=False)
     
     def load_calibration(self):
-        self.dig_T1 = self.readU16LE(BME280_REGISTER_DIG_T1)
-        self.dig_T2 = self.readS16LE(BME280_REGISTER_DIG_T2)
-        self.dig_T1 = self.readU16LE(BME280_REGISTER_DIG_T1)
-        self.dig_T2 = self.readS16LE(BME280_REGISTER_DIG_T2)
-        self.dig_T3 = self.readS16LE(BME280_REGISTER_DIG_T3)
-
-        self.dig_P1 = self.readU16LE(BME280_REGISTER_DIG_P1)
-        self.dig_P2 = self.readS16LE(BME280_REGISTER_DIG_P2)
-        self.dig_P3 = self.readS16LE(BME280_REGISTER_DIG_P3)
-        self.dig_P4 = self.readS16LE(BME280_REGISTER_DIG_P4)
-        self.dig_P5 = self.readS16LE(BME280_REGISTER_DIG_P5)
-        self.dig_P6 = self.readS16LE(BME280_REGISTER_DIG_P6)
-        self.dig_P7 = self.readS16LE(BME280_REGISTER_DIG_P7)
-        self.dig_P8 = self.readS16LE(BME280_REGISTER_DIG_P8)
-        self.dig_P9 = self.readS16LE(BME280_REGISTER_DIG_P9)
-
-        self.dig_H1 = self.readU8(BME280_REGISTER_DIG_H1)
-        self.dig_H2 = self.readS16LE(BME280_REGISTER_DIG_H2)
-        self.dig_H3 = self.readU8(BME280_REGISTER_DIG_H3)
-        self.dig_H6 = self.readS8(BME280_REGISTER_DIG_H7)
-
-        h4 = self.readS8(BME280_REGISTER_DIG_H4)
-        h4 = (h4 << 24) >> 20
-        self.dig_H4 = h4 | (self.readU8(BME280_REGISTER_DIG_H5) & 0x0F)
-
-        h5 = self.readS8(BME280_REGISTER_DIG_H6)
-        h5 = (h5 << 24) >> 20
-        self.dig_H5 = h5 | (
-            self.readU8(BME280_REGISTER_DIG_H5) >> 4 & 0x0F)
+        (self.dig_T1, self.dig_T2, self.dig_T3,
+         self.dig_P1, self.dig_P2, self.dig_P3, self.dig_P4, self.dig_P5,
+         self.dig_P6, self.dig_P7, self.dig_P8, self.dig_P9,
+         self.dig_H1, self.dig_H2, self.dig_H3, e4, e5, e6,
+         self.dig_H6) = self.regs.read_many(*BME280.CALIBRATION)
+
+        # H4 and H5 are 12-bit values sharing the nibbles of 0xE5
+        self.dig_H4 = (e4 << 4) | (e5 & 0x0F)
+        self.dig_H5 = (e6 << 4) | (e5 >> 4 & 0x0F)
 
     def read_raw_temp(self):
         """Reads the raw (uncompensated) temperature from the sensor."""
         meas = self.mode
-        self.write8(BME280_REGISTER_CONTROL_HUM, meas)
-        meas = self.mode << 5 | self.mode << 2 | 1
-        self.write8(BME280_REGISTER_CONTROL, meas)
+        # Humidity oversampling only changes with the mode, skip it otherwise
+        self.shadow.write(BME280_REGISTER_CONTROL_HUM, meas)
+        meas = self.mode << 5 | self.mode << 2
+        # Forced mode must be requested on every sample; the sensor then
+        # drops back to sleep mode
+        self.shadow.trigger(BME280_REGISTER_CONTROL, meas | 1, meas)
 
         sleep_time = 1250 + 2300 * (1 << (self.overscan_temperature - 1))
         sleep_time = sleep_time + 2300 * (1 << (self.overscan_pressure - 1)) + 575
         sleep_time = sleep_time + 2300 * (1 << (self.overscan_humidity - 1)) + 575
         time.sleep(sleep_time / 1000000)  # Wait the required time
 
-        msb = self.readU8(BME280_REGISTER_TEMP_DATA)
-        lsb = self.readU8(BME280_REGISTER_TEMP_DATA + 1)
-        xlsb = self.readU8(BME280_REGISTER_TEMP_DATA + 2)
-        raw = ((msb << 16) | (lsb << 8) | xlsb) >> 4
+        # Pressure, temperature and humidity outputs in one 8-byte burst;
+        # pressure and humidity are kept for the reads that follow
+        try:
+            self._raw_pressure, raw, self._raw_humidity = self.regs.read_many(
+                'PRESSURE_DATA', 'TEMP_DATA', 'HUMIDITY_DATA')
+        except OSError:
+            # The device state is unknown after a bus error, as after a failed write
+            self.shadow.invalidate()
+            raise
         return raw
 
 
@@ -464,21 +492,18 @@ class BME280:
         Assumes that the temperature has already been read
         i.e. that enough delay has been provided
         """
-        msb = self.readU8(BME280_REGISTER_PRESSURE_DATA)
-        lsb = self.readU8(BME280_REGISTER_PRESSURE_DATA + 1)
-        xlsb = self.readU8(BME280_REGISTER_PRESSURE_DATA + 2)
-        raw = ((msb << 16) | (lsb << 8) | xlsb) >> 4
-        return raw
+        if self._raw_pressure is None:
+            return self.regs.read('PRESSURE_DATA')
+        return self._raw_pressure
 
 
     def read_raw_humidity(self):
         """Assumes that the temperature has already been read
         i.e. that enough delay has been provided
         """
-        msb = self.readU8(BME280_REGISTER_HUMIDITY_DATA)
-        lsb = self.readU8(BME280_REGISTER_HUMIDITY_DATA + 1)
-        raw = (msb << 8) | lsb
-        return raw
+        if self._raw_humidity is None:
+            return self.regs.read('HUMIDITY_DATA')
+        return self._raw_humidity
 
 
     def read_temperature(self):
@@ -668,6 +693,7 @@ class BME280:
 
 from machine import I2C, Pin
 import time
+from sensors.registers import Register, RegisterMap, ShadowRegisters
 
 class BMP280:
     def __init__(self, i2c_channel=1, scl_pin=48, sda_pin=47, address=0x77):
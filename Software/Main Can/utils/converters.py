@@ -34,4 +34,20 @@ def epoch2UTC(et):
     da = int(((et % 31556926) % 2629743) / 86400)
     ho = int((((et % 31556926) % 2629743) % 86400) / 3600)
     mi = int(((((et % 31556926) % 2629743) % 86400) % 3600) / 60)
-    print('{}, {}, {}-{}:{}'.format(yr, mo, da, ho, mi))
\ No newline at end of file
+    print('{}, {}, {}-{}:{}'.format(yr, mo, da, ho, mi))
+
+def ddm_to_degrees(ddm):
+    """ Convert an NMEA (d)ddmm.mmmm coordinate such as '4750.6142 N' to signed decimal degrees. """
+    ddm = ddm.strip()
+    direction = ddm[-1]
+    value = float(ddm[:-1].strip())
+    degrees = int(value / 100)
+    decimal = degrees + (value - degrees * 100) / 60
+    return -decimal if direction in 'SW' else decimal
+
+def nmea_time_to_seconds(hhmmss):
+    """ Convert an NMEA hhmmss.ss time of fix to seconds since midnight UTC. """
+    value = float(hhmmss)
+    hours = int(value / 10000)
+    minutes = int(value / 100) % 100
+    return hours * 3600 + minutes * 60 + (value % 100)
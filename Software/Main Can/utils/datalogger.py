@@ -1,21 +1,61 @@
-import json
 import os
 import time
+from communications.logformat import (file_header, encode_sample, encode_seal, read_seal, scan_file, segment_filename,
+                                      parse_segment_filename, FILE_HEADER_SIZE, SAMPLE_RECORD_SIZE, SEAL_RECORD_SIZE,
+                                      SEAL_CLOSED, SEAL_RECOVERED)
+
+BLOCK_SIZE = 4096   # Flash sector and FAT cluster, the file grows by whole blocks
+FLUSH_MS = 1000     # Longest a record waits in RAM before it is written
+SYNC_MS = 5000      # Longest written data waits before the FAT entry is committed
+# A brownout loses at most the last SYNC_MS + FLUSH_MS of samples
+SESSION_FILE = 'logsession.txt'  # Last session number, so file names are never reused
 
 class DataLogger:
-    def __init__(self, base_filename="rcrc24log", max_records=500, max_size=5242880):  # 5 MB limit
+    """Appends the samples to binary log files (communications/logformat.py),
+    a new file (segment) every max_records samples or max_size bytes.
+
+    Records collect in a RAM buffer that is written in whole BLOCK_SIZE
+    blocks, aligned to the start of the file. A partial block is written
+    when the oldest record has waited FLUSH_MS, and the file is committed
+    (flush(), the FAT f_sync) every SYNC_MS, on commit() and on close.
+
+    Files are named by session and segment number (segment_filename()).
+    start_session() runs once at boot: it seals the segment a reset left
+    open and takes the next session number.
+    """
+    def __init__(self, base_filename="rcrc24log", max_records=500, max_size=5242880,  # 5 MB limit
+                 block_size=BLOCK_SIZE, flush_ms=FLUSH_MS, sync_ms=SYNC_MS, session_file=SESSION_FILE):
         self.base_filename = base_filename
+        self.session_file = session_file
+        self.session = None
+        self.segment = 0
         self.max_records = max_records
         self.max_size = max_size
+        self.block_size = block_size
+        self.flush_ms = flush_ms
+        self.sync_ms = sync_ms
         self.current_file = None
         self.current_count = 0
-        
+        # Records are encoded straight into the buffer, nothing is allocated per write
+        self._buffer = bytearray(block_size + SAMPLE_RECORD_SIZE)
+        self._view = memoryview(self._buffer)
+        self._fill = 0
+        self._size = 0              # Bytes written to the current file, instead of tell()
+        self._first = None          # ticks of the oldest buffered record
+        self._last_sync = time.ticks_ms()
+        self.bytes_written = 0
+        self.flushes = 0
+        self.syncs = 0
+        self.flush_ms_last = 0
+        self.flush_ms_max = 0
+        self.sync_ms_max = 0
+
     def get_file_size(self, filename):
         try:
             return os.stat(filename)[6]
         except OSError:
             return 0
-        
+
     def file_exists(self,filename):
         try:
             os.stat(filename)
@@ -23,26 +63,170 @@ class DataLogger:
         except OSError:
             return False
 
+    def _load_session(self):
+        try:
+            with open(self.session_file, 'r') as file:
+                return int(file.read())
+        except (OSError, ValueError):
+            return 0
+
+    def _save_session(self):
+        # Kept in flash, the files also carry it in case this one is lost
+        try:
+            with open(self.session_file, 'w') as file:
+                file.write(str(self.session))
+        except OSError:
+            pass
+
+    def start_session(self):
+        """Seal the newest segment if a reset left it open, then start the
+        next session. Returns what the recovery did, for the event log."""
+        session = self._load_session()
+        newest = None
+        for name in os.listdir():
+            numbers = parse_segment_filename(self.base_filename, name)
+            if numbers is not None and (newest is None or numbers > newest[0]):
+                newest = (numbers, name)
+        result = {'recovered': None}
+        if newest is not None:
+            # A lost or stale session file must not bring old numbers back
+            session = max(session, newest[0][0])
+            try:
+                result = self.recover(newest[1])
+            except OSError as e:
+                # Logging goes on in a new file whatever happened to the old one
+                result = {'recovered': None, 'error': str(e)}
+        self.session = session + 1
+        self.segment = 0
+        self._save_session()
+        result['session'] = self.session
+        return result
+
+    def recover(self, filename):
+        """Seal 'filename' unless it is sealed already. A torn last record
+        stays in place, files are never rewritten; the seal says where it
+        starts."""
+        size = self.get_file_size(filename)
+        if size < FILE_HEADER_SIZE:
+            # Reset before the first block, the file holds nothing
+            os.remove(filename)
+            return {'recovered': filename, 'records': 0, 'torn_bytes': size}
+        with open(filename, 'rb') as file:
+            if size >= FILE_HEADER_SIZE + SEAL_RECORD_SIZE:
+                file.seek(size - SEAL_RECORD_SIZE)
+                if read_seal(file.read(SEAL_RECORD_SIZE), 0) is not None:
+                    return {'recovered': None}
+            try:
+                end, records = scan_file(file, size)
+            except ValueError:
+                # Not a log this version writes, left as it is
+                return {'recovered': None}
+        with open(filename, 'ab') as file:
+            file.write(encode_seal(time.ticks_ms(), end, records, SEAL_RECOVERED))
+        return {'recovered': filename, 'records': records, 'torn_bytes': size - end}
+
     def get_next_filename(self):
-        """Generate a filename with a unique timestamp to prevent overwriting."""
-        epoch_time = int(time.time())  # Get current epoch time
-        filename = f"{self.base_filename}_{epoch_time}.json"
-        # The above uses epoch time directly, ensuring uniqueness for each file creation event
+        """Name of the next segment; session numbers come from flash, so
+        the name is unique even while the RTC is not set."""
+        if self.session is None:
+            self.start_session()
+        filename = segment_filename(self.base_filename, self.session, self.segment)
+        self.segment += 1
         return filename
 
     def open_new_file(self):
-        self.current_file = open(self.get_next_filename(), 'a')
+        self.current_file = open(self.get_next_filename(), 'ab')
         self.current_count = 0
+        self._size = 0
+        # The header goes out with the first block
+        header = file_header(time.time(), self.session, self.segment - 1)
+        self._buffer[:len(header)] = header
+        self._fill = len(header)
+        self._first = time.ticks_ms()
 
     def write_data(self, data):
-        if not self.current_file or self.current_count >= self.max_records or self.current_file.tell() > self.max_size:
-            if self.current_file:
-                self.current_file.close()
+        """Log one sample: 'data' holds 'pid', 'epoch', 'data' (the sensor
+        readings) and 'esp32', as built by the main loop."""
+        if not self.current_file or self.current_count >= self.max_records or self._size + self._fill > self.max_size:
+            self.close()
             self.open_new_file()
-        
-        self.current_file.write(str(data) + '\n')
+
+        now = time.ticks_ms()
+        fields = dict(data['data'])
+        fields['esp32'] = data.get('esp32')
+        encode_sample(self._view[self._fill:self._fill + SAMPLE_RECORD_SIZE], now, data['pid'], data['epoch'], fields)
+        if self._first is None:
+            self._first = now
+        self._fill += SAMPLE_RECORD_SIZE
         self.current_count += 1
 
+        # Size trigger: complete the block the file is in
+        to_boundary = self.block_size - self._size % self.block_size
+        if self._fill >= to_boundary:
+            self._write(to_boundary)
+        self.poll(now)
+
+    def poll(self, now=None):
+        """Apply the time triggers. Called with every sample and while the
+        main loop waits, so slow sample periods keep the same bounds."""
+        if not self.current_file:
+            return
+        if now is None:
+            now = time.ticks_ms()
+        # A partial block, the next full one realigns the file
+        if self._first is not None and time.ticks_diff(now, self._first) >= self.flush_ms:
+            self._write(self._fill)
+        if time.ticks_diff(now, self._last_sync) >= self.sync_ms:
+            self._sync()
+
+    def _write(self, n):
+        start = time.ticks_ms()
+        self.current_file.write(self._view[:n])
+        self.flush_ms_last = time.ticks_diff(time.ticks_ms(), start)
+        self.flush_ms_max = max(self.flush_ms_max, self.flush_ms_last)
+        self.flushes += 1
+        self.bytes_written += n
+        self._size += n
+        rest = self._fill - n
+        if rest:
+            # Less than a record is left over; copied out first, the two ranges may overlap
+            self._buffer[:rest] = bytes(self._view[n:self._fill])
+        self._fill = rest
+        self._first = time.ticks_ms() if rest else None
+
+    def _sync(self):
+        start = time.ticks_ms()
+        if self.current_file:
+            self.current_file.flush()
+        self.sync_ms_max = max(self.sync_ms_max, time.ticks_diff(time.ticks_ms(), start))
+        self.syncs += 1
+        self._last_sync = time.ticks_ms()
+
+    def commit(self):
+        """Write and commit everything logged so far, e.g. when the flight
+        phase changes and the samples around it must survive a brownout."""
+        if self.current_file:
+            if self._fill:
+                self._write(self._fill)
+            self._sync()
+
+    def stats(self):
+        return {
+            'bytes': self.bytes_written,
+            'flushes': self.flushes,
+            'syncs': self.syncs,
+            'flush_ms_last': self.flush_ms_last,
+            'flush_ms_max': self.flush_ms_max,
+            'sync_ms_max': self.sync_ms_max,
+            'buffered': self._fill,
+        }
+
     def close(self):
         if self.current_file:
-            self.current_file.close()
\ No newline at end of file
+            # The seal tells the next boot this segment ended cleanly
+            seal = encode_seal(time.ticks_ms(), self._size + self._fill, self.current_count, SEAL_CLOSED)
+            self._buffer[self._fill:self._fill + len(seal)] = seal
+            self._fill += len(seal)
+            self.commit()
+            self.current_file.close()
+            self.current_file = None
@@ -1,10 +1,10 @@
 from machine import I2C, Pin
-from utils.logger import Logger
+from utils.logger import get_logger
 from utils.i2c_config import SENSOR_MAP, I2C_PINS
 
 class I2CScanner:
     def __init__(self, freq=400000):
-        self.logger = Logger(level='DEBUG')
+        self.logger = get_logger(level='DEBUG')
         self.freq = freq
         self.buses = {}
         # Initialize I2C buses based on the configuration
@@ -21,6 +21,7 @@ class I2CScanner:
         # self.logger.log(f"Scanning for I2C devices on bus {bus_id}...")
         self.logger.log_event("INFO", f"Scanning for I2C devices on bus {bus_id}...")
         devices = i2c.scan()
+        self.logger.log_event("DEBUG", f"I2C scan of bus {bus_id}", addresses=["0x{:02X}".format(device) for device in devices])
         identified_devices = []
         unidentified_devices = []
         device_num = 0
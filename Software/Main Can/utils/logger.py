@@ -2,12 +2,46 @@ import os
 import utime
 import ujson
 
+# Shared instances, one per log file, see get_logger()
+_loggers = {}
+# Directories already checked in this boot
+_ready_dirs = set()
+
+
+def get_logger(log_file='log.txt', level=None):
+    """Return the process-wide logger of 'log_file', created on first use.
+    Modules share it instead of each opening the log again. A module that
+    wants another threshold passes 'level' and gets a LevelLogger, its
+    entries still go through the shared ring and file."""
+    logger = _loggers.get(log_file)
+    if logger is None:
+        logger = Logger(log_file=log_file)
+    if level is not None and Logger.LEVELS[level] != logger.level:
+        return LevelLogger(logger, level)
+    return logger
+
+
+def poll_all():
+    """Flush the loggers whose oldest buffered entry is due; the main loop
+    calls this while it waits, so log_event itself never touches the file."""
+    for logger in _loggers.values():
+        logger.poll()
+
+
+def flush_all():
+    for logger in _loggers.values():
+        logger.flush()
+
+
 class Logger:
     LEVELS = {'DEBUG': 0, 'INFO': 1, 'WARNING': 2, 'ERROR': 3, 'CRITICAL': 4}
     LOG_FILE = 'log.txt'  # Adjust the path according to your system
     MAX_FILE_SIZE = 1024 * 10  # 10KB
     LOG_ROTATION_COUNT = 3  # Keep up to 3 rotated logs
     MIN_CONSOLE_LEVEL = 'ERROR'  # Minimum level to print to console
+    RING_SIZE = 32  # Entries buffered in RAM between two writes
+    FLUSH_MS = 2000  # Longest an entry waits in the ring
+    FLUSH_LEVEL = 'ERROR'  # Entries from this level on are written at once
 
     def __init__(self, base_directory='/SenderSD', log_directory='CanSat2024Log', log_file=LOG_FILE, level='INFO'):
         self.level = self.LEVELS.get(level, 2)
@@ -15,10 +49,23 @@ class Logger:
         self.log_directory = log_directory
         self.log_path = self.base_directory + '/' + self.log_directory
         self.logfile = log_file
+        self.filename = self.log_path + '/' + self.logfile
         self.ensure_dir(self.base_directory)
         self.ensure_dir(self.log_path)
-        
+        self.file = None
+        self.size = 0  # Bytes in the file, counted as they are written
+        # Ring of encoded entries; a full ring is written out, nothing is dropped
+        self._ring = [None] * self.RING_SIZE
+        self._head = 0
+        self._count = 0
+        self._first = 0  # ticks of the oldest entry in the ring
+        self._stamp_time = None
+        self._stamp = ''
+        _loggers.setdefault(log_file, self)
+
     def ensure_dir(self, path):
+        if path in _ready_dirs:
+            return
         try:
             # Try to list directory, if it fails, it might not exist
             os.listdir(path)
@@ -28,90 +75,146 @@ class Logger:
                 os.mkdir(path)  # Create the directory since it does not exist
             else:
                 raise  # Re-raise the exception if it's caused by something else
+        _ready_dirs.add(path)
 
     def log_event(self, level, message, **kwargs):
+        # Below the threshold nothing is built, formatted or written
+        if self.LEVELS[level] < self.level:
+            return
+        self._event(level, message, kwargs)
+
+    def _event(self, level, message, details):
+        now = utime.time()
         log_entry = {
-            'timestamp': utime.time(),
-            'localtime' : self.get_timestamp(),
+            'timestamp': now,
+            'localtime': self.get_timestamp(now),
             'level': level,
             'message': message,
-            'details': kwargs
+            'details': details
         }
-        if self.LEVELS[level] >= self.level:
-            self.output(log_entry, level)
-        # print(str(log_entry).replace("'", '"'))
+        self.output(log_entry, level)
 
     def log(self, message, level='INFO'):
         if self.LEVELS[level] >= self.level:
-            timestamp = self.get_timestamp()
-            log_entry = "[{}] - {} - {}".format(timestamp, level, message)
-            self.output(log_entry, level)
+            self._line(message, level)
 
-    def get_timestamp(self):
-        # Returns formatted timestamp
-        now = utime.localtime()
-        return "{year}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}:{second:02d}".format(
-            year=now[0], month=now[1], day=now[2], hour=now[3], minute=now[4], second=now[5])
+    def _line(self, message, level):
+        log_entry = "[{}] - {} - {}".format(self.get_timestamp(), level, message)
+        self.output(log_entry, level)
 
+    def get_timestamp(self, now=None):
+        # Returns formatted timestamp, formatted once per second
+        if now is None:
+            now = utime.time()
+        if now != self._stamp_time:
+            t = utime.localtime(now)
+            self._stamp = "{year}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}:{second:02d}".format(
+                year=t[0], month=t[1], day=t[2], hour=t[3], minute=t[4], second=t[5])
+            self._stamp_time = now
+        return self._stamp
 
     def output(self, log_entry, log_level):
         # Check if the log level is above or equal to the minimum console level
         if self.LEVELS[log_level] >= self.LEVELS[self.MIN_CONSOLE_LEVEL]:
             print(log_entry)  # Output to console or serial
         self.write_to_file(log_entry)
+        if self.LEVELS[log_level] >= self.LEVELS[self.FLUSH_LEVEL]:
+            # Errors often come just before a reset, they must not stay in RAM
+            self.flush()
 
     def write_to_file(self, log_entry):
-        self.rotate_log()
-        filename = self.base_directory + '/' + self.log_directory + '/' + self.logfile
-        log_entry_str = ujson.dumps(log_entry)
+        """Queue the entry; the file is written by flush()."""
+        if self._count == self.RING_SIZE:
+            self.flush()
+        if not self._count:
+            self._first = utime.ticks_ms()
+        entry = log_entry if isinstance(log_entry, str) else ujson.dumps(log_entry)
+        self._ring[(self._head + self._count) % self.RING_SIZE] = entry
+        self._count += 1
+
+    def poll(self):
+        if self._count and utime.ticks_diff(utime.ticks_ms(), self._first) >= self.FLUSH_MS:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered entries in one go and commit them."""
+        if not self._count:
+            return
         try:
-            with open(filename, 'a') as file:
-                file.write(log_entry_str + '\n')
+            if self.file is None:
+                self.open()
+            written = 0
+            while self._count:
+                entry = self._ring[self._head]
+                self._ring[self._head] = None
+                self._head = (self._head + 1) % self.RING_SIZE
+                self._count -= 1
+                self.file.write(entry)
+                self.file.write('\n')
+                written += len(entry) + 1
+            self.file.flush()
+            self.size += written
         except OSError as e:
             print("Failed to write log to file: ", str(e))
-            
-    def dirname(self, path):
-        # Find the last occurrence of '/'
-        last_slash_index = path.rfind('/')
-        if last_slash_index == -1:
-            # No '/' found, so there's no directory part
-            return ''
-        return path[:last_slash_index]  # Return everything before the last '/'
-            
-    def ensure_file_exists(self, log_path):
-        directory = self.dirname(log_path)
-        
-#         # Ensure the directory exists
-#         if directory and not os.listdir(directory):
-#             try:
-#                 os.mkdir(directory)
-#                 print(f"Created directory: {directory}")
-#             except OSError as e:
-#                 print(f"Failed to create directory {directory}: {str(e)}")
-#                 return  # Exit if the directory cannot be created
-        
-        # Check if the file exists and create it if it does not
+            self.close()
+            return
+        if self.size > self.MAX_FILE_SIZE:
+            self.rotate_log()
+
+    def open(self):
+        self.file = open(self.filename, 'a')
+        # Only read once, written bytes are counted from here on
         try:
-            with open(log_path, 'a') as file:
-                pass  # File exists or has been created
-            # print(f"File {log_path} exists or created successfully.")
-        except OSError as e:
-            print(f"Failed to create file {log_path}: {str(e)}")
+            self.size = os.stat(self.filename)[6]
+        except OSError:
+            self.size = 0
+
+    def close(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
 
     def rotate_log(self):
-        log_path = self.base_directory + '/' + self.log_directory + '/' + self.logfile
-        self.ensure_file_exists(log_path)
-        size = os.stat(log_path)[6]
+        """Shift log.txt.0.log .. log.txt.<count-1>.log along, the oldest
+        is dropped, and start a new file."""
+        self.close()
         try:
-            # Check the file size first to decide whether rotation is needed
-            if os.stat(log_path)[6] > self.MAX_FILE_SIZE:
-                for i in range(self.LOG_ROTATION_COUNT - 1, 0, -1):
-                    older_log = "{}.{}.log".format(log_path, i - 1 if i > 1 else '')
-                    newer_log = "{}.{}.log".format(log_path, i)
-                    if self.ensure_dir(older_log):
-                        os.rename(older_log, newer_log)
-                os.rename(log_path, log_path + ".0.log")
-                open(log_path, 'w').close()  # Create a new log file
+            try:
+                # FAT does not rename onto an existing file
+                os.remove("{}.{}.log".format(self.filename, self.LOG_ROTATION_COUNT - 1))
+            except OSError:
+                pass
+            for i in range(self.LOG_ROTATION_COUNT - 1, 0, -1):
+                older_log = "{}.{}.log".format(self.filename, i - 1)
+                newer_log = "{}.{}.log".format(self.filename, i)
+                try:
+                    os.rename(older_log, newer_log)
+                except OSError:
+                    pass  # Not rotated that many times yet
+            os.rename(self.filename, self.filename + ".0.log")
         except OSError as e:
             print("Failed to rotate log file: ", str(e))
-            self.log("Failed to rotate log file: {}".format(str(e)), "ERROR")
+        self.size = 0
+
+
+class LevelLogger:
+    """The shared logger of a file seen with another threshold, e.g. DEBUG
+    for the I2C scan while the rest of the can logs from INFO on."""
+
+    def __init__(self, logger, level='INFO'):
+        self.logger = logger
+        self.level = Logger.LEVELS[level]
+
+    def log_event(self, level, message, **kwargs):
+        if Logger.LEVELS[level] >= self.level:
+            self.logger._event(level, message, kwargs)
+
+    def log(self, message, level='INFO'):
+        if Logger.LEVELS[level] >= self.level:
+            self.logger._line(message, level)
+
+    def flush(self):
+        self.logger.flush()
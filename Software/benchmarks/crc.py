@@ -0,0 +1,92 @@
+"""
+Host benchmark of the integrity checks in dataintegrity.py, run with
+'python crc.py'.
+
+'before' is the removed work: get_data_checksum() on every sample, and
+the bit-at-a-time CRC loops. 'after' is the current dataintegrity of the
+can, timed with the C CRCs of CPython and again with the lookup tables
+alone, the path MicroPython takes where the port has no C CRC.
+"""
+import os
+import sys
+import timeit
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Main Can'))
+from communications import dataintegrity  # noqa: E402
+
+NUMBER = 2000
+
+SAMPLE = {
+    'pid': 123, 'type': 'TLM', 'valid': True, 'epoch': 1718000000, 'local': '2024-06-10 12:00:00',
+    'data': {
+        'alt': {'bme688': 123.4, 'lps25h': 122.9, 'bmp280': 123.1},
+        'temp': {'bme688': 21.3, 'lps25h': 21.1, 'mcp9808': 21.0, 'bmp280': 21.2},
+        'pres': {'bme688': 998.1, 'lps25h': 998.3, 'bmp280': 998.2},
+        'hum': {'bme688': 45.1, 'bmp280': 44.9},
+        'acc': {'icm20948': {'accel_x': 0.01, 'accel_y': -0.02, 'accel_z': 0.99}},
+        'gyro': {'icm20948': {'gyro_x': 0.1, 'gyro_y': -0.2, 'gyro_z': 0.05}},
+        'mag': {'lis3mdl': {'mag_x': 0.2, 'mag_y': 0.1, 'mag_z': -0.4},
+                'icm20948': {'mag_x': 20.0, 'mag_y': 10.0, 'mag_z': -40.0}},
+        'uv': {'veml6075': {'uva': 1.0, 'uvb': 2.0, 'index': 0.1}},
+        'air': {'ccs811': {'eCO2': 400, 'tVOC': 0}},
+        'gps': {'latitude': '4505.12345', 'longitude': '02610.54321', 'gtm': '120000.00', 'speed': 0.1, 'course': 0.0},
+        'bat': {'volt': 3.91, 'soc': 87.5},
+    },
+    'esp32': {'fmem': 123456, 'wss': -60},
+}
+
+
+def crc32_bitwise(data):
+    crc = 0xffffffff
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xEDB88320
+            else:
+                crc >>= 1
+    return crc ^ 0xffffffff
+
+
+def crc16_bitwise(data, crc=0xffff):
+    for b in data:
+        crc ^= b << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xffff
+            else:
+                crc = (crc << 1) & 0xffff
+    return crc
+
+
+def per_call_us(function, *arguments):
+    return timeit.timeit(lambda: function(*arguments), number=NUMBER) / NUMBER * 1e6
+
+
+def show(label, function, *arguments):
+    print(f"  {label:<44} {per_call_us(function, *arguments):8.1f} us")
+
+
+if __name__ == "__main__":
+    record = str(SAMPLE).encode()
+    frame = bytes(range(40))
+    assert dataintegrity.crc32(record) == crc32_bitwise(record) == zlib.crc32(record)
+    assert dataintegrity.crc16_ccitt(frame) == crc16_bitwise(frame)
+
+    print(f"Per call, {len(record)}-byte sample record, {len(frame)}-byte frame")
+    print("before:")
+    show("get_data_checksum, sample dict", dataintegrity.get_data_checksum, SAMPLE)
+    show("crc32 bitwise, record", crc32_bitwise, record)
+    show("crc16 bitwise, frame", crc16_bitwise, frame)
+    print("after, C CRCs (CPython, crc32 on the ESP32):")
+    show("crc32, record", dataintegrity.crc32, record)
+    show("crc16_ccitt, frame", dataintegrity.crc16_ccitt, frame)
+
+    dataintegrity._crc32_c = None
+    dataintegrity._crc16_c = None
+    assert dataintegrity.crc32(record) == zlib.crc32(record)
+    assert dataintegrity.crc16_ccitt(frame) == crc16_bitwise(frame)
+    print("after, lookup tables only (crc16_ccitt on the can):")
+    show("crc32, record", dataintegrity.crc32, record)
+    show("crc16_ccitt, frame", dataintegrity.crc16_ccitt, frame)
@@ -0,0 +1,64 @@
+"""
+Host micro-benchmark of the 'radio tx' command build in LoRaComm
+(Main Can/communications/lora.py), run with 'python lora_tx.py'.
+
+'before' is the removed path: to_hex() one character at a time, then a
+formatted and encoded command string; 'before, frame' the old
+transmit_frame(), hexlify() and the same string handling. 'after' is
+LoRaComm._dispatch(): hexlify() into the preallocated command buffer,
+written out through a memoryview. All three must give the same bytes.
+"""
+import binascii
+import os
+import timeit
+
+TX_PREFIX = b'radio tx '
+MAX_PAYLOAD = 255
+NUMBER = 2000
+REPEAT = 5
+
+
+def to_hex(data):
+    hex_str = ''
+    for char in data:
+        hex_char = hex(ord(char))[2:]
+        if len(hex_char) < 2:
+            hex_char = '0' + hex_char
+        hex_str += hex_char
+    return hex_str
+
+
+def before(text):
+    return "{}\x0d\x0a".format('radio tx {}'.format(to_hex(text))).encode('ASCII')
+
+
+def before_frame(frame):
+    return "{}\x0d\x0a".format('radio tx ' + binascii.hexlify(frame).decode()).encode('ASCII')
+
+
+tx_buf = bytearray(len(TX_PREFIX) + 2 * MAX_PAYLOAD + 2)
+tx_buf[:len(TX_PREFIX)] = TX_PREFIX
+tx_view = memoryview(tx_buf)
+
+
+def after(frame):
+    start = len(TX_PREFIX)
+    end = start + 2 * len(frame)
+    tx_buf[start:end] = binascii.hexlify(frame)
+    tx_buf[end] = 0x0d
+    tx_buf[end + 1] = 0x0a
+    return tx_view[:end + 2]
+
+
+def per_call_us(function, argument):
+    return min(timeit.repeat(lambda: function(argument), number=NUMBER, repeat=REPEAT)) / NUMBER * 1e6
+
+
+if __name__ == "__main__":
+    print(f"{'payload':>8} {'before':>10} {'before, frame':>14} {'after':>8}")
+    for size in (16, 64, 128, MAX_PAYLOAD):
+        frame = os.urandom(size)
+        text = frame.decode('latin-1')
+        assert before(text) == before_frame(frame) == bytes(after(frame))
+        print(f"{size:6d} B {per_call_us(before, text):8.1f} us {per_call_us(before_frame, frame):11.1f} us "
+              f"{per_call_us(after, frame):5.1f} us")
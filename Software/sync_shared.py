@@ -0,0 +1,72 @@
+"""
+Copies the modules shared by the can, the base station and the host from
+Main Can/communications, where they are edited, into Base Station/lib and
+Data Analysis.
+
+    python sync_shared.py           copy every module that differs
+    python sync_shared.py --check   only list them, exit status 1 if any
+
+Each tree keeps its own line endings, the comparison ignores them.
+Base Station/tests/test_shared_copies.py fails while a copy differs.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SOURCE = 'Main Can/communications'
+# Target directory -> line ending of its files
+TARGETS = {
+    'Base Station/lib': '\n',
+    'Data Analysis': '\r\n',
+}
+# Module -> target directories that keep a copy
+SHARED = {
+    'dataintegrity.py': ('Base Station/lib', 'Data Analysis'),
+    'schema.py': ('Base Station/lib', 'Data Analysis'),
+    'telemetry.py': ('Base Station/lib', 'Data Analysis'),
+    'fec.py': ('Base Station/lib',),
+    'telecommand.py': ('Base Station/lib',),
+    'logformat.py': ('Data Analysis',),
+    'logtransfer.py': ('Data Analysis',),
+}
+
+
+def read_text(path):
+    """ File content with '\\n' line endings, None when it does not exist. """
+    try:
+        with open(path, 'rb') as file:
+            return file.read().decode('utf-8').replace('\r\n', '\n')
+    except FileNotFoundError:
+        return None
+
+
+def copies():
+    """ (source path, copy path, line ending) of every shared module. """
+    for name, targets in SHARED.items():
+        for target in targets:
+            yield os.path.join(ROOT, SOURCE, name), os.path.join(ROOT, target, name), TARGETS[target]
+
+
+def out_of_sync():
+    """ Copy paths, relative to this folder, whose content differs from the source. """
+    return [os.path.relpath(copy, ROOT) for source, copy, _ in copies() if read_text(copy) != read_text(source)]
+
+
+def sync():
+    """ Rewrite the copies that differ, returns their paths. """
+    changed = out_of_sync()
+    for source, copy, newline in copies():
+        if os.path.relpath(copy, ROOT) in changed:
+            with open(copy, 'wb') as file:
+                file.write(read_text(source).replace('\n', newline).encode('utf-8'))
+    return changed
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['--check']:
+        stale = out_of_sync()
+        for path in stale:
+            print(f"{path} differs from {SOURCE}")
+        sys.exit(1 if stale else 0)
+    for path in sync():
+        print(f"Updated {path}")